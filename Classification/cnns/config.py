@@ -183,6 +183,19 @@ def get_parser(parser=None):
         default=1,
         help="print loss every n iteration",
     )
+    parser.add_argument(
+        "--metric_file",
+        type=str,
+        default=None,
+        help="file metrics are written to, csv if it ends with .csv, else json lines",
+    )
+    parser.add_argument(
+        "--metric_print_format",
+        type=str,
+        default="normal",
+        choices=["normal", "none"],
+        help="none to only write metrics to --metric_file",
+    )
     add_ofrecord_args(parser)
     add_optimizer_args(parser)
     return parser
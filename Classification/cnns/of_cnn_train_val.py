@@ -19,7 +19,7 @@ import oneflow as flow
 import ofrecord_util
 import optimizer_util
 import config as configs
-from util import Snapshot, InitNodes, Metric
+from util import Snapshot, InitNodes, Metric, MetricSink
 from job_function_util import get_train_config, get_val_config
 import resnet_model
 import resnext_model
@@ -134,12 +134,18 @@ def main():
 
     print(" {} iter per epoch...".format(epoch_size))
 
+    metric_sink = None
+    if args.metric_file:
+        metric_sink = MetricSink(args.metric_file)
+
     for epoch in range(args.num_epochs):
         metric = Metric(
             desc="train",
             calculate_batches=args.loss_print_every_n_iter,
             batch_size=train_batch_size,
             loss_key="loss",
+            sink=metric_sink,
+            print_format=args.metric_print_format,
         )
         for i in range(epoch_size):
             TrainNet().async_get(metric.metric_cb(epoch, i))
@@ -149,11 +155,16 @@ def main():
                 desc="validation",
                 calculate_batches=num_val_steps,
                 batch_size=val_batch_size,
+                sink=metric_sink,
+                print_format=args.metric_print_format,
             )
             for i in range(num_val_steps):
                 InferenceNet().async_get(metric.metric_cb(epoch, i))
         snapshot.save("epoch_{}".format(epoch))
 
+    if metric_sink is not None:
+        metric_sink.close()
+
 
 if __name__ == "__main__":
     main()
@@ -15,12 +15,21 @@ limitations under the License.
 """
 
 import os
+import sys
 import time
 import numpy as np
 import pandas as pd
 from datetime import datetime
 import oneflow as flow
 
+sys.path.append(
+    os.path.abspath(
+        os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)
+    )
+)
+
+from metric_sink import MetricSink
+
 
 def InitNodes(args):
     if args.num_nodes > 1:
@@ -94,13 +103,30 @@ class Metric(object):
         prediction_key="predictions",
         label_key="labels",
         loss_key=None,
+        sink=None,
+        print_format="normal",
     ):
+        if print_format not in ("normal", "none"):
+            raise ValueError("print_format must be <normal|none>")
+
         self.desc = desc
         self.calculate_batches = calculate_batches
         self.top_k = top_k
         self.prediction_key = prediction_key
         self.label_key = label_key
         self.loss_key = loss_key
+        self.sink = sink
+        self.print_format = print_format
+        self.record_fields = (
+            "desc",
+            "epoch",
+            "step",
+            "timestamp",
+            "throughput",
+            "loss",
+            "top_1",
+            "top_k",
+        )
         if loss_key:
             self.fmt = "{}: epoch {}, iter {}, loss: {:.6f}, top_1: {:.6f}, top_k: {:.6f}, samples/s: {:.3f}"
         else:
@@ -144,33 +170,52 @@ class Metric(object):
                     top_1_accuracy = 0.0
                     top_k_accuracy = 0.0
 
+                loss = None
                 if self.loss_key:
                     loss = outputs[self.loss_key].mean()
-                    print(
-                        self.fmt.format(
+
+                if self.sink is not None:
+                    self.sink.push(
+                        self.record_fields,
+                        (
                             self.desc,
                             epoch,
                             step + 1,
-                            loss,
-                            top_1_accuracy,
-                            top_k_accuracy,
+                            time.time(),
                             throughput,
-                        ),
-                        time.time(),
-                    )
-                else:
-                    print(
-                        self.fmt.format(
-                            self.desc,
-                            epoch,
-                            step + 1,
+                            loss,
                             top_1_accuracy,
                             top_k_accuracy,
-                            throughput,
                         ),
-                        time.time(),
                     )
 
+                if self.print_format == "normal":
+                    if self.loss_key:
+                        print(
+                            self.fmt.format(
+                                self.desc,
+                                epoch,
+                                step + 1,
+                                loss,
+                                top_1_accuracy,
+                                top_k_accuracy,
+                                throughput,
+                            ),
+                            time.time(),
+                        )
+                    else:
+                        print(
+                            self.fmt.format(
+                                self.desc,
+                                epoch,
+                                step + 1,
+                                top_1_accuracy,
+                                top_k_accuracy,
+                                throughput,
+                            ),
+                            time.time(),
+                        )
+
                 self._clear()
 
         return callback
@@ -0,0 +1,123 @@
+"""
+Copyright 2020 The OneFlow Authors. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import argparse
+import json
+import time
+
+import tokenization
+from config import str2bool
+
+
+def get_parser():
+  parser = argparse.ArgumentParser(description="benchmark of bert tokenization")
+  parser.add_argument("--vocab_file", type=str, required=True,
+                      help="The vocabulary file that the BERT model was trained on.")
+  parser.add_argument("--squad_file", type=str, required=True,
+                      help="SQuAD json file, its paragraph contexts are tokenized.")
+  parser.add_argument('--do_lower_case', type=str2bool, nargs='?', const=True,
+                      default='True')
+  parser.add_argument("--max_paragraphs", type=int, default=None)
+  return parser
+
+
+def reference_wordpiece_tokenize(wordpiece_tokenizer, text):
+  """The original greedy longest-match-first WordpieceTokenizer.tokenize."""
+  output_tokens = []
+  for token in tokenization.whitespace_tokenize(text):
+    chars = list(token)
+    if len(chars) > wordpiece_tokenizer.max_input_chars_per_word:
+      output_tokens.append(wordpiece_tokenizer.unk_token)
+      continue
+
+    is_bad = False
+    start = 0
+    sub_tokens = []
+    while start < len(chars):
+      end = len(chars)
+      cur_substr = None
+      while start < end:
+        substr = "".join(chars[start:end])
+        if start > 0:
+          substr = "##" + substr
+        if substr in wordpiece_tokenizer.vocab:
+          cur_substr = substr
+          break
+        end -= 1
+      if cur_substr is None:
+        is_bad = True
+        break
+      sub_tokens.append(cur_substr)
+      start = end
+
+    if is_bad:
+      output_tokens.append(wordpiece_tokenizer.unk_token)
+    else:
+      output_tokens.extend(sub_tokens)
+  return output_tokens
+
+
+def read_contexts(squad_file, max_paragraphs):
+  with open(squad_file, "r") as reader:
+    input_data = json.load(reader)["data"]
+  contexts = [paragraph["context"] for entry in input_data
+              for paragraph in entry["paragraphs"]]
+  return contexts[:max_paragraphs]
+
+
+def bench(name, tokenize, inputs, reference=None):
+  start = time.time()
+  outputs = [tokenize(x) for x in inputs]
+  elapsed = time.time() - start
+  verified = "-" if reference is None else str(outputs == reference)
+  print("| {:<26} | {:>12.1f} | {:>10.4f} | {:<8} |".format(
+      name, len(inputs) / elapsed, elapsed, verified))
+  return outputs
+
+
+def main():
+  args = get_parser().parse_args()
+  tokenizer = tokenization.FullTokenizer(
+      vocab_file=args.vocab_file, do_lower_case=args.do_lower_case)
+  contexts = read_contexts(args.squad_file, args.max_paragraphs)
+  words = [word for context in contexts
+           for word in tokenizer.basic_tokenizer.tokenize(context)]
+  print("{} paragraphs, {} words".format(len(contexts), len(words)))
+
+  print("| {:<26} | {:>12} | {:>10} | {:<8} |".format(
+      "tokenizer", "items/sec", "seconds", "verified"))
+  print("| {} | {} | {} | {} |".format("-" * 26, "-" * 12, "-" * 10, "-" * 8))
+  wordpiece = tokenizer.wordpiece_tokenizer
+  reference = bench("wordpiece reference",
+                    lambda word: reference_wordpiece_tokenize(wordpiece, word),
+                    words)
+  bench("wordpiece trie", wordpiece.tokenize, words, reference)
+
+  basic = tokenizer.basic_tokenizer
+  reference = bench("basic per char", basic._tokenize_per_char, contexts)
+  bench("basic tables", basic.tokenize, contexts, reference)
+
+  # squad_util tokenizes every whitespace separated token of a context
+  doc_tokens = [token for context in contexts for token in context.split()]
+  reference = bench("squad doc tokens reference",
+                    lambda token: [
+                        piece for word in basic._tokenize_per_char(token)
+                        for piece in reference_wordpiece_tokenize(
+                            wordpiece, word)], doc_tokens)
+  bench("squad doc tokens", tokenizer.tokenize, doc_tokens, reference)
+
+
+if __name__ == "__main__":
+  main()
@@ -71,6 +71,10 @@ def get_parser(parser=None):
         help="save model snapshot for last iteration")
     parser.add_argument("--model_load_dir", type=str, default=None, help="model load directory")
     parser.add_argument("--log_dir", type=str, default="./output", help="log info save directory")
+    parser.add_argument("--metric_file", type=str, default=None,
+        help="file metrics are written to, csv if it ends with .csv, else json lines")
+    parser.add_argument("--metric_print_format", type=str, default="normal",
+        choices=["normal", "none"], help="none to only write metrics to --metric_file")
 
     # bert backbone
     parser.add_argument('--do_lower_case', type=str2bool, nargs='?', const=True, default='True')
@@ -22,7 +22,7 @@ import config as configs
 import oneflow as flow
 
 from pretrain import PreTrain
-from util import Snapshot, InitNodes, Metric, CreateOptimizer, GetFunctionConfig
+from util import Snapshot, InitNodes, Metric, MetricSink, CreateOptimizer, GetFunctionConfig
 
 parser = configs.get_parser()
 parser.add_argument("--data_dir", type=str, default=None)
@@ -104,8 +104,10 @@ def main():
 
     snapshot = Snapshot(args.model_save_dir, args.model_load_dir)
 
+    metric_sink = MetricSink(args.metric_file) if args.metric_file else None
     metric = Metric(desc='train', print_steps=args.loss_print_every_n_iter, 
-                    batch_size=batch_size, keys=['total_loss', 'mlm_loss', 'nsp_loss'])
+                    batch_size=batch_size, keys=['total_loss', 'mlm_loss', 'nsp_loss'],
+                    sink=metric_sink, print_format=args.metric_print_format)
     for step in range(args.iter_num):
         PretrainJob().async_get(metric.metric_cb(step))
         #PretrainJob().async_get(metric.metric_cb(step, epoch=3))
@@ -115,6 +117,9 @@ def main():
     if args.save_last_snapshot:
         snapshot.save("last_snapshot")
 
+    if metric_sink is not None:
+        metric_sink.close()
+
 
 if __name__ == "__main__":
     main()
@@ -31,8 +31,10 @@ limitations under the License.
 """Tokenization classes."""
 
 import collections
+import multiprocessing
 import re
 import unicodedata
+import numpy as np
 import six
 #import tensorflow as tf
 
@@ -162,6 +164,31 @@ def convert_ids_to_tokens(inv_vocab, ids):
   return convert_by_vocab(inv_vocab, ids)
 
 
+_ENCODE_WORKER_TOKENIZER = None
+
+
+def _init_encode_worker(tokenizer_cls, args, kwargs):
+  """Builds the tokenizer of a pool worker from its files, so that the
+  parent's tokenizer is not pickled to every worker."""
+  global _ENCODE_WORKER_TOKENIZER
+  _ENCODE_WORKER_TOKENIZER = tokenizer_cls(*args, **kwargs)
+
+
+def _encode_texts(tokenizer, texts):
+  """Returns the flat ids of `texts` and the number of ids of every text."""
+  ids = []
+  lengths = np.empty(len(texts), dtype=np.int64)
+  for i, text in enumerate(texts):
+    text_ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
+    ids.extend(text_ids)
+    lengths[i] = len(text_ids)
+  return np.array(ids, dtype=np.int64), lengths
+
+
+def _encode_worker(texts):
+  return _encode_texts(_ENCODE_WORKER_TOKENIZER, texts)
+
+
 def whitespace_tokenize(text):
   """Runs basic whitespace cleaning and splitting on a piece of text."""
   text = text.strip()
@@ -175,6 +202,9 @@ class FullTokenizer(object):
   """Runs end-to-end tokenziation."""
 
   def __init__(self, vocab_file, do_lower_case=True):
+    # to build the same tokenizer in encode_batch workers
+    self.init_args = (vocab_file,)
+    self.init_kwargs = dict(do_lower_case=do_lower_case)
     self.vocab = load_vocab(vocab_file)
     self.inv_vocab = {v: k for k, v in self.vocab.items()}
     self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
@@ -194,6 +224,32 @@ class FullTokenizer(object):
   def convert_ids_to_tokens(self, ids):
     return convert_by_vocab(self.inv_vocab, ids)
 
+  def encode_batch(self, texts, num_workers=1, chunk_size=64):
+    """Tokenizes `texts` into ids, in a pool of `num_workers` processes.
+
+    Texts are dispatched to the workers in chunks of `chunk_size` and the
+    results are kept in input order.
+
+    Returns:
+      A tuple (ids, offsets) of int64 arrays, ids of text i are
+      ids[offsets[i]:offsets[i + 1]].
+    """
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    if num_workers > 1 and len(chunks) > 1:
+      with multiprocessing.Pool(
+          num_workers, initializer=_init_encode_worker,
+          initargs=(type(self), self.init_args, self.init_kwargs)) as pool:
+        results = list(pool.imap(_encode_worker, chunks))
+    else:
+      results = [_encode_texts(self, chunk) for chunk in chunks]
+
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    if not results:
+      return np.zeros(0, dtype=np.int64), offsets
+    ids, lengths = zip(*results)
+    np.cumsum(np.concatenate(lengths), out=offsets[1:])
+    return np.concatenate(ids), offsets
+
 
 class BasicTokenizer(object):
   """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
@@ -209,6 +265,22 @@ class BasicTokenizer(object):
   def tokenize(self, text):
     """Tokenizes a piece of text."""
     text = convert_to_unicode(text)
+    if _NON_BMP_RE.search(text) is not None:
+      return self._tokenize_per_char(text)
+
+    # Same steps as _tokenize_per_char, each one a pass over the whole text
+    # with the precomputed tables of the Basic Multilingual Plane. Lower
+    # casing and accent stripping do not depend on the whitespace splitting.
+    text = text.translate(_CLEAN_TEXT_TABLE)
+    text = _CHINESE_CHAR_RE.sub(r" \g<0> ", text)
+    if self.do_lower_case:
+      text = text.lower()
+      if not text.isascii():
+        text = unicodedata.normalize("NFD", text).translate(_STRIP_ACCENTS_TABLE)
+    return _PUNCTUATION_RE.sub(r" \g<0> ", text).split()
+
+  def _tokenize_per_char(self, text):
+    """Tokenizes a piece of text, one character at a time."""
     text = self._clean_text(text)
 
     # This was added on November 1st, 2018 for the multilingual and Chinese
@@ -310,6 +382,20 @@ class BasicTokenizer(object):
     return "".join(output)
 
 
+_TRIE_END = ""
+
+
+def _build_trie(words):
+  """Builds a prefix trie of nested dicts, `_TRIE_END` marks complete words."""
+  root = {}
+  for word in words:
+    node = root
+    for char in word:
+      node = node.setdefault(char, {})
+    node[_TRIE_END] = True
+  return root
+
+
 class WordpieceTokenizer(object):
   """Runs WordPiece tokenziation."""
 
@@ -317,6 +403,10 @@ class WordpieceTokenizer(object):
     self.vocab = vocab
     self.unk_token = unk_token
     self.max_input_chars_per_word = max_input_chars_per_word
+    # Pieces starting a word, and pieces continuing a word without "##".
+    self.trie = _build_trie(vocab)
+    self.suffix_trie = _build_trie(
+        piece[2:] for piece in vocab if piece.startswith("##"))
 
   def tokenize(self, text):
     """Tokenizes a piece of text into its word pieces.
@@ -340,29 +430,36 @@ class WordpieceTokenizer(object):
 
     output_tokens = []
     for token in whitespace_tokenize(text):
-      chars = list(token)
-      if len(chars) > self.max_input_chars_per_word:
+      if len(token) > self.max_input_chars_per_word:
         output_tokens.append(self.unk_token)
         continue
+      if token in self.vocab:
+        # The longest match is the whole word.
+        output_tokens.append(token)
+        continue
 
       is_bad = False
       start = 0
       sub_tokens = []
-      while start < len(chars):
-        end = len(chars)
-        cur_substr = None
-        while start < end:
-          substr = "".join(chars[start:end])
-          if start > 0:
-            substr = "##" + substr
-          if substr in self.vocab:
-            cur_substr = substr
+      while start < len(token):
+        # Walk the trie along the token, remembering the longest match.
+        node = self.trie if start == 0 else self.suffix_trie
+        end = None
+        i = start
+        while i < len(token):
+          node = node.get(token[i])
+          if node is None:
             break
-          end -= 1
-        if cur_substr is None:
+          i += 1
+          if _TRIE_END in node:
+            end = i
+        if end is None:
           is_bad = True
           break
-        sub_tokens.append(cur_substr)
+        if start > 0:
+          sub_tokens.append("##" + token[start:end])
+        else:
+          sub_tokens.append(token[:end])
         start = end
 
       if is_bad:
@@ -372,7 +469,7 @@ class WordpieceTokenizer(object):
     return output_tokens
 
 
-def _is_whitespace(char):
+def _is_whitespace_uncached(char):
   """Checks whether `chars` is a whitespace character."""
   # \t, \n, and \r are technically contorl characters but we treat them
   # as whitespace since they are generally considered as such.
@@ -384,7 +481,7 @@ def _is_whitespace(char):
   return False
 
 
-def _is_control(char):
+def _is_control_uncached(char):
   """Checks whether `chars` is a control character."""
   # These are technically control characters but we count them as whitespace
   # characters.
@@ -396,7 +493,7 @@ def _is_control(char):
   return False
 
 
-def _is_punctuation(char):
+def _is_punctuation_uncached(char):
   """Checks whether `chars` is a punctuation character."""
   cp = ord(char)
   # We treat all non-letter/number ASCII as punctuation.
@@ -410,3 +507,82 @@ def _is_punctuation(char):
   if cat.startswith("P"):
     return True
   return False
+
+
+_WHITESPACE = 1
+_CONTROL = 2
+_PUNCTUATION = 4
+_NONSPACING_MARK = 8
+_BMP_SIZE = 0x10000
+
+
+def _build_char_classes():
+  """Class flags of every code point of the Basic Multilingual Plane."""
+  char_classes = bytearray(_BMP_SIZE)
+  for cp in range(_BMP_SIZE):
+    char = six.unichr(cp)
+    if _is_whitespace_uncached(char):
+      char_classes[cp] |= _WHITESPACE
+    if _is_control_uncached(char):
+      char_classes[cp] |= _CONTROL
+    if _is_punctuation_uncached(char):
+      char_classes[cp] |= _PUNCTUATION
+    if unicodedata.category(char) == "Mn":
+      char_classes[cp] |= _NONSPACING_MARK
+  return char_classes
+
+
+def _char_class_regex(char_classes, flag):
+  """Regex matching one character of the code points having `flag`."""
+  ranges = []
+  for cp in range(_BMP_SIZE):
+    if char_classes[cp] & flag:
+      if ranges and ranges[-1][1] == cp - 1:
+        ranges[-1][1] = cp
+      else:
+        ranges.append([cp, cp])
+  return re.compile("[" + "".join(
+      re.escape(six.unichr(start)) + "-" + re.escape(six.unichr(end))
+      for start, end in ranges) + "]")
+
+
+_CHAR_CLASSES = _build_char_classes()
+
+# Mirrors BasicTokenizer._clean_text.
+_CLEAN_TEXT_TABLE = {}
+for _cp in range(_BMP_SIZE):
+  if _cp == 0 or _cp == 0xfffd or _CHAR_CLASSES[_cp] & _CONTROL:
+    _CLEAN_TEXT_TABLE[_cp] = None
+  elif _CHAR_CLASSES[_cp] & _WHITESPACE and _cp != ord(" "):
+    _CLEAN_TEXT_TABLE[_cp] = " "
+_STRIP_ACCENTS_TABLE = {
+    cp: None for cp in range(_BMP_SIZE) if _CHAR_CLASSES[cp] & _NONSPACING_MARK}
+
+_PUNCTUATION_RE = _char_class_regex(_CHAR_CLASSES, _PUNCTUATION)
+# The ranges of BasicTokenizer._is_chinese_char within the BMP.
+_CHINESE_CHAR_RE = re.compile(u"[\u4e00-\u9fff\u3400-\u4dbf\uf900-\ufaff]")
+_NON_BMP_RE = re.compile(u"[^\u0000-\uffff]")
+
+
+def _is_whitespace(char):
+  """Checks whether `chars` is a whitespace character."""
+  cp = ord(char)
+  if cp < _BMP_SIZE:
+    return bool(_CHAR_CLASSES[cp] & _WHITESPACE)
+  return _is_whitespace_uncached(char)
+
+
+def _is_control(char):
+  """Checks whether `chars` is a control character."""
+  cp = ord(char)
+  if cp < _BMP_SIZE:
+    return bool(_CHAR_CLASSES[cp] & _CONTROL)
+  return _is_control_uncached(char)
+
+
+def _is_punctuation(char):
+  """Checks whether `chars` is a punctuation character."""
+  cp = ord(char)
+  if cp < _BMP_SIZE:
+    return bool(_CHAR_CLASSES[cp] & _PUNCTUATION)
+  return _is_punctuation_uncached(char)
@@ -15,6 +15,7 @@ limitations under the License.
 """
 
 import os
+import sys
 import time
 import numpy as np
 from collections import OrderedDict
@@ -22,6 +23,14 @@ import pandas as pd
 from datetime import datetime
 import oneflow as flow
 
+sys.path.append(
+    os.path.abspath(
+        os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)
+    )
+)
+
+from metric_sink import MetricSink
+
 
 def InitNodes(args):
     if args.num_nodes > 1:
@@ -77,7 +86,8 @@ class StopWatch(object):
 
 
 class Metric(object):
-    def __init__(self, desc='train', print_steps=-1, batch_size=256, keys=[]):
+    def __init__(self, desc='train', print_steps=-1, batch_size=256, keys=[], sink=None,
+                 print_format='normal'):
         r"""accumulate and calculate metric
 
         Args:
@@ -85,8 +95,12 @@ class Metric(object):
             print_steps: `Int` print metrics every nth steps
             batch_size: `Int` batch size per step
             keys: keys in callback outputs
+            sink: `MetricSink` receives a record at every print
+            print_format: `str` normal, or none to disable printing
         Returns:
         """
+        if print_format not in ('normal', 'none'):
+            raise ValueError("print_format must be <normal|none>")
         self.desc = desc
         self.print_steps = print_steps
         assert batch_size > 0
@@ -96,6 +110,9 @@ class Metric(object):
         self.keys = keys
         self.metric_dict = OrderedDict()
         self.metric_dict['step'] = 0
+        self.sink = sink
+        self.print_format = print_format
+        self.record_fields = ('desc', 'step', 'timestamp', 'throughput') + tuple(keys)
 
         self.timer = StopWatch()
         self.timer.start()
@@ -131,8 +148,13 @@ class Metric(object):
                 for key in self.keys:
                     value = self.metric_dict[key] / self.metric_dict['n_' + key]
                     self.update_and_save(key, value, step, **kwargs)
-                print(', '.join(('{}: {}' if type(v) is int else '{}: {:.3f}').format(k, v) \
-                                for k, v in self.metric_dict.items()), time.time())
+                if self.sink is not None:
+                    self.sink.push(self.record_fields,
+                                   (self.desc, step, time.time(), throughput)
+                                   + tuple(self.metric_dict[key] for key in self.keys))
+                if self.print_format == 'normal':
+                    print(', '.join(('{}: {}' if type(v) is int else '{}: {:.3f}').format(k, v) \
+                                    for k, v in self.metric_dict.items()), time.time())
                 self._clear()
 
         return callback
@@ -0,0 +1,41 @@
+#!/bin/bash
+
+export PYTHONUNBUFFERED=1
+
+PROMPT_FILE=/path/to/prompts.txt
+VOCAB_FILE=/path/to/gpt2-vocab.json
+MERGE_FILE=/path/to/gpt2-merges.txt
+CHECKPOINT_PATH=/path/to/model
+
+device=gpu
+micro_batch_size=8
+hidden_size=768
+num_attn_heads=12
+num_layers=12
+seq_length=1024
+max_new_tokens=64
+
+cmd=""
+cmd+="python3 tools/generate_samples.py "
+cmd+="--prompt-file $PROMPT_FILE "
+cmd+="--tokenizer-type GPT2BPETokenizer "
+cmd+="--merge-file $MERGE_FILE "
+cmd+="--vocab-file $VOCAB_FILE "
+cmd+="--load $CHECKPOINT_PATH "
+cmd+="--vocab-size 50257 "
+cmd+="--hidden-size $hidden_size "
+cmd+="--num-attention-heads $num_attn_heads "
+cmd+="--num-layers $num_layers "
+cmd+="--seq-length $seq_length "
+cmd+="--max-new-tokens $max_new_tokens "
+cmd+="--top-k 40 "
+cmd+="--temperature 0.9 "
+cmd+="--device $device "
+cmd+="--make-vocab-size-divisible-by=128 "
+cmd+="--micro-batch-size=$micro_batch_size "
+cmd+="--num-gpus-per-node=1 "
+cmd+="--num-nodes=1 "
+
+set -x
+
+$cmd
@@ -409,8 +409,15 @@ def _add_training_args(parser):
         "--metric-print-format",
         type=str,
         default="table",
-        choices=["normal", "table"],
-        help="metric print format <normal|table>",
+        choices=["normal", "table", "none"],
+        help="metric print format <normal|table|none>",
+    )
+    group.add_argument(
+        "--metric-file",
+        type=str,
+        default=None,
+        help="File the metrics of every step are written to, as csv if it ends"
+        " with .csv, otherwise as json lines.",
     )
 
     return parser
@@ -512,6 +519,31 @@ def _add_checkpointing_args(parser):
         default=False,
         help="save model snapshot for inited",
     )
+    group.add_argument(
+        "--save-async",
+        action="store_true",
+        default=False,
+        help="Copy the variables to host memory and write snapshots on a "
+        "background thread, a save waits for the previous one to finish.",
+    )
+    group.add_argument(
+        "--keep-last-snapshots",
+        type=int,
+        default=0,
+        help="Retention policy, keep the last N snapshots of the save dir.",
+    )
+    group.add_argument(
+        "--keep-snapshot-interval",
+        type=int,
+        default=0,
+        help="Retention policy, keep the snapshots of iterations divisible by K.",
+    )
+    group.add_argument(
+        "--keep-best-snapshots",
+        type=int,
+        default=0,
+        help="Retention policy, keep the N snapshots with the lowest training loss.",
+    )
 
     return parser
 
@@ -597,8 +629,11 @@ def _add_data_args(parser):
     group.add_argument(
         "--dataset",
         type=str,
+        nargs="+",
         default=None,
-        help="Path join the data index file and binary file prefix.",
+        help="Path join the data index file and binary file prefix, or"
+        " `weight1 prefix1 weight2 prefix2 ...` to blend datasets"
+        " (external dataset only).",
     )
     group.add_argument(
         "--split",
@@ -624,6 +659,35 @@ def _add_data_args(parser):
         action="store_true",
         help="Use external megatron dataset.",
     )
+    group.add_argument(
+        "--num-prefetch-batches",
+        type=int,
+        default=2,
+        help="Number of batches of the external dataset assembled ahead "
+        "of training on a background thread.",
+    )
+    group.add_argument(
+        "--mmap-warmup",
+        type=str,
+        default="full",
+        choices=["full", "samples", "none"],
+        help="Page in the whole external dataset before training, or only "
+        "the documents of the samples this run will consume.",
+    )
+    group.add_argument(
+        "--mmap-warmup-method",
+        type=str,
+        default="read",
+        choices=["read", "madvise"],
+        help="Warm up by reading from parallel threads, or by madvise "
+        "(MADV_WILLNEED) letting the kernel read ahead in the background.",
+    )
+    group.add_argument(
+        "--mmap-warmup-threads",
+        type=int,
+        default=8,
+        help="Number of threads reading the external dataset at warmup.",
+    )
 
     return parser
 
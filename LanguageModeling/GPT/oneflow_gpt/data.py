@@ -1,3 +1,7 @@
+import time
+import queue
+import threading
+import numpy as np
 import oneflow as flow
 
 from oneflow_gpt import distribute
@@ -15,7 +19,10 @@ class GPTDataLoader(object):
         self.name = name
         args = get_args()
         assert args.dataset is not None
-        self.dataset = args.dataset
+        assert (
+            len(args.dataset) == 1
+        ), "blending datasets requires --use-external-dataset"
+        self.dataset = args.dataset[0]
         self.batch_size = args.global_batch_size // args.num_accumulation_steps
         self.seq_length = args.seq_length
         self.seed = args.seed
@@ -47,3 +54,143 @@ class GPTDataLoader(object):
             labels = flow.slice(x, begin=(None, 1), size=(None, self.seq_length))
 
         return data, labels
+
+
+class GPTBatchLoader(object):
+    r"""Assemble batches of an external GPT dataset on a background thread
+
+    Batches are gathered `prefetch` steps ahead of the training loop into a
+    pool of preallocated buffers, which are reused once the step consuming
+    them has finished (see `recycle_after`).
+
+    Args:
+        dataset: `GPTDataset` or any dataset providing `get_batch(indices, out)`
+        batch_size: `Int` number of samples per global batch
+        seq_length: `Int` sequence length
+        consumed_samples: `Int` number of samples already consumed by earlier
+            runs, the first batch starts right after them
+        num_batches: `Int` number of batches to assemble, `None` for unlimited
+        prefetch: `Int` max number of batches assembled ahead
+        num_buffers: `Int` size of buffer pool, default `2 * prefetch`
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        seq_length,
+        consumed_samples=0,
+        num_batches=None,
+        prefetch=2,
+        num_buffers=None,
+    ):
+        assert prefetch > 0
+        if num_buffers is None:
+            num_buffers = 2 * prefetch
+        assert num_buffers >= prefetch
+
+        self.dataset_ = dataset
+        self.batch_size_ = batch_size
+        self.consumed_samples_ = consumed_samples
+        self.max_batches_ = num_batches
+
+        self.buffers_ = [
+            np.empty((batch_size, seq_length + 1), dtype=np.int64)
+            for _ in range(num_buffers)
+        ]
+        self.buffer_ids_ = {id(buf): i for i, buf in enumerate(self.buffers_)}
+        self.free_ = queue.Queue()
+        for i in range(num_buffers):
+            self.free_.put(i)
+        self.ready_ = queue.Queue(maxsize=prefetch)
+
+        # stats
+        self.num_batches_ = 0
+        self.acc_wait_time_ = 0.0
+        self.last_wait_time_ = 0.0
+        self.acc_queue_depth_ = 0
+
+        self.stop_ = threading.Event()
+        self.thread_ = threading.Thread(target=self._worker, daemon=True)
+        self.thread_.start()
+
+    def _worker(self):
+        start = self.consumed_samples_
+        num_batches = 0
+        try:
+            while self.max_batches_ is None or num_batches < self.max_batches_:
+                buffer_id = self.free_.get()
+                if buffer_id is None or self.stop_.is_set():
+                    break
+
+                self.dataset_.get_batch(
+                    np.arange(start, start + self.batch_size_),
+                    out=self.buffers_[buffer_id],
+                )
+
+                self.ready_.put(buffer_id)
+                start += self.batch_size_
+                num_batches += 1
+        except Exception as e:
+            self.ready_.put(e)
+
+    def next(self):
+        """Return the next batch, blocking until it is assembled."""
+        depth = self.ready_.qsize()
+        start = time.perf_counter()
+        buffer_id = self.ready_.get()
+        self.last_wait_time_ = time.perf_counter() - start
+        self.acc_wait_time_ += self.last_wait_time_
+        self.acc_queue_depth_ += depth
+        self.num_batches_ += 1
+
+        if isinstance(buffer_id, Exception):
+            raise buffer_id
+
+        self.consumed_samples_ += self.batch_size_
+        return self.buffers_[buffer_id]
+
+    def recycle(self, batch):
+        """Give the buffer of a batch returned by `next` back to the pool."""
+        self.free_.put(self.buffer_ids_[id(batch)])
+
+    def recycle_after(self, callback, batch):
+        """Wrap a job callback so that the buffer of `batch` is recycled once
+        the job consuming it has finished."""
+
+        def wrapped_callback(outputs):
+            self.recycle(batch)
+            callback(outputs)
+
+        return wrapped_callback
+
+    @property
+    def consumed_samples(self):
+        return self.consumed_samples_
+
+    def state_dict(self):
+        """Position in the dataset, saved along with snapshots so that a
+        resumed job continues with the next unconsumed sample."""
+        return {"consumed_samples": self.consumed_samples_}
+
+    @property
+    def avg_wait_time(self):
+        """Average seconds the training loop waited for a batch."""
+        return self.acc_wait_time_ / max(self.num_batches_, 1)
+
+    @property
+    def last_wait_time(self):
+        """Seconds the training loop waited for the last batch."""
+        return self.last_wait_time_
+
+    @property
+    def avg_queue_depth(self):
+        """Average number of ready batches when the training loop asked for one."""
+        return self.acc_queue_depth_ / max(self.num_batches_, 1)
+
+    def close(self):
+        self.stop_.set()
+        self.free_.put(None)
+        while not self.ready_.empty():
+            self.ready_.get_nowait()
+        self.thread_.join()
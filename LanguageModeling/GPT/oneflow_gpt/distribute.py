@@ -220,6 +220,11 @@ def _infer_split_axis(x):
 
 
 def forward_p2b_parallel_cast(x):
+    dist_util = get_dist_util()
+    if dist_util.is_non_parallel():
+        # no need to cast, identity
+        return x
+
     split_axis = _infer_split_axis(x)
     if split_axis < 0:
         raise RuntimeError("can't infer split axis")
@@ -227,7 +232,6 @@ def forward_p2b_parallel_cast(x):
     sbps = [f"S({split_axis})", "B"]
     parallel_dist = _gen_parallel_dist_by_2d_sbp(sbps)
 
-    dist_util = get_dist_util()
     if dist_util.is_hybrid_parallel() or dist_util.is_model_parallel():
         # forward: [S(0), P] cast to [S(0), B], allreduce
         # backward: [S(0), B] cast to [S(0), B], identity
@@ -242,9 +246,6 @@ def forward_p2b_parallel_cast(x):
     elif dist_util.is_data_parallel():
         # parallel cast: S(0) -> S(0), identity
         pass
-    elif dist_util.is_non_parallel():
-        # no need to cast, identity
-        pass
     else:
         raise NotImplementedError
 
@@ -252,6 +253,11 @@ def forward_p2b_parallel_cast(x):
 
 
 def backward_p2b_parallel_cast(x):
+    dist_util = get_dist_util()
+    if dist_util.is_non_parallel():
+        # no need to cast, identity
+        return x
+
     split_axis = _infer_split_axis(x)
     if split_axis < 0:
         raise RuntimeError("can't infer split axis")
@@ -259,7 +265,6 @@ def backward_p2b_parallel_cast(x):
     sbps = [f"S({split_axis})", "B"]
     parallel_dist = _gen_parallel_dist_by_2d_sbp(sbps)
 
-    dist_util = get_dist_util()
     if dist_util.is_hybrid_parallel():
         # forward: [S(0), B] cast to [S(0), B], identity
         # backward: [S(0), P] cast to [S(0), B], for layernorm grad not supporting P, cast from P to B
@@ -275,9 +280,6 @@ def backward_p2b_parallel_cast(x):
     elif dist_util.is_model_parallel():
         # auto cast by choicing P -> B or P -> S(0), according to order value it should be former
         pass
-    elif dist_util.is_non_parallel():
-        # no need to cast, identity
-        pass
     else:
         raise NotImplementedError
 
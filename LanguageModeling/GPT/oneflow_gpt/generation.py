@@ -0,0 +1,298 @@
+import time
+import numpy as np
+import oneflow as flow
+
+from oneflow_gpt import distribute
+from oneflow_gpt.config import get_args
+from oneflow_gpt.model import Embedding, Transformer
+
+# additive attention bias of the masked positions
+_MASK_VALUE = -10000.0
+
+
+def sample_logits(
+    logits, greedy=False, top_k=0, top_p=0.0, temperature=1.0, rng=np.random
+):
+    """Sample the next token of every row of `logits` [batch, vocab] on host.
+
+    Greedy picks the argmax, otherwise the logits scaled by `temperature` are
+    restricted to the `top_k` largest and to the smallest set whose
+    probability reaches `top_p` (either filter is off when 0), and a token is
+    drawn from the softmax of the rest.
+    """
+    if greedy:
+        return np.argmax(logits, axis=-1)
+
+    logits = logits.astype(np.float32) / temperature
+    if 0 < top_k < logits.shape[-1]:
+        kth = np.partition(logits, -top_k, axis=-1)[:, -top_k, None]
+        logits = np.where(logits < kth, -np.inf, logits)
+
+    if top_p > 0.0:
+        order = np.argsort(-logits, axis=-1)
+        sorted_logits = np.take_along_axis(logits, order, axis=-1)
+        sorted_probs = np.exp(sorted_logits - sorted_logits[:, :1])
+        sorted_probs /= sorted_probs.sum(axis=-1, keepdims=True)
+        # drop tokens once the more probable ones reach top_p, keep the first
+        cum_probs = np.cumsum(sorted_probs, axis=-1)
+        remove = cum_probs - sorted_probs >= top_p
+        np.put_along_axis(
+            logits, order, np.where(remove, -np.inf, sorted_logits), axis=-1
+        )
+
+    probs = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    cum_probs = np.cumsum(probs, axis=-1)
+    u = rng.random_sample(logits.shape[0]) * cum_probs[:, -1]
+    return np.minimum(
+        (cum_probs <= u[:, None]).sum(axis=-1), logits.shape[-1] - 1
+    ).astype(np.int64)
+
+
+class _KVCache(object):
+    """Keys and values of every attention layer, kept on device in `k_cache`
+    and `v_cache` variables of the layer, [cache_length, b, n, h] each.
+
+    `update` writes the keys and values of the input positions to the cache
+    rows `indices` [s, 1] and returns those the positions attend to, the whole
+    cache when `attend_cache` else the input keys and values only.
+    """
+
+    def __init__(self, cache_length, indices, attention_bias, attend_cache):
+        self.cache_length = cache_length
+        self.indices = indices
+        self.attention_bias = attention_bias
+        self.attend_cache = attend_cache
+
+    def update(self, k, v):
+        outputs = []
+        for name, x in (("k_cache", k), ("v_cache", v)):
+            batch_size, num_heads, _, head_size = x.shape
+            cache = flow.get_variable(
+                name,
+                shape=(self.cache_length, batch_size, num_heads, head_size),
+                dtype=x.dtype,
+                initializer=flow.constant_initializer(0.0),
+                trainable=False,
+            )
+            # (b, n, s, h) -> (s, b, n, h), one cache row per position
+            new_cache = flow.tensor_scatter_nd_update(
+                cache, self.indices, flow.transpose(x, [2, 0, 1, 3])
+            )
+            flow.assign(cache, new_cache)
+            if self.attend_cache:
+                # (t, b, n, h) -> (b, n, t, h)
+                x = flow.transpose(new_cache, [1, 2, 0, 3])
+            outputs.append(x)
+        return outputs
+
+
+class Generator(object):
+    r"""Batched incremental decoding of `GPTModel` with key/value caches
+
+    The prompts, left padded to `prompt_length`, run once through a prefill
+    function which writes the keys and values of every layer to the caches.
+    Every decode step then feeds one token per sample with its position,
+    writes its keys and values to the next cache row and attends to the whole
+    cache with a mask of its filled rows, so the decode function has one
+    shape and is compiled once.
+
+    The caches are variables of the attention layers sized for
+    `prompt_length + max_new_tokens - 1` positions and stay on device, only
+    the tokens, positions and masks are fed and only the logits of the last
+    position are fetched. Both functions run the layers of `GPTModel(name)`
+    on `device` and share its variables, so a checkpoint of the model is
+    loaded as usual.
+
+    Only a single device is supported.
+
+    Args:
+        name: `String` namespace of the model variables
+        batch_size: `Int` number of prompts decoded together
+        prompt_length: `Int` length the prompts are left padded to
+        max_new_tokens: `Int` max number of tokens generated per prompt
+        device: `String` "gpu" or "cpu"
+    """
+
+    def __init__(self, name, batch_size, prompt_length, max_new_tokens, device="gpu"):
+        args = get_args()
+        assert max_new_tokens > 0
+        assert prompt_length + max_new_tokens <= args.seq_length, (
+            f"prompt_length {prompt_length} + max_new_tokens {max_new_tokens}"
+            f" must not exceed seq_length {args.seq_length}"
+        )
+        assert distribute.get_dist_util().is_non_parallel(), (
+            "generation supports a single device only"
+        )
+        assert not args.multihead_attention_fusion, (
+            "generation does not support multihead_attention_fusion"
+        )
+
+        self.name_ = name
+        self.batch_size_ = batch_size
+        self.prompt_length_ = prompt_length
+        self.max_new_tokens_ = max_new_tokens
+        self.device_ = device
+        self.hidden_size_ = args.hidden_size
+        # cache rows of the prompt and of every fed generated token
+        self.cache_length_ = prompt_length + max_new_tokens - 1
+
+        self.embedding_ = Embedding(
+            batch_size, args.seq_length, args.hidden_size, args.padded_vocab_size
+        )
+        self.prefill_ = self._make_prefill_func()
+        self.decode_ = self._make_decode_func()
+
+    def _forward(self, transformer, tokens, position_ids, kv_cache):
+        """Logits of the last position [b, vocab]."""
+        batch_size, length = tokens.shape
+
+        with flow.scope.namespace(self.name_):
+            with distribute.layer_placement_scope(0, self.device_):
+                wpe, wte = self.embedding_.get_params()
+                h = flow.gather(wte, tokens) + flow.gather(wpe, position_ids)
+
+            h = transformer(h, kv_cache, self.device_)
+
+            with distribute.layer_placement_scope(-1, self.device_):
+                # (b, s, H) -> (b, H) of the last position
+                h = flow.slice(h, begin=[None, length - 1, None], size=[None, 1, None])
+                h = flow.reshape(h, (batch_size, self.hidden_size_))
+                logits = flow.matmul(h, wte, transpose_b=True)
+
+        return logits
+
+    def _make_prefill_func(self):
+        b, s = self.batch_size_, self.prompt_length_
+        transformer = Transformer(b, s, self.hidden_size_)
+
+        @flow.global_function("predict", flow.function_config())
+        def prefill(
+            tokens: flow.typing.Numpy.Placeholder((b, s), dtype=flow.int64),
+            position_ids: flow.typing.Numpy.Placeholder((b, s), dtype=flow.int64),
+            attention_bias: flow.typing.Numpy.Placeholder(
+                (b, 1, s, s), dtype=flow.float32
+            ),
+            cache_indices: flow.typing.Numpy.Placeholder((s, 1), dtype=flow.int64),
+        ):
+            kv_cache = _KVCache(
+                self.cache_length_, cache_indices, attention_bias, attend_cache=False
+            )
+            logits = self._forward(transformer, tokens, position_ids, kv_cache)
+            return {"logits": logits}
+
+        return prefill
+
+    def _make_decode_func(self):
+        b, t = self.batch_size_, self.cache_length_
+        transformer = Transformer(b, 1, self.hidden_size_)
+
+        @flow.global_function("predict", flow.function_config())
+        def decode(
+            tokens: flow.typing.Numpy.Placeholder((b, 1), dtype=flow.int64),
+            position_ids: flow.typing.Numpy.Placeholder((b, 1), dtype=flow.int64),
+            attention_bias: flow.typing.Numpy.Placeholder(
+                (b, 1, 1, t), dtype=flow.float32
+            ),
+            cache_indices: flow.typing.Numpy.Placeholder((1, 1), dtype=flow.int64),
+        ):
+            kv_cache = _KVCache(t, cache_indices, attention_bias, attend_cache=True)
+            logits = self._forward(transformer, tokens, position_ids, kv_cache)
+            return {"logits": logits}
+
+        return decode
+
+    def generate(
+        self,
+        prompts,
+        eod=None,
+        vocab_size=None,
+        greedy=False,
+        top_k=0,
+        top_p=0.0,
+        temperature=1.0,
+        rng=np.random,
+    ):
+        """Generate up to `max_new_tokens` tokens for each of at most
+        `batch_size` prompts (lists of token ids), stopping a prompt at `eod`.
+
+        Returns the generated tokens of every prompt, without `eod`, and a dict
+        of timings: `time_to_first_token` and `elapsed` in seconds,
+        `num_tokens` generated and `tokens_per_sec`.
+        """
+        b, s = self.batch_size_, self.prompt_length_
+        assert 0 < len(prompts) <= b
+        lengths = np.ones(b, dtype=np.int64)
+        lengths[: len(prompts)] = [len(prompt) for prompt in prompts]
+        assert np.all((lengths > 0) & (lengths <= s)), "prompt length out of range"
+
+        # left pad so the last prompt tokens are aligned, rows past the
+        # prompts are dummy single token prompts
+        pad = s - lengths
+        tokens = np.zeros((b, s), dtype=np.int64)
+        for i, prompt in enumerate(prompts):
+            tokens[i, pad[i] :] = prompt
+        cols = np.arange(s)
+        position_ids = np.maximum(cols[None, :] - pad[:, None], 0)
+        # padded positions attend to themselves only
+        past_valid = np.zeros((b, self.cache_length_), dtype=np.bool_)
+        past_valid[:, :s] = cols[None, :] >= pad[:, None]
+        allowed = (cols[None, :] <= cols[:, None])[None] & past_valid[:, None, :s]
+        allowed |= np.eye(s, dtype=np.bool_)[None]
+        bias = np.where(allowed[:, None], 0.0, _MASK_VALUE).astype(np.float32)
+
+        def next_tokens(logits):
+            if vocab_size is not None:
+                # padded vocab entries
+                logits[:, vocab_size:] = -np.inf
+            return sample_logits(logits, greedy, top_k, top_p, temperature, rng)
+
+        start_time = time.perf_counter()
+        outputs = self.prefill_(
+            tokens, position_ids, bias, cols[:, None].astype(np.int64)
+        ).get()
+
+        generated = np.zeros((b, self.max_new_tokens_), dtype=np.int64)
+        generated[:, 0] = next_tokens(outputs["logits"].numpy())
+        time_to_first_token = time.perf_counter() - start_time
+
+        done = np.zeros(b, dtype=np.bool_)
+        done[len(prompts) :] = True
+        num_new = np.ones(b, dtype=np.int64)
+        if eod is not None:
+            done |= generated[:, 0] == eod
+
+        for step in range(1, self.max_new_tokens_):
+            if done.all():
+                break
+            # cache row the fed token is written to
+            col = s + step - 1
+            past_valid[:, col] = True
+            bias = np.where(past_valid, 0.0, _MASK_VALUE).astype(np.float32)
+            outputs = self.decode_(
+                generated[:, step - 1 : step],
+                (col - pad)[:, None],
+                bias[:, None, None, :],
+                np.array([[col]], dtype=np.int64),
+            ).get()
+
+            generated[:, step] = next_tokens(outputs["logits"].numpy())
+            num_new += ~done
+            if eod is not None:
+                done |= generated[:, step] == eod
+
+        elapsed = time.perf_counter() - start_time
+        results = []
+        for i in range(len(prompts)):
+            new_tokens = generated[i, : num_new[i]].tolist()
+            if eod is not None and new_tokens and new_tokens[-1] == eod:
+                new_tokens.pop()
+            results.append(new_tokens)
+
+        num_tokens = int(num_new[: len(prompts)].sum())
+        stats = {
+            "time_to_first_token": time_to_first_token,
+            "elapsed": elapsed,
+            "num_tokens": num_tokens,
+            "tokens_per_sec": num_tokens / elapsed,
+        }
+        return results, stats
@@ -108,18 +108,7 @@ class Embedding(object):
         assert tokens.shape[1] == self.seq_length
 
         with distribute.layer_placement_scope(0):
-            wpe = flow.get_variable(
-                "wpe",
-                shape=(self.seq_length, self.hidden_size),
-                initializer=self.wpe_initializer,
-                parallel_distribution=distribute.get_wpe_parallel_dist(),
-            )
-            wte = flow.get_variable(
-                "wte",
-                shape=(self.vocab_size, self.hidden_size),
-                initializer=self.wte_initializer,
-                parallel_distribution=distribute.get_wte_parallel_dist(),
-            )
+            wpe, wte = self.get_params()
 
             # 2d sbp sig: [B, S(0)] x [S(0), B] -> [S(0), P] -> [S(0), B]
             # grad 2d sbp sig: [S(0), B](dy) x [S(0), B](index) x [B, S(0)](x)
@@ -137,6 +126,21 @@ class Embedding(object):
 
         return h, wte
 
+    def get_params(self):
+        wpe = flow.get_variable(
+            "wpe",
+            shape=(self.seq_length, self.hidden_size),
+            initializer=self.wpe_initializer,
+            parallel_distribution=distribute.get_wpe_parallel_dist(),
+        )
+        wte = flow.get_variable(
+            "wte",
+            shape=(self.vocab_size, self.hidden_size),
+            initializer=self.wte_initializer,
+            parallel_distribution=distribute.get_wte_parallel_dist(),
+        )
+        return wpe, wte
+
 
 class Transformer(object):
     def __init__(self, batch_size, seq_length, hidden_size):
@@ -165,30 +169,34 @@ class Transformer(object):
                 )
             )
 
-    def __call__(self, hidden_states):
+    def __call__(self, hidden_states, kv_cache=None, device="gpu"):
         """
         hidden_states shape: (batch_size, seq_length, hidden_size)
         data parallel sbp: S(0)
         2d sbp: [S(0), B]
+        kv_cache: keys and values of the attention layers kept across calls,
+            see SelfAttention
+        device: device type the layers are placed on
         """
         assert len(hidden_states.shape) == 3
         assert hidden_states.shape[0] == self.batch_size
         assert hidden_states.shape[1] == self.seq_length
         assert hidden_states.shape[2] == self.hidden_size
+        assert kv_cache is None or not self.multihead_attention_fusion
 
         if self.multihead_attention_fusion:
-            with distribute.layer_placement_scope(0):
+            with distribute.layer_placement_scope(0, device):
                 # [b, s, H] -> [s, b, H] for multihead_attention_fusion
                 h = flow.transpose(hidden_states, [1, 0, 2])
         else:
             h = hidden_states
 
         for i in range(self.num_layers):
-            with distribute.layer_placement_scope(i):
-                h = self.layers[i](h)
+            with distribute.layer_placement_scope(i, device):
+                h = self.layers[i](h, kv_cache)
 
         # final layernorm
-        with distribute.layer_placement_scope(-1):
+        with distribute.layer_placement_scope(-1, device):
             h = layernorm("layernorm_f", h)
 
         return h
@@ -233,7 +241,7 @@ class TransformerLayer(object):
 
         self.checkpoint_activations = args.checkpoint_activations
 
-    def __call__(self, hidden_states):
+    def __call__(self, hidden_states, kv_cache=None):
         """
         hidden_states shape: (batch_size, seq_length, hidden_size)
         data parallel sbp: S(0)
@@ -255,7 +263,7 @@ class TransformerLayer(object):
                 # input layernorm
                 norm1 = layernorm("layernorm_1", h)
                 # attention
-                h = h + self.attn(norm1)
+                h = h + self.attn(norm1, kv_cache)
                 # output layernorm
                 norm2 = layernorm("layernorm_2", h)
                 # mlp
@@ -316,10 +324,10 @@ class SelfAttention(object):
             self.num_heads,
             3 * self.head_size,
         )
-        if h.shape[0] == self.seq_length and h.shape[1] == self.batch_size:
-            perm = [1, 2, 0, 3]
-        elif h.shape[0] == self.batch_size and h.shape[1] == self.seq_length:
+        if h.shape[0] == self.batch_size and h.shape[1] == self.seq_length:
             perm = [0, 2, 1, 3]
+        elif h.shape[0] == self.seq_length and h.shape[1] == self.batch_size:
+            perm = [1, 2, 0, 3]
         else:
             raise ValueError
 
@@ -359,6 +367,24 @@ class SelfAttention(object):
         # 2d sbp sig: [S(0), S(1)] x [S(0), S(1)] -> [S(0), S(1)]
         return flow.matmul(qmk, v)
 
+    def cached_multihead_attn(self, q, k, v, attention_bias):
+        """
+        q shape: (batch_size, num_attn_heads, seq_length, head_size)
+        k, v shape: (batch_size, num_attn_heads, kv_length, head_size)
+        attention_bias shape: (batch_size, 1, seq_length, kv_length), added to
+            the scores in place of the causal mask
+        """
+        assert all(len(x.shape) == 4 for x in (q, k, v))
+        assert k.shape[2] == v.shape[2] == attention_bias.shape[-1]
+
+        # shape sig: (b, n, s, h) x (b, n, t, h)(transposed) -> (b, n, s, t)
+        qmk = flow.matmul(q, k, transpose_b=True, alpha=(1.0 / self.norm_factor))
+        if self.coeff != 1.0:
+            qmk = qmk * self.coeff
+        qmk = flow.nn.softmax(qmk + attention_bias, axis=-1)
+        # shape sig: (b, n, s, t) x (b, n, t, h) -> (b, n, s, h)
+        return flow.matmul(qmk, v)
+
     def tril_softmax_dropout(self, x):
         if self.scale_tril_softmax_dropout_fusion:
             x = flow.math.fused_scale_tril_softmax_dropout(
@@ -389,11 +415,14 @@ class SelfAttention(object):
         qmk = self.tril_softmax_dropout(qmk)
         return flow.matmul(qmk, v)
 
-    def __call__(self, hidden_states):
+    def __call__(self, hidden_states, kv_cache=None):
         # hidden_states shape: (batch_size, seq_length, hidden_size)
         # or (seq_length, batch_size, hidden_size) [seq_len dim leading]
         # data parallel sbp: S(0)
         # 2d sbp: [S(0), B]
+        # kv_cache: keeps the keys and values of the previous calls, its
+        # update(k, v) returns the keys and values to attend to and its
+        # attention_bias masks them, see oneflow_gpt.generation
         assert len(hidden_states.shape) == 3
         assert hidden_states.shape[-1] == self.hidden_size
         if (
@@ -414,7 +443,11 @@ class SelfAttention(object):
             h = col_parallel_linear(
                 "c_attn", h, self.hidden_size * 3, weight_initializer=self.initializer,
             )
-            if self.multihead_attention_fusion:
+            if kv_cache is not None:
+                q, k, v = self.query_key_value(h)
+                k, v = kv_cache.update(k, v)
+                h = self.cached_multihead_attn(q, k, v, kv_cache.attention_bias)
+            elif self.multihead_attention_fusion:
                 h = self.fused_multihead_attn(h)
             else:
                 q, k, v = self.query_key_value(h)
@@ -1,10 +1,133 @@
 import os
 import re
 import glob
+import json
+import time
+import shutil
 import operator
+import threading
+import numpy as np
 import oneflow as flow
 
 
+_DATA_STATE_FILENAME = "data_state.json"
+_MANIFEST_FILENAME = "manifest.json"
+# list of the snapshots of a save dir and the latest one
+_LATEST_FILENAME = "latest.json"
+
+# names of the variable files of the checkpoint format of flow.checkpoint.save
+_VARIABLE_DATA_FILENAME = "out"
+_VARIABLE_META_FILENAME = "meta"
+_SNAPSHOT_DONE_FILENAME = "snapshot_done"
+_META_DATA_TYPES = {
+    np.dtype(np.float32): "kFloat",
+    np.dtype(np.float64): "kDouble",
+    np.dtype(np.int8): "kInt8",
+    np.dtype(np.int32): "kInt32",
+    np.dtype(np.int64): "kInt64",
+    np.dtype(np.uint8): "kUInt8",
+    np.dtype(np.float16): "kFloat16",
+}
+
+
+def _check_data_types(variables):
+    """Raise ValueError if a variable of `variables`, a dict of variable name
+    to numpy array, has a data type the checkpoint format does not have."""
+    unsupported = {
+        name: str(value.dtype)
+        for name, value in variables.items()
+        if value.dtype not in _META_DATA_TYPES
+    }
+    if len(unsupported) > 0:
+        raise ValueError(f"variables of unsupported data types: {unsupported}")
+
+
+def _write_variables(path, variables):
+    """Write `variables`, a dict of variable name to numpy array, to `path`
+    the way flow.checkpoint.save does, so that the snapshot loads as usual.
+
+    flow.checkpoint.save only reads variable blobs, not host copies, so the
+    files are written here, tests/test_snapshot.py checks that they load back
+    with flow.checkpoint.get."""
+    _check_data_types(variables)
+    for name, value in variables.items():
+        var_dir = os.path.join(path, name)
+        os.makedirs(var_dir)
+        with open(os.path.join(var_dir, _VARIABLE_DATA_FILENAME), "wb") as f:
+            f.write(memoryview(np.ascontiguousarray(value)).cast("B"))
+        dims = "".join(f"  dim: {d}\n" for d in value.shape)
+        with open(os.path.join(var_dir, _VARIABLE_META_FILENAME), "w") as f:
+            f.write(
+                f"shape {{\n{dims}}}\ndata_type: {_META_DATA_TYPES[value.dtype]}\n"
+            )
+
+    with open(os.path.join(path, _SNAPSHOT_DONE_FILENAME), "w"):
+        pass
+
+
+def _write_manifest(path, name, write_time):
+    variables = {}
+    for var_name in sorted(os.listdir(path)):
+        data_file = os.path.join(path, var_name, _VARIABLE_DATA_FILENAME)
+        if os.path.isfile(data_file):
+            variables[var_name] = os.path.getsize(data_file)
+
+    manifest = {
+        "snapshot": name,
+        "variables": variables,
+        "total_bytes": sum(variables.values()),
+        "write_seconds": write_time,
+    }
+    with open(os.path.join(path, _MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def _read_latest(basedir):
+    latest_file = os.path.join(basedir, _LATEST_FILENAME)
+    if not os.path.isfile(latest_file):
+        return None
+
+    with open(latest_file, "r") as f:
+        return json.load(f)
+
+
+def _write_latest(basedir, snapshots, pending=None):
+    """Write the latest manifest of `basedir`. `pending` names a snapshot
+    about to be renamed into place, it is loaded if complete although not
+    listed, so that a kill before the next update of the manifest loses
+    nothing."""
+    latest = {"latest": None, "iter": None, "snapshots": snapshots}
+    if len(snapshots) > 0:
+        snapshot = max(snapshots, key=operator.itemgetter("iter"))
+        latest.update(latest=snapshot["name"], iter=snapshot["iter"])
+    if pending is not None:
+        latest["pending"] = pending
+
+    tmp_file = os.path.join(basedir, f".{_LATEST_FILENAME}.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(latest, f, indent=2)
+    os.replace(tmp_file, os.path.join(basedir, _LATEST_FILENAME))
+
+
+def _select_retained(snapshots, keep_last=0, keep_interval=0, keep_best=0):
+    """Names of the snapshots kept by the retention policy: the last
+    `keep_last`, those whose iteration is a multiple of `keep_interval` and
+    the `keep_best` with the lowest metric. The latest is always kept, all
+    are kept when no rule is set."""
+    if keep_last <= 0 and keep_interval <= 0 and keep_best <= 0:
+        return set(s["name"] for s in snapshots)
+
+    by_iter = sorted(snapshots, key=operator.itemgetter("iter"))
+    keep = set(s["name"] for s in by_iter[-max(keep_last, 1) :])
+    if keep_interval > 0:
+        keep.update(s["name"] for s in by_iter if s["iter"] % keep_interval == 0)
+    if keep_best > 0:
+        scored = [s for s in by_iter if s.get("metric") is not None]
+        scored.sort(key=operator.itemgetter("metric"))
+        keep.update(s["name"] for s in scored[:keep_best])
+    return keep
+
+
 class Snapshot(object):
     def __init__(
         self,
@@ -14,6 +137,10 @@ class Snapshot(object):
         total_iters=0,
         save_last=False,
         save_init=False,
+        save_async=False,
+        keep_last=0,
+        keep_interval=0,
+        keep_best=0,
     ):
         self.load_dir_ = load_dir
         self.save_dir_ = save_dir
@@ -21,15 +148,40 @@ class Snapshot(object):
         self.total_iters_ = total_iters
         self.save_last_ = save_last
         self.save_init_ = save_init
+        self.save_async_ = save_async
+        self.save_thread_ = None
+        self.save_error_ = None
+        self.keep_last_ = keep_last
+        self.keep_interval_ = keep_interval
+        self.keep_best_ = keep_best
         self.checkpoint_ = flow.train.CheckPoint()
+        self.data_state_ = None
+        self.data_state_fn_ = None
+        self.metric_fn_ = None
 
-        self.iter_, snapshot_dir = self._find_max_iter_snapshot_from_load_dir()
+        # latest manifests are read once, the snapshots are listed from them
+        load_latest = None if load_dir is None else _read_latest(load_dir)
+        if save_dir is None:
+            save_latest = None
+        elif load_dir is not None and os.path.abspath(load_dir) == os.path.abspath(
+            save_dir
+        ):
+            save_latest = load_latest
+        else:
+            save_latest = _read_latest(save_dir)
+
+        self.iter_, snapshot_dir = self._find_max_iter_snapshot_from_load_dir(
+            load_latest
+        )
         if snapshot_dir is None:
             self.checkpoint_.init()
         else:
             print(f"Loading model from {snapshot_dir}")
             self.checkpoint_.load(snapshot_dir)
+            self.data_state_ = self._load_data_state(snapshot_dir)
 
+        # snapshots of save dir, dicts of name, iter and metric
+        self.snapshots_ = self._collect_snapshots(self.save_dir_, save_latest)
         self._check_save_dir_snapshot_existence(self.iter_)
 
     def _extract_iter_from_snapshot_dirname(self, s):
@@ -38,18 +190,52 @@ class Snapshot(object):
         assert len(itr) > 0
         return itr[0]
 
-    def _collect_snapshot2iter(self, basedir):
+    def _collect_snapshots(self, basedir, latest):
+        """Snapshots of `basedir` as dicts of name, iter and metric, listed by
+        its latest manifest `latest`, or by scanning the dir when None."""
+        if basedir is None:
+            return []
+
+        if latest is not None:
+            # no need to scan the dir
+            snapshots = list(latest["snapshots"])
+            pending = latest.get("pending")
+            if (
+                pending is not None
+                and all(s["name"] != pending for s in snapshots)
+                and os.path.isfile(
+                    os.path.join(basedir, pending, _SNAPSHOT_DONE_FILENAME)
+                )
+            ):
+                # renamed by a save killed before the manifest was updated
+                print(f"WARNING: snapshot {pending} is missing from {_LATEST_FILENAME}")
+                snapshots.append(
+                    {
+                        "name": pending,
+                        "iter": self._extract_iter_from_snapshot_dirname(pending),
+                        "metric": None,
+                    }
+                )
+            return snapshots
+
         snapshot_dirs = glob.glob(f"{basedir}/iter*_snapshot")
-        snapshot2iter = dict()
+        snapshots = []
         for s_dir in snapshot_dirs:
             assert os.path.isdir(s_dir)
             s = os.path.basename(s_dir)
-            snapshot2iter[s_dir] = self._extract_iter_from_snapshot_dirname(s)
-        return snapshot2iter
+            snapshots.append(
+                {
+                    "name": s,
+                    "iter": self._extract_iter_from_snapshot_dirname(s),
+                    "metric": None,
+                }
+            )
+        return snapshots
 
     def _check_save_dir_snapshot_existence(self, start_iter):
-        snapshot2iter = self._collect_snapshot2iter(self.save_dir_)
-        for s, i in snapshot2iter.items():
+        for snapshot in self.snapshots_:
+            s = os.path.join(self.save_dir_, snapshot["name"])
+            i = snapshot["iter"]
             if self.save_init_ and i == 0:
                 raise ValueError(f"{s} already exist")
 
@@ -64,21 +250,122 @@ class Snapshot(object):
             ):
                 raise ValueError(f"{s} already exist")
 
-    def _find_max_iter_snapshot_from_load_dir(self):
+    def _find_max_iter_snapshot_from_load_dir(self, latest):
         if self.load_dir_ is None:
             return 0, None
 
-        snapshot2iter = self._collect_snapshot2iter(self.load_dir_)
-        if len(snapshot2iter) == 0:
+        snapshots = self._collect_snapshots(self.load_dir_, latest)
+        if len(snapshots) > 0 and latest is not None:
+            s = max(snapshots, key=operator.itemgetter("iter"))["name"]
+            if not os.path.isdir(os.path.join(self.load_dir_, s)):
+                print(f"WARNING: latest snapshot {s} is missing, scanning {self.load_dir_}")
+                snapshots = self._collect_snapshots(self.load_dir_, None)
+
+        if len(snapshots) == 0:
             return 0, None
 
-        s, i = max(snapshot2iter.items(), key=operator.itemgetter(1))
-        return i, s
+        s = max(snapshots, key=operator.itemgetter("iter"))
+        return s["iter"], os.path.join(self.load_dir_, s["name"])
+
+    def _load_data_state(self, snapshot_dir):
+        data_state_file = os.path.join(snapshot_dir, _DATA_STATE_FILENAME)
+        if not os.path.isfile(data_state_file):
+            return None
+
+        with open(data_state_file, "r") as f:
+            return json.load(f)
 
     @property
     def iter(self):
         return self.iter_
 
+    @property
+    def data_state(self):
+        """Data loader state saved with the loaded snapshot, None if absent"""
+        return self.data_state_
+
+    def set_data_state_fn(self, data_state_fn):
+        """`data_state_fn` returns a json serializable dict of the data loader
+        state, it is saved with every snapshot and restored by `data_state`"""
+        self.data_state_fn_ = data_state_fn
+
+    def set_metric_fn(self, metric_fn):
+        """`metric_fn` returns a float, lower is better, or None. It is
+        recorded with every snapshot for the keep best retention rule."""
+        self.metric_fn_ = metric_fn
+
+    def _write_snapshot(self, name, write_fn, data_state):
+        """Write a snapshot into a temp dir with `write_fn(path)`, add the
+        data state and the manifest, then rename it to its final name."""
+        save_path = os.path.join(self.save_dir_, name)
+        tmp_path = os.path.join(self.save_dir_, f".{name}.tmp")
+        if os.path.exists(tmp_path):
+            # left by an interrupted save
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        start = time.perf_counter()
+        write_fn(tmp_path)
+        if data_state is not None:
+            with open(os.path.join(tmp_path, _DATA_STATE_FILENAME), "w") as f:
+                json.dump(data_state, f)
+        _write_manifest(tmp_path, name, time.perf_counter() - start)
+        _write_latest(self.save_dir_, self.snapshots_, pending=name)
+        os.rename(tmp_path, save_path)
+        return time.perf_counter() - start
+
+    def _save_in_background(self, name, variables, data_state, record):
+        write_time = self._write_snapshot(
+            name, lambda path: _write_variables(path, variables), data_state
+        )
+        removed = self._update_snapshots(record)
+        print(f"Saved model to {name} in {write_time:.3f}s on background")
+        self._remove_snapshots(removed)
+
+    def _update_snapshots(self, record):
+        """Add a saved snapshot and update the latest manifest, returns the
+        snapshots dropped by the retention policy."""
+        snapshots = [s for s in self.snapshots_ if s["name"] != record["name"]]
+        snapshots.append(record)
+        keep = _select_retained(
+            snapshots, self.keep_last_, self.keep_interval_, self.keep_best_
+        )
+        removed = [s for s in snapshots if s["name"] not in keep]
+        self.snapshots_ = [s for s in snapshots if s["name"] in keep]
+        _write_latest(self.save_dir_, self.snapshots_)
+        return removed
+
+    def _remove_snapshots(self, removed):
+        for snapshot in removed:
+            path = os.path.join(self.save_dir_, snapshot["name"])
+            if not os.path.isdir(path):
+                continue
+            # rename first so that a partly deleted snapshot is never loaded
+            trash_path = os.path.join(self.save_dir_, f".{snapshot['name']}.deleting")
+            os.rename(path, trash_path)
+            shutil.rmtree(trash_path)
+            print(f"Removed snapshot {path} by retention policy")
+
+    def _start_background(self, fn, *args):
+        def run():
+            try:
+                fn(*args)
+            except Exception as e:
+                self.save_error_ = e
+
+        self.save_thread_ = threading.Thread(target=run)
+        self.save_thread_.start()
+
+    def wait(self):
+        """Block until the background save, if any, has finished."""
+        if self.save_thread_ is not None:
+            self.save_thread_.join()
+            self.save_thread_ = None
+
+        if self.save_error_ is not None:
+            e, self.save_error_ = self.save_error_, None
+            raise e
+
     def save(self, name):
         if self.save_dir_ is None:
             return
@@ -87,9 +374,40 @@ class Snapshot(object):
         if os.path.exists(save_path):
             return
 
-        os.makedirs(save_path)
+        start = time.perf_counter()
+        # back-pressure, one save or retention pass runs on background at most,
+        # so at most one snapshot is held in host memory
+        self.wait()
+        wait_time = time.perf_counter() - start
+
         print(f"Saving model to {save_path}")
-        self.checkpoint_.save(save_path)
+        data_state = None if self.data_state_fn_ is None else self.data_state_fn_()
+        record = {
+            "name": name,
+            "iter": self.iter_,
+            "metric": None if self.metric_fn_ is None else self.metric_fn_(),
+        }
+        if self.save_async_:
+            variables = {
+                var_name: var.numpy()
+                for var_name, var in flow.get_all_variables().items()
+            }
+            # fail here rather than on the background thread
+            _check_data_types(variables)
+            self._start_background(
+                self._save_in_background, name, variables, data_state, record
+            )
+        else:
+            self._write_snapshot(name, self.checkpoint_.save, data_state)
+            # the manifest is updated right after the rename, only the
+            # deletion of old snapshots runs on background
+            removed = self._update_snapshots(record)
+            self._start_background(self._remove_snapshots, removed)
+
+        print(
+            f"Snapshot {name} stalled training {time.perf_counter() - start:.3f}s"
+            f" (waiting for the previous save {wait_time:.3f}s)"
+        )
 
     def step(self):
         if self.iter_ == 0 and self.save_init_:
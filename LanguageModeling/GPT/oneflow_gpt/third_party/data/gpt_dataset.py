@@ -15,8 +15,13 @@
 
 """GPT style dataset."""
 
+import contextlib
+import fcntl
+import hashlib
+import math
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
@@ -66,7 +71,74 @@ def build_train_valid_test_datasets(data_prefix, data_impl, splits_string,
                                                 train_valid_test_num_samples,
                                                 seq_length, seed, skip_warmup)
 
-    assert 0, 'Blending dataset is not supported!'
+    # Blending dataset.
+    # Parse the values.
+    prefixes, weights, datasets_train_valid_test_num_samples = \
+        get_datasets_weights_and_num_samples(data_prefix,
+                                             train_valid_test_num_samples)
+
+    # Build individual datasets.
+    train_datasets = []
+    valid_datasets = []
+    test_datasets = []
+    for i in range(len(prefixes)):
+        train_ds, valid_ds, test_ds = _build_train_valid_test_datasets(
+            prefixes[i], data_impl, splits_string,
+            datasets_train_valid_test_num_samples[i],
+            seq_length, seed, skip_warmup)
+        train_datasets.append(train_ds)
+        valid_datasets.append(valid_ds)
+        test_datasets.append(test_ds)
+
+    def build_blending_dataset(index, name, datasets):
+        # Datasets with an empty split do not take part in the blend.
+        blend = [(ds, w) for ds, w in zip(datasets, weights) if ds is not None]
+        if len(blend) == 0:
+            return None
+        datasets_, weights_ = zip(*blend)
+        return BlendableDataset(name, prefixes, datasets_, weights_,
+                                train_valid_test_num_samples[index])
+
+    blending_train_dataset = build_blending_dataset(0, 'train', train_datasets)
+    blending_valid_dataset = build_blending_dataset(1, 'valid', valid_datasets)
+    blending_test_dataset = build_blending_dataset(2, 'test', test_datasets)
+
+    return (blending_train_dataset, blending_valid_dataset,
+            blending_test_dataset)
+
+
+def get_datasets_weights_and_num_samples(data_prefix,
+                                         train_valid_test_num_samples):
+    """Parse `weight1 prefix1 weight2 prefix2 ...` into prefixes, normalized
+    weights and the number of samples each dataset has to provide."""
+
+    # The data prefix should be in the format of:
+    #   weight-1, data-prefix-1, weight-2, data-prefix-2, ..
+    assert len(data_prefix) % 2 == 0
+    num_datasets = len(data_prefix) // 2
+    weights = [0] * num_datasets
+    prefixes = [0] * num_datasets
+    for i in range(num_datasets):
+        weights[i] = float(data_prefix[2 * i])
+        prefixes[i] = (data_prefix[2 * i + 1]).strip()
+    # Normalize weights
+    weight_sum = 0.0
+    for weight in weights:
+        weight_sum += weight
+    assert weight_sum > 0.0
+    weights = [weight / weight_sum for weight in weights]
+
+    # Add 0.5% (the 1.005 factor) so in case the bleding dataset does
+    # not uniformly distribute the number of samples, we still have
+    # samples left to feed to the network, plus one sample per dataset
+    # for the rounding of the blending order.
+    datasets_train_valid_test_num_samples = []
+    for weight in weights:
+        datasets_train_valid_test_num_samples.append(
+            [int(math.ceil(val * weight * 1.005)) + num_datasets
+             for val in train_valid_test_num_samples])
+
+    return prefixes, weights, datasets_train_valid_test_num_samples
 
 
 def _build_train_valid_test_datasets(data_prefix, data_impl, splits_string,
@@ -136,6 +208,7 @@ class GPTDataset():
 
         self.name = name
         self.indexed_dataset = indexed_dataset
+        self.seq_length = seq_length
 
         # Checks
         assert np.min(documents) >= 0
@@ -179,6 +252,197 @@ class GPTDataset():
 
         return np.array(sample, dtype=np.int64)
 
+    def get_batch(self, indices, out=None):
+        """Gather the samples at `indices` into `out`, an int64 array of shape
+        [len(indices), seq_length + 1]. Tokens are copied straight from the
+        indexed dataset buffer into `out`, without per-sample arrays."""
+        if out is None:
+            out = np.empty((len(indices), self.seq_length + 1), dtype=np.int64)
+        assert out.shape == (len(indices), self.seq_length + 1)
+        assert out.dtype == np.int64 and out.flags.c_contiguous
+
+        docs, offsets, lengths = self._sample_pieces(indices)
+        self.indexed_dataset.get_ranges(docs, offsets, lengths,
+                                        out.reshape(-1))
+        return out
+
+    def warmup(self, indices=None, method='read', num_threads=8):
+        """Page in the documents the samples at `indices` are made of, or the
+        whole indexed dataset when indices is None."""
+        if indices is None:
+            self.indexed_dataset.warmup(method=method, num_threads=num_threads)
+            return
+
+        start_time = time.time()
+        touched = np.zeros(self.indexed_dataset.sizes.shape[0], dtype=np.bool_)
+        chunk_size = 1 << 20
+        for start in range(0, len(indices), chunk_size):
+            docs, _, _ = self._sample_pieces(indices[start:start + chunk_size])
+            touched[docs] = True
+        documents = np.nonzero(touched)[0]
+        print(' > {} samples of {} touch {} of {} documents, found in {:4f} '
+              'seconds'.format(len(indices), self.name, documents.size,
+                               touched.size, time.time() - start_time))
+        self.indexed_dataset.warmup(documents, method=method,
+                                    num_threads=num_threads)
+
+    def _sample_pieces(self, indices):
+        """Indexed dataset items, offsets and lengths the samples at `indices`
+        are made of, in order."""
+        # Get the shuffled indices.
+        idx = np.asarray(self.shuffle_idx[indices], dtype=np.int64)
+        # Start and end documents and offsets.
+        doc_index_f = self.sample_idx[idx, 0].astype(np.int64)
+        doc_index_l = self.sample_idx[idx + 1, 0].astype(np.int64)
+        offset_f = self.sample_idx[idx, 1]
+        offset_l = self.sample_idx[idx + 1, 1]
+
+        # Every sample is made of the documents [doc_index_f, doc_index_l]
+        # of doc_idx, list them all in order.
+        num_docs = doc_index_l - doc_index_f + 1
+        last = np.cumsum(num_docs) - 1
+        first = last - num_docs + 1
+        doc_index = np.repeat(doc_index_f - first, num_docs)
+        doc_index += np.arange(doc_index.size, dtype=np.int64)
+        docs = self.doc_idx[doc_index]
+
+        # Entire in between documents, the relevant portion of last document
+        # and the rest of the initial document.
+        offsets = np.zeros(docs.size, dtype=np.int64)
+        lengths = self.indexed_dataset.sizes[docs].astype(np.int64)
+        lengths[last] = offset_l + 1
+        offsets[first] = offset_f
+        lengths[first] -= offset_f
+        return docs, offsets, lengths
+
+
+class BlendableDataset():
+    """Weighted mixture of datasets. Sample i of the blend is sample
+    `dataset_sample_index[i]` of dataset `dataset_index[i]`, both indices are
+    built once and cached next to the first dataset."""
+
+    def __init__(self, name, data_prefixes, datasets, weights, num_samples):
+
+        self.name = name
+        self.datasets = datasets
+        self.seq_length = datasets[0].seq_length
+        self.size = num_samples
+        num_datasets = len(datasets)
+        assert num_datasets == len(weights)
+        assert num_datasets < 255
+
+        # Normalize weights.
+        weights = np.array(weights, dtype=np.float64)
+        sum_weights = np.sum(weights)
+        assert sum_weights > 0.0
+        weights /= sum_weights
+
+        self.dataset_index, self.dataset_sample_index = \
+            _build_blending_index_mappings(name, data_prefixes, weights,
+                                           num_samples)
+
+        # Every dataset has to be large enough for its share of the blend,
+        # samples of a dataset are taken in order so its share is its count.
+        counts = np.bincount(self.dataset_index, minlength=num_datasets)
+        for i, (dataset, count) in enumerate(zip(datasets, counts)):
+            print('    dataset {} weight {:.6f} samples {}'.format(
+                i, weights[i], count))
+            assert count <= len(dataset), \
+                'dataset {} has {} samples, blending needs {}'.format(
+                    i, len(dataset), count)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        dataset_idx = self.dataset_index[idx]
+        sample_idx = self.dataset_sample_index[idx]
+        return self.datasets[dataset_idx][sample_idx]
+
+    def get_batch(self, indices, out=None):
+        """Same as GPTDataset.get_batch, gathering every dataset's rows of the
+        batch with one call to its get_batch."""
+        if out is None:
+            out = np.empty((len(indices), self.seq_length + 1), dtype=np.int64)
+        assert out.shape == (len(indices), self.seq_length + 1)
+
+        dataset_index = self.dataset_index[indices]
+        dataset_sample_index = self.dataset_sample_index[indices]
+        for i, dataset in enumerate(self.datasets):
+            rows = np.nonzero(dataset_index == i)[0]
+            if rows.size > 0:
+                out[rows] = dataset.get_batch(dataset_sample_index[rows])
+
+        return out
+
+    def warmup(self, indices=None, method='read', num_threads=8):
+        """Same as GPTDataset.warmup, for every blended dataset."""
+        if indices is not None:
+            dataset_index = self.dataset_index[indices]
+            dataset_sample_index = self.dataset_sample_index[indices]
+        for i, dataset in enumerate(self.datasets):
+            if indices is None:
+                dataset.warmup(method=method, num_threads=num_threads)
+            else:
+                dataset.warmup(dataset_sample_index[dataset_index == i],
+                               method=method, num_threads=num_threads)
+
+
+def _build_blending_index_mappings(name, data_prefixes, weights, num_samples):
+    """Build or load the cached dataset-index and dataset-sample-index."""
+    # Filename of the index mappings, keyed by everything they depend on.
+    desc = '{}-{}-{}-{}'.format(name, ','.join(data_prefixes),
+                                ','.join(map(repr, weights.tolist())),
+                                num_samples)
+    _filename = os.path.join(os.path.dirname(data_prefixes[0]),
+                             '{}_blendmap_{}'.format(
+                                 name, hashlib.md5(desc.encode()).hexdigest()))
+    dataset_index_filename = _filename + '_dataset_index.npy'
+    dataset_sample_index_filename = _filename + '_dataset_sample_index.npy'
+
+    if not _index_mappings_exist(dataset_index_filename,
+                                 dataset_sample_index_filename):
+        with _index_mappings_lock(_filename + '.lock'):
+            if not _index_mappings_exist(dataset_index_filename,
+                                         dataset_sample_index_filename):
+                print(' > building blending indices for {} datasets with '
+                      'weights {} ...'.format(len(weights), weights.tolist()))
+                start_time = time.time()
+                dataset_index, dataset_sample_index = \
+                    _build_blending_indices(weights, num_samples)
+                _save_index_mapping(dataset_index_filename, dataset_index)
+                _save_index_mapping(dataset_sample_index_filename,
+                                    dataset_sample_index)
+                print(' > elapsed time to build and save blending indices '
+                      '(seconds): {:4f}'.format(time.time() - start_time))
+
+    print(' > loading blending indices from {}'.format(_filename))
+    dataset_index = np.load(dataset_index_filename, allow_pickle=True,
+                            mmap_mode='r')
+    dataset_sample_index = np.load(dataset_sample_index_filename,
+                                   allow_pickle=True, mmap_mode='r')
+
+    return dataset_index, dataset_sample_index
+
+
+def _build_blending_indices(weights, num_samples):
+    """The k-th sample of dataset d is due at (k + 0.5) / weights[d], taking
+    the samples of all datasets in order of due time spreads every dataset
+    evenly over the blend with the requested proportions."""
+    num_datasets = len(weights)
+    # Upper bound of the samples taken from every dataset.
+    sizes = np.ceil(weights * (num_samples + num_datasets)).astype(np.int64) + 1
+
+    dataset_index = np.repeat(np.arange(num_datasets, dtype=np.uint8), sizes)
+    dataset_sample_index = np.arange(dataset_index.size, dtype=np.int64)
+    dataset_sample_index -= np.repeat(np.cumsum(sizes) - sizes, sizes)
+    with np.errstate(divide='ignore'):
+        due = (dataset_sample_index + 0.5) / weights[dataset_index]
+    order = np.argsort(due, kind='stable')[:num_samples]
+    del due
+
+    return dataset_index[order], dataset_sample_index[order]
+
 
 def _build_index_mappings(name, data_prefix, documents, sizes,
                           num_samples, seq_length, seed):
@@ -204,86 +468,18 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
     sample_idx_filename = _filename + '_sample_idx.npy'
     shuffle_idx_filename = _filename + '_shuffle_idx.npy'
 
-    # Build the indexed mapping if not exist.
-    if (not os.path.isfile(doc_idx_filename)) or \
-        (not os.path.isfile(sample_idx_filename)) or \
-        (not os.path.isfile(shuffle_idx_filename)):
-
-        print(' > WARNING: could not find index map files, building '
-                        'the indices on rank 0 ...')
-
-        # For the last epoch, decide whether include the entire epoch
-        # in the global shuffle or not.
-
-        # If we need only one epoch, then separating last epoch  does
-        # not mean anything.
-        if num_epochs == 1:
-            separate_last_epoch = False
-            print(' > only one epoch required, setting '
-                    'separate_last_epoch to False', flush=True)
-
-        else:
-            # Get the number of samples for the last epoch
-            num_samples_from_epochs_minus_one = (
-                (num_epochs - 1) * tokens_per_epoch - 1) // seq_length
-            last_epoch_num_samples = num_samples - \
-                                        num_samples_from_epochs_minus_one
-            assert last_epoch_num_samples >= 0, \
-                'last epoch number of samples should be non-negative.'
-            num_samples_per_epoch = (tokens_per_epoch - 1) // seq_length
-            assert last_epoch_num_samples < (num_samples_per_epoch + 1), \
-                'last epoch number of samples exceeded max value.'
-            # If we have less than 80% of the samples for the last epoch,
-            # seperate out the epoch and treat it differently.
-            # Note: the 80% number is just based on common sense and can
-            # be adjusted if needed.
-            separate_last_epoch = (last_epoch_num_samples <
-                                    int(0.80 * num_samples_per_epoch))
-            if separate_last_epoch:
-                string = ' > last epoch number of samples ({}) is smaller '\
-                            'than 80% of number of samples per epoch ({}), '\
-                            'setting separate_last_epoch to True'
-            else:
-                string = ' > last epoch number of samples ({}) is larger '\
-                            'than 80% of number of samples per epoch ({}), '\
-                            'setting separate_last_epoch to False'
-            print(string.format(last_epoch_num_samples,
-                                num_samples_per_epoch), flush=True)
-
-        # doc-idx.
-        start_time = time.time()
-        doc_idx = _build_doc_idx(documents, num_epochs, np_rng,
-                                    separate_last_epoch)
-        np.save(doc_idx_filename, doc_idx, allow_pickle=True)
-        print(' > elasped time to build and save doc-idx mapping '
-                        '(seconds): {:4f}'.format(time.time() - start_time))
-        # sample-idx.
-        start_time = time.time()
-        # Use C++ implementation for speed.
-        # First compile and then import.
-        # from megatron.data import helpers
-        assert doc_idx.dtype == np.int32
-        assert sizes.dtype == np.int32
-        # sample_idx = helpers.build_sample_idx(sizes, doc_idx, seq_length,
-        #                                         num_epochs, tokens_per_epoch)
-        sample_idx = _build_sample_idx(sizes, doc_idx, seq_length,
-                                      num_epochs, tokens_per_epoch)
-        np.save(sample_idx_filename, sample_idx, allow_pickle=True)
-        print(' > elasped time to build and save sample-idx mapping '
-                        '(seconds): {:4f}'.format(time.time() - start_time))
-        # shuffle-idx.
-        start_time = time.time()
-        # -1 is due to data structure used to retieve the index:
-        #    sample i --> [sample_idx[i], sample_idx[i+1])
-        if separate_last_epoch:
-            num_samples_ = num_samples_from_epochs_minus_one
-        else:
-            num_samples_ = sample_idx.shape[0] - 1
-        shuffle_idx = _build_shuffle_idx(num_samples_,
-                                            sample_idx.shape[0] - 1, np_rng)
-        np.save(shuffle_idx_filename, shuffle_idx, allow_pickle=True)
-        print(' > elasped time to build and save shuffle-idx mapping'
-                        ' (seconds): {:4f}'.format(time.time() - start_time))
+    # Build the indexed mapping if not exist. Only one process builds the
+    # mappings, the others wait on the lock and then load the result.
+    if not _index_mappings_exist(doc_idx_filename, sample_idx_filename,
+                                 shuffle_idx_filename):
+        with _index_mappings_lock(_filename + '.lock'):
+            if not _index_mappings_exist(doc_idx_filename,
+                                         sample_idx_filename,
+                                         shuffle_idx_filename):
+                _build_and_save_index_mappings(
+                    documents, sizes, num_samples, seq_length, num_epochs,
+                    tokens_per_epoch, np_rng, doc_idx_filename,
+                    sample_idx_filename, shuffle_idx_filename)
 
     # Load mappings.
     start_time = time.time()
@@ -305,6 +501,127 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
     return doc_idx, sample_idx, shuffle_idx
 
 
+def _index_mappings_exist(*filenames):
+    return all(os.path.isfile(filename) for filename in filenames)
+
+
+@contextlib.contextmanager
+def _index_mappings_lock(lock_filename):
+    """Exclusive cross-process lock, released when the holder exits."""
+    with open(lock_filename, 'a') as f:
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+
+
+def _save_index_mapping(filename, array):
+    """Save to a temporary file and rename it, so that readers never see a
+    partially written mapping."""
+    tmp_filename = '{}.tmp{}'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        np.save(f, array, allow_pickle=True)
+    os.replace(tmp_filename, filename)
+
+
+def _build_and_save_sample_idx(sample_idx_filename, sizes, doc_idx,
+                               seq_length, num_epochs, tokens_per_epoch):
+    start_time = time.time()
+    sample_idx = _build_sample_idx(sizes, doc_idx, seq_length,
+                                   num_epochs, tokens_per_epoch)
+    _save_index_mapping(sample_idx_filename, sample_idx)
+    return time.time() - start_time
+
+
+def _build_and_save_shuffle_idx(shuffle_idx_filename, num_samples,
+                                total_size, np_rng):
+    start_time = time.time()
+    shuffle_idx = _build_shuffle_idx(num_samples, total_size, np_rng)
+    _save_index_mapping(shuffle_idx_filename, shuffle_idx)
+    return time.time() - start_time
+
+
+def _build_and_save_index_mappings(documents, sizes, num_samples, seq_length,
+                                   num_epochs, tokens_per_epoch, np_rng,
+                                   doc_idx_filename, sample_idx_filename,
+                                   shuffle_idx_filename):
+    print(' > WARNING: could not find index map files, building '
+                    'the indices on this process ...')
+
+    # For the last epoch, decide whether include the entire epoch
+    # in the global shuffle or not.
+
+    # If we need only one epoch, then separating last epoch  does
+    # not mean anything.
+    if num_epochs == 1:
+        separate_last_epoch = False
+        print(' > only one epoch required, setting '
+                'separate_last_epoch to False', flush=True)
+
+    else:
+        # Get the number of samples for the last epoch
+        num_samples_from_epochs_minus_one = (
+            (num_epochs - 1) * tokens_per_epoch - 1) // seq_length
+        last_epoch_num_samples = num_samples - \
+                                    num_samples_from_epochs_minus_one
+        assert last_epoch_num_samples >= 0, \
+            'last epoch number of samples should be non-negative.'
+        num_samples_per_epoch = (tokens_per_epoch - 1) // seq_length
+        assert last_epoch_num_samples < (num_samples_per_epoch + 1), \
+            'last epoch number of samples exceeded max value.'
+        # If we have less than 80% of the samples for the last epoch,
+        # seperate out the epoch and treat it differently.
+        # Note: the 80% number is just based on common sense and can
+        # be adjusted if needed.
+        separate_last_epoch = (last_epoch_num_samples <
+                                int(0.80 * num_samples_per_epoch))
+        if separate_last_epoch:
+            string = ' > last epoch number of samples ({}) is smaller '\
+                        'than 80% of number of samples per epoch ({}), '\
+                        'setting separate_last_epoch to True'
+        else:
+            string = ' > last epoch number of samples ({}) is larger '\
+                        'than 80% of number of samples per epoch ({}), '\
+                        'setting separate_last_epoch to False'
+        print(string.format(last_epoch_num_samples,
+                            num_samples_per_epoch), flush=True)
+
+    # doc-idx.
+    start_time = time.time()
+    doc_idx = _build_doc_idx(documents, num_epochs, np_rng,
+                                separate_last_epoch)
+    _save_index_mapping(doc_idx_filename, doc_idx)
+    print(' > elasped time to build and save doc-idx mapping '
+                    '(seconds): {:4f}'.format(time.time() - start_time))
+    assert doc_idx.dtype == np.int32
+    assert sizes.dtype == np.int32
+
+    # sample-idx and shuffle-idx only depend on doc-idx and on the rng state
+    # after shuffling it, so build them concurrently. Threads rather than
+    # processes: the training process is already multi-threaded, which makes
+    # forking unsafe, and the numpy kernels and file writes release the GIL.
+    # -1 is due to data structure used to retieve the index:
+    #    sample i --> [sample_idx[i], sample_idx[i+1])
+    total_num_samples = (num_epochs * tokens_per_epoch - 1) // seq_length
+    if separate_last_epoch:
+        num_samples_ = num_samples_from_epochs_minus_one
+    else:
+        num_samples_ = total_num_samples
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sample_idx_future = executor.submit(
+            _build_and_save_sample_idx, sample_idx_filename, sizes,
+            doc_idx, seq_length, num_epochs, tokens_per_epoch)
+        shuffle_idx_future = executor.submit(
+            _build_and_save_shuffle_idx, shuffle_idx_filename, num_samples_,
+            total_num_samples, np_rng)
+        print(' > elasped time to build and save sample-idx mapping '
+                        '(seconds): {:4f}'.format(sample_idx_future.result()))
+        print(' > elasped time to build and save shuffle-idx mapping'
+                        ' (seconds): {:4f}'.format(shuffle_idx_future.result()))
+    del doc_idx
+
+
 def _num_tokens(documents, sizes):
     """Total number of tokens in the dataset."""
     return np.sum(sizes[documents])
@@ -346,46 +663,37 @@ def _build_sample_idx(sizes, doc_idx, seq_length,
     """Sample index mapping is a 2D array with sizes
     [number-of-samples + 1, 2] where [..., 0] contains
     the index into `doc_idx` and [..., 1] is the
-    starting offset in that document."""
+    starting offset in that document.
+
+    Sample i spans the tokens [i * seq_length, (i + 1) * seq_length] of the
+    stream formed by concatenating the documents in `doc_idx` order (the last
+    token overlaps with the first token of the next sample), so its boundary
+    can be located with a binary search over the cumulative document sizes
+    instead of walking every document.
+    """
 
     # Total number of samples. For -1 see comments in `_num_epochs`.
     num_samples = (num_epochs * tokens_per_epoch - 1) // seq_length
     sample_idx = np.zeros([num_samples + 1, 2], dtype=np.int32)
 
-    # Index into sample_idx.
-    sample_index = 0
-    # Index into doc_idx.
-    doc_idx_index = 0
-    # Begining offset for each document.
-    doc_offset = 0
+    # doc_ends[k] is the position right after the last token of doc_idx[k].
+    doc_ends = np.cumsum(sizes[doc_idx], dtype=np.int64)
+
     # Start with first document and no offset.
-    sample_idx[sample_index][0] = doc_idx_index
-    sample_idx[sample_index][1] = doc_offset
-    sample_index += 1
-    while sample_index <= num_samples:
-        # Start with a fresh sequence.
-        remaining_seq_length = seq_length + 1
-        while remaining_seq_length != 0:
-            # Get the document length.
-            doc_id = doc_idx[doc_idx_index]
-            doc_length = sizes[doc_id] - doc_offset
-            # And add it to the current sequence.
-            remaining_seq_length -= doc_length
-            # If we have more than a full sequence, adjust offset and set
-            # remaining length to zero so we return from the while loop.
-            # Note that -1 here is for the same reason we have -1 in
-            # `_num_epochs` calculations.
-            if remaining_seq_length <= 0:
-                doc_offset += (remaining_seq_length + doc_length - 1)
-                remaining_seq_length = 0
-            else:
-                # Otherwise, start from the begining of the next document.
-                doc_idx_index += 1
-                doc_offset = 0
-        # Record the sequence.
-        sample_idx[sample_index][0] = doc_idx_index
-        sample_idx[sample_index][1] = doc_offset
-        sample_index += 1
+    sample_idx[0][0] = 0
+    sample_idx[0][1] = 0
+    # Bound the temporary position arrays for very large corpora.
+    chunk_size = 1 << 24
+    for start in range(1, num_samples + 1, chunk_size):
+        stop = min(start + chunk_size, num_samples + 1)
+        positions = np.arange(start, stop, dtype=np.int64) * seq_length
+        # First document ending after the position, empty documents are
+        # skipped since their end equals the end of the previous one.
+        doc_idx_index = np.searchsorted(doc_ends, positions, side='right')
+        doc_offset = positions - (doc_ends[doc_idx_index] -
+                                  sizes[doc_idx[doc_idx_index]])
+        sample_idx[start:stop, 0] = doc_idx_index
+        sample_idx[start:stop, 1] = doc_offset
 
     return sample_idx
 
@@ -10,10 +10,13 @@
 # Added document index to index file and made it accessible.
 #    An empty sentence no longer separates documents.
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+import mmap
 import os
 import shutil
 import struct
+import time
 from itertools import accumulate
 
 import numpy as np
@@ -258,6 +261,36 @@ class IndexedCachedDataset(IndexedDataset):
             return sents
 
 
+_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def _append_file(out_file, path):
+    """Append the content of path to the opened out_file, in kernel when possible."""
+    out_file.flush()
+    out_fd = out_file.fileno()
+    with open(path, 'rb') as f:
+        in_fd = f.fileno()
+        remaining = os.fstat(in_fd).st_size
+        try:
+            while remaining > 0:
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(in_fd, out_fd, min(remaining, _COPY_CHUNK_SIZE))
+                else:
+                    copied = os.sendfile(out_fd, in_fd, None, min(remaining, _COPY_CHUNK_SIZE))
+                if copied == 0:
+                    break
+                remaining -= copied
+        except (AttributeError, OSError):
+            # e.g. cross filesystem copy on old kernels, fall back to large buffer copies
+            pass
+        if remaining > 0:
+            f.seek(-remaining, os.SEEK_END)
+            out_file.seek(0, os.SEEK_END)
+            shutil.copyfileobj(f, out_file, _COPY_CHUNK_SIZE)
+    # resync the buffered writer with the position of the underlying fd
+    out_file.seek(0, os.SEEK_END)
+
+
 class IndexedDatasetBuilder(object):
     element_sizes = {
         np.uint8: 1,
@@ -285,6 +318,18 @@ class IndexedDatasetBuilder(object):
             self.sizes.append(s)
         self.dim_offsets.append(self.dim_offsets[-1] + len(tensor.size()))
 
+    def add_items(self, tokens, lengths):
+        """Append len(lengths) 1-D items stored back to back in the flat tokens."""
+        tokens = np.asarray(tokens, dtype=self.dtype)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        assert tokens.size == lengths.sum()
+        self.out_file.write(tokens.tobytes(order='C'))
+        self.data_offsets.extend((self.data_offsets[-1] + np.cumsum(lengths)).tolist())
+        self.sizes.extend(lengths.tolist())
+        self.dim_offsets.extend(
+            (self.dim_offsets[-1] + np.arange(1, lengths.size + 1)).tolist()
+        )
+
     def end_document(self):
         self.doc_idx.append(len(self.sizes))
 
@@ -292,21 +337,13 @@ class IndexedDatasetBuilder(object):
         index = IndexedDataset(another_file)
         assert index.dtype == self.dtype
 
-        begin = self.data_offsets[-1]
-        for offset in index.data_offsets[1:]:
-            self.data_offsets.append(begin + offset)
-        self.sizes.extend(index.sizes)
-        begin = self.dim_offsets[-1]
-        for dim_offset in index.dim_offsets[1:]:
-            self.dim_offsets.append(begin + dim_offset)
-
-        with open(data_file_path(another_file), 'rb') as f:
-            while True:
-                data = f.read(1024)
-                if data:
-                    self.out_file.write(data)
-                else:
-                    break
+        num_sizes = len(self.sizes)
+        self.data_offsets.extend((self.data_offsets[-1] + index.data_offsets[1:]).tolist())
+        self.sizes.extend(index.sizes.tolist())
+        self.dim_offsets.extend((self.dim_offsets[-1] + index.dim_offsets[1:]).tolist())
+        self.doc_idx.extend((num_sizes + index.doc_idx[1:]).tolist())
+
+        _append_file(self.out_file, data_file_path(another_file))
 
     def finalize(self, index_file):
         self.out_file.close()
@@ -323,10 +360,65 @@ class IndexedDatasetBuilder(object):
         index.close()
 
 
-def _warmup_mmap_file(path):
-    with open(path, 'rb') as stream:
-        while stream.read(100 * 1024 * 1024):
-            pass
+_WARMUP_CHUNK_SIZE = 16 * 1024 * 1024
+_WARMUP_NUM_THREADS = 8
+# tokens gathered at once by get_ranges when `out` needs a dtype conversion
+_GATHER_CHUNK_SIZE = 64 * 1024
+
+
+def _read_range(fd, start, end):
+    while start < end:
+        data = os.pread(fd, min(end - start, _WARMUP_CHUNK_SIZE), start)
+        if not data:
+            break
+        start += len(data)
+
+
+def _log_warmup(verb, path, num_bytes, start_time):
+    elapsed = max(time.time() - start_time, 1e-6)
+    print('    {} {:.1f} MB of {} in {:.3f} seconds ({:.1f} MB/s)'.format(
+        verb, num_bytes / 1e6, path, elapsed, num_bytes / 1e6 / elapsed))
+
+
+def _warmup_mmap_file(path, ranges=None, num_threads=_WARMUP_NUM_THREADS):
+    """Read the byte `ranges` ([start, end) pairs, the whole file by default)
+    of path into the page cache, from num_threads threads in parallel."""
+    start_time = time.time()
+    if ranges is None:
+        ranges = [(0, os.path.getsize(path))]
+    chunks = [(start, min(start + _WARMUP_CHUNK_SIZE, end))
+              for start, end in ranges
+              for start in range(start, end, _WARMUP_CHUNK_SIZE)]
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        # os.pread releases the GIL, so the threads do read in parallel
+        with ThreadPoolExecutor(max(num_threads, 1)) as executor:
+            list(executor.map(lambda chunk: _read_range(fd, *chunk), chunks))
+    finally:
+        os.close(fd)
+
+    _log_warmup('warmed up', path, sum(end - start for start, end in ranges),
+                start_time)
+
+
+def _madvise_mmap_file(np_memmap, path, ranges=None):
+    """Ask the kernel to read ahead the byte `ranges` of the mapped file,
+    returns without waiting for the reads."""
+    if not hasattr(np_memmap._mmap, 'madvise'):
+        # madvise needs python 3.8
+        return _warmup_mmap_file(path, ranges)
+
+    start_time = time.time()
+    if ranges is None:
+        ranges = [(0, len(np_memmap._mmap))]
+    for start, end in ranges:
+        aligned_start = start - start % mmap.PAGESIZE
+        np_memmap._mmap.madvise(mmap.MADV_WILLNEED, aligned_start,
+                                end - aligned_start)
+
+    _log_warmup('advised read ahead of', path,
+                sum(end - start for start, end in ranges), start_time)
 
 
 class MMapIndexedDataset():
@@ -348,26 +440,22 @@ class MMapIndexedDataset():
                 @staticmethod
                 def _get_pointers(sizes):
                     dtype_size = dtype().itemsize
-                    address = 0
-                    pointers = []
-
-                    for size in sizes:
-                        pointers.append(address)
-                        address += size * dtype_size
+                    pointers = np.zeros(len(sizes), dtype=np.int64)
+                    np.cumsum(sizes[:-1], dtype=np.int64, out=pointers[1:])
+                    pointers *= dtype_size
 
                     return pointers
 
                 def write(self, sizes, doc_idx):
+                    sizes = np.asarray(sizes, dtype=np.int32)
                     pointers = self._get_pointers(sizes)
 
                     self._file.write(struct.pack('<Q', len(sizes)))
                     self._file.write(struct.pack('<Q', len(doc_idx)))
 
-                    sizes = np.array(sizes, dtype=np.int32)
                     self._file.write(sizes.tobytes(order='C'))
                     del sizes
 
-                    pointers = np.array(pointers, dtype=np.int64)
                     self._file.write(pointers.tobytes(order='C'))
                     del pointers
 
@@ -507,6 +595,68 @@ class MMapIndexedDataset():
                                  count=length, offset=ptr)
         return np_array
 
+    def warmup(self, indices=None, method='read',
+               num_threads=_WARMUP_NUM_THREADS):
+        """Page in the index and the data of the items at `indices` (all items
+        by default), reading with threads or with madvise(MADV_WILLNEED)."""
+        assert method in ('read', 'madvise')
+        ranges = None if indices is None else self._byte_ranges(indices)
+        if method == 'madvise':
+            _madvise_mmap_file(self._index._bin_buffer_mmap,
+                               index_file_path(self._path))
+            _madvise_mmap_file(self._bin_buffer_mmap,
+                               data_file_path(self._path), ranges)
+        else:
+            _warmup_mmap_file(index_file_path(self._path),
+                              num_threads=num_threads)
+            _warmup_mmap_file(data_file_path(self._path), ranges, num_threads)
+
+    def _byte_ranges(self, indices):
+        """Sorted [start, end) byte ranges of the data file covering the items
+        at `indices`, ranges closer than a warmup chunk are merged."""
+        touched = np.zeros(len(self) + 2, dtype=np.int8)
+        touched[np.asarray(indices) + 1] = 1
+        edges = np.diff(touched)
+        run_starts = np.nonzero(edges == 1)[0]
+        run_ends = np.nonzero(edges == -1)[0]
+        if run_starts.size == 0:
+            return []
+
+        pointers = self._index._pointers
+        starts = pointers[run_starts]
+        ends = (pointers[run_ends - 1] +
+                self._index.sizes[run_ends - 1].astype(np.int64) *
+                self._index._dtype_size)
+        keep = starts[1:] - ends[:-1] >= _WARMUP_CHUNK_SIZE
+        starts = starts[np.concatenate(([True], keep))]
+        ends = ends[np.concatenate((keep, [True]))]
+        return list(zip(starts.tolist(), ends.tolist()))
+
+    def get_ranges(self, indices, offsets, lengths, out):
+        """ Copies `lengths[i]` tokens starting at `offsets[i]` of item
+        `indices[i]` for every i, back to back into the flat array `out`.
+
+        This is the batched form of get(). The temporaries are one index
+        array the size of `out` and, when `out` has another dtype than the
+        tokens, a chunk of `_GATHER_CHUNK_SIZE` tokens.
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        starts = self._index._pointers[indices] // self._index._dtype_size
+        starts += offsets
+        ends = np.cumsum(lengths)
+        assert out.shape == (ends[-1],)
+        positions = np.repeat(starts - ends + lengths, lengths)
+        positions += np.arange(out.size, dtype=np.int64)
+        tokens = np.frombuffer(self._bin_buffer, dtype=self._index.dtype)
+        if out.dtype == tokens.dtype:
+            np.take(tokens, positions, out=out)
+        else:
+            # np.take can't cast into `out`, convert chunk by chunk
+            for start in range(0, out.size, _GATHER_CHUNK_SIZE):
+                end = start + _GATHER_CHUNK_SIZE
+                out[start:end] = tokens[positions[start:end]]
+        return out
+
     @property
     def sizes(self):
         return self._index.sizes
@@ -536,31 +686,71 @@ class MMapIndexedDatasetBuilder(object):
     def __init__(self, out_file, dtype=np.int64):
         self._data_file = open(out_file, 'wb')
         self._dtype = dtype
+        self._num_items = 0
+        # sizes and document index are kept as numpy chunks, the python lists
+        # only buffer what add_item and end_document append one at a time
         self._sizes = []
         self._doc_idx = [0]
+        self._sizes_chunks = []
+        self._doc_idx_chunks = []
+
+    def _flush_lists(self):
+        if len(self._sizes) > 0:
+            self._sizes_chunks.append(np.array(self._sizes, dtype=np.int32))
+            self._sizes = []
+        if len(self._doc_idx) > 0:
+            self._doc_idx_chunks.append(np.array(self._doc_idx, dtype=np.int64))
+            self._doc_idx = []
 
     def add_item(self, tensor):
-        np_array = np.array(tensor.numpy(), dtype=self._dtype)
+        if hasattr(tensor, 'numpy'):
+            tensor = tensor.numpy()
+        np_array = np.asarray(tensor, dtype=self._dtype)
         self._data_file.write(np_array.tobytes(order='C'))
         self._sizes.append(np_array.size)
+        self._num_items += 1
+
+    def add_items(self, tokens, lengths, end_documents=False):
+        """Append len(lengths) items stored back to back in the flat tokens.
+
+        With end_documents, every item is also a document of its own.
+        """
+        tokens = np.asarray(tokens, dtype=self._dtype)
+        lengths = np.asarray(lengths, dtype=np.int32)
+        assert tokens.size == lengths.sum(dtype=np.int64)
+        self._data_file.write(tokens.tobytes(order='C'))
+
+        self._flush_lists()
+        self._sizes_chunks.append(lengths)
+        if end_documents:
+            self._doc_idx_chunks.append(
+                self._num_items + np.arange(1, lengths.size + 1, dtype=np.int64)
+            )
+        self._num_items += lengths.size
 
     def end_document(self):
-        self._doc_idx.append(len(self._sizes))
+        self._doc_idx.append(self._num_items)
 
     def merge_file_(self, another_file):
         # Concatenate index
-        index = MMapIndexedDataset.Index(index_file_path(another_file))
+        index = MMapIndexedDataset.Index(index_file_path(another_file), skip_warmup=True)
         assert index.dtype == self._dtype
 
-        for size in index.sizes:
-            self._sizes.append(size)
+        self._flush_lists()
+        self._sizes_chunks.append(np.array(index.sizes, dtype=np.int32))
+        # Concatenate document index, dropping the leading 0 of another_file
+        self._doc_idx_chunks.append(self._num_items + index.doc_idx[1:])
+        self._num_items += len(index)
+        del index
 
         # Concatenate data
-        with open(data_file_path(another_file), 'rb') as f:
-            shutil.copyfileobj(f, self._data_file)
+        _append_file(self._data_file, data_file_path(another_file))
 
     def finalize(self, index_file):
         self._data_file.close()
 
+        self._flush_lists()
+        sizes = np.concatenate(self._sizes_chunks or [np.empty(0, dtype=np.int32)])
+        doc_idx = np.concatenate(self._doc_idx_chunks)
         with MMapIndexedDataset.Index.writer(index_file, self._dtype) as index:
-            index.write(self._sizes, self._doc_idx)
+            index.write(sizes, doc_idx)
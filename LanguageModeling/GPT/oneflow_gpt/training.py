@@ -10,11 +10,15 @@ import oneflow as flow
 
 from oneflow_gpt.config import get_args
 from oneflow_gpt import distribute
-from oneflow_gpt.data import GPTDataLoader, get_train_val_test_num_samples
+from oneflow_gpt.data import (
+    GPTDataLoader,
+    GPTBatchLoader,
+    get_train_val_test_num_samples,
+)
 from oneflow_gpt.model import GPTModel, ParallelSparseSoftmaxCrossEntropyLoss
 from oneflow_gpt.optimizer import make_optimizer
 from oneflow_gpt.snapshot import Snapshot
-from oneflow_gpt.util import Metric
+from oneflow_gpt.util import Metric, MetricSink
 from oneflow_gpt.third_party.data.gpt_dataset import build_train_valid_test_datasets
 
 
@@ -119,6 +123,33 @@ def _make_gpt_train_func(args):
     return train
 
 
+def _get_consumed_samples(args, snapshot, batch_size):
+    data_state = snapshot.data_state
+    if data_state is None:
+        # snapshot saved without data loader state
+        return snapshot.iter * batch_size
+
+    for key in ("dataset", "seed", "seq_length"):
+        if data_state[key] != getattr(args, key):
+            print(
+                f"WARNING: {key} {getattr(args, key)} differs from {data_state[key]}"
+                " of the loaded snapshot, resumed data order may be inconsistent"
+            )
+
+    return data_state["consumed_samples"]
+
+
+def _make_data_state_fn(args, batch_loader):
+    def data_state_fn():
+        state = batch_loader.state_dict()
+        state["dataset"] = args.dataset
+        state["seed"] = args.seed
+        state["seq_length"] = args.seq_length
+        return state
+
+    return data_state_fn
+
+
 def train():
     args = get_args()
     _init_env(args)
@@ -131,8 +162,16 @@ def train():
         total_iters=args.train_iters,
         save_last=args.save_last,
         save_init=args.save_init,
+        save_async=args.save_async,
+        keep_last=args.keep_last_snapshots,
+        keep_interval=args.keep_snapshot_interval,
+        keep_best=args.keep_best_snapshots,
     )
 
+    metric_sink = None
+    if args.metric_file is not None:
+        metric_sink = MetricSink(args.metric_file)
+
     metric = Metric(
         print_steps=args.log_interval,
         start_step=snapshot.iter,
@@ -142,36 +181,67 @@ def train():
         print_format=args.metric_print_format,
         nvidia_smi_report_step=10,
         nvidia_smi_report_file=None,
+        num_tokens_per_sample=args.seq_length,
+        sink=metric_sink,
     )
+    snapshot.set_metric_fn(lambda: metric.latest("loss"))
 
     if args.use_external_dataset:
         train_val_test_num_samples = get_train_val_test_num_samples(
             args.split, args.train_samples
         )
         train_ds, _, _ = build_train_valid_test_datasets(
-            data_prefix=[args.dataset],
+            data_prefix=args.dataset,
             data_impl="mmap",
             splits_string=args.split,
             train_valid_test_num_samples=train_val_test_num_samples,
             seq_length=args.seq_length,
             seed=args.seed,
-            skip_warmup=0,
+            skip_warmup=True,
+        )
+        # the train placeholder holds the whole global batch, data parallel
+        # ranks get their slices through the S(0) input split
+        batch_size = args.global_batch_size
+        consumed_samples = _get_consumed_samples(args, snapshot, batch_size)
+        print(f"Resuming external dataset after {consumed_samples} samples")
+        if args.mmap_warmup != "none":
+            indices = None
+            if args.mmap_warmup == "samples":
+                # this process feeds every sample of the global batch
+                num_samples = (args.train_iters - snapshot.iter) * batch_size
+                indices = np.arange(
+                    consumed_samples,
+                    min(consumed_samples + num_samples, len(train_ds)),
+                )
+            train_ds.warmup(
+                indices,
+                method=args.mmap_warmup_method,
+                num_threads=args.mmap_warmup_threads,
+            )
+        batch_loader = GPTBatchLoader(
+            train_ds,
+            batch_size=batch_size,
+            seq_length=args.seq_length,
+            consumed_samples=consumed_samples,
+            num_batches=args.train_iters - snapshot.iter,
+            prefetch=args.num_prefetch_batches,
         )
+        snapshot.set_data_state_fn(_make_data_state_fn(args, batch_loader))
 
     if args.train_iters is None and args.train_samples is None:
         raise ValueError("train_iters and train_samples must be set either")
 
     print("Training...")
     try:
-        batch_size = args.micro_batch_size * args.num_accumulation_steps
         iteration = snapshot.iter
         while iteration < args.train_iters:
             if args.use_external_dataset:
-                batch = [
-                    train_ds[iteration * batch_size + i] for i in range(batch_size)
-                ]
-                data = np.stack(batch)
-                trainer(data).async_get(metric.metric_cb())
+                data = batch_loader.next()
+                trainer(data).async_get(
+                    batch_loader.recycle_after(
+                        metric.metric_cb(wait_time=batch_loader.last_wait_time), data
+                    )
+                )
             else:
                 trainer().async_get(metric.metric_cb())
 
@@ -181,6 +251,18 @@ def train():
     except KeyboardInterrupt:
         print("interrupted")
 
+    snapshot.wait()
+    metric.close()
+    if metric_sink is not None:
+        metric_sink.close()
+
+    if args.use_external_dataset:
+        batch_loader.close()
+        print(
+            f"batch loader: avg_wait_time={batch_loader.avg_wait_time:.5f},"
+            f"avg_queue_depth={batch_loader.avg_queue_depth:.2f}"
+        )
+
 
 if __name__ == "__main__":
     train()
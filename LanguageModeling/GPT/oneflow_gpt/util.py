@@ -1,7 +1,19 @@
 import os
+import sys
 import time
+import subprocess
 import numpy as np
 
+sys.path.append(
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(__file__), os.path.pardir, os.path.pardir, os.path.pardir
+        )
+    )
+)
+
+from metric_sink import MetricSink
+
 
 class _Timer(object):
     def __init__(self):
@@ -39,6 +51,8 @@ class Metric(object):
         print_format="normal",
         nvidia_smi_report_step=10,
         nvidia_smi_report_file=None,
+        num_tokens_per_sample=None,
+        sink=None,
     ):
         r"""accumulate and calculate metric
 
@@ -46,14 +60,20 @@ class Metric(object):
             print_steps: `Int` print metrics every nth steps
             batch_size: `Int` batch size per step
             keys: keys in callback outputs
+            print_format: `str` normal, table or none to disable printing
+            num_tokens_per_sample: `Int` tokens of a sample for tokens_per_sec
+            sink: `MetricSink` receives a record of every step
         Returns:
         """
         self.print_steps_ = print_steps
         self.max_step_ = max_step
         self.num_samples_per_batch_ = num_samples_per_batch
+        self.num_tokens_per_sample_ = num_tokens_per_sample
+        self.sink_ = sink
 
         self.nvidia_smi_report_step_ = nvidia_smi_report_step
         self.nvidia_smi_report_file_ = nvidia_smi_report_file
+        self.nvidia_smi_proc_ = None
 
         self.step_ = start_step
         self.micro_batches_ = 0
@@ -70,6 +90,17 @@ class Metric(object):
 
         for key in self.keys_:
             self.kv_store_[key] = 0.0
+        self.record_fields_ = (
+            "step",
+            "timestamp",
+            "latency",
+            "samples",
+            "throughput",
+            "tokens_per_sec",
+            "wait_time",
+        ) + tuple(self.keys_)
+        # values of the last print
+        self.latest_ = dict()
 
         # need reset after every print
         self.acc_elapsed_time_ = 0.0
@@ -84,8 +115,10 @@ class Metric(object):
         elif print_format == "table":
             self.print_fn_ = self.step_print_by_table
             self.print_title_ = False
+        elif print_format == "none":
+            self.print_fn_ = None
         else:
-            raise ValueError("print_format must be <normal|table>")
+            raise ValueError("print_format must be <normal|table|none>")
 
     def step_print(self):
         record = (
@@ -134,13 +167,34 @@ class Metric(object):
 
         print(record)
 
-    def metric_cb(self):
+    def latest(self, key):
+        """Value of `key` at the last print, None before the first print"""
+        return self.latest_.get(key)
+
+    def _report_nvidia_smi(self):
+        cmd = ["nvidia-smi", "--query-gpu=utilization.gpu,memory.used", "--format=csv"]
+        if self.nvidia_smi_report_file_ is not None:
+            cmd += ["-f", self.nvidia_smi_report_file_]
+        # not waited for, the callback thread keeps running jobs, reaped by
+        # the next callbacks or close
+        self.nvidia_smi_proc_ = subprocess.Popen(cmd)
+
+    def close(self):
+        """Wait for the nvidia-smi report, if still running."""
+        if self.nvidia_smi_proc_ is not None:
+            self.nvidia_smi_proc_.wait()
+            self.nvidia_smi_proc_ = None
+
+    def metric_cb(self, wait_time=0.0):
+        """`wait_time` is the host time spent waiting for the input of the step"""
+
         def callback(outputs):
             elapsed_time = self.timer_.step()
             self.timestamp_ = self.timer_.cur_step()
             self.acc_elapsed_time_ += elapsed_time
 
             micro_batches = None
+            sums = []
             for key in self.keys_:
                 output = outputs[key].numpy()
                 assert isinstance(output, np.ndarray)
@@ -148,18 +202,41 @@ class Metric(object):
                     micro_batches = output.shape[0]
                 else:
                     assert micro_batches == output.shape[0]
-                self.kv_store_[key] += output.sum()
+                sums.append(output.sum())
+                self.kv_store_[key] += sums[-1]
 
             self.step_ += 1
+            samples = micro_batches * self.num_samples_per_batch_
             self.acc_micro_batches_ += micro_batches
-            self.acc_samples_ += micro_batches * self.num_samples_per_batch_
+            self.acc_samples_ += samples
+
+            if self.sink_ is not None:
+                throughput = samples / elapsed_time
+                tokens_per_sec = None
+                if self.num_tokens_per_sample_ is not None:
+                    tokens_per_sec = throughput * self.num_tokens_per_sample_
+                self.sink_.push(
+                    self.record_fields_,
+                    (
+                        self.step_,
+                        time.time(),
+                        elapsed_time,
+                        samples,
+                        throughput,
+                        tokens_per_sec,
+                        wait_time,
+                    )
+                    + tuple(s / micro_batches for s in sums),
+                )
 
             if self.step_ == self.nvidia_smi_report_step_:
-                cmd = "nvidia-smi --query-gpu=utilization.gpu,memory.used --format=csv"
-                if self.nvidia_smi_report_file_ is not None:
-                    cmd += f" -f {self.nvidia_smi_report_file_}"
-                os.system(cmd)
+                self._report_nvidia_smi()
                 self.print_title_ = False
+            elif (
+                self.nvidia_smi_proc_ is not None
+                and self.nvidia_smi_proc_.poll() is not None
+            ):
+                self.nvidia_smi_proc_ = None
 
             if self.step_ % self.print_steps_ == 0 or self.step_ == self.max_step_:
                 self.throughput_ = self.acc_samples_ / self.acc_elapsed_time_
@@ -168,12 +245,16 @@ class Metric(object):
                 for key in self.keys_:
                     value = self.kv_store_[key] / self.acc_micro_batches_
                     self.kv_store_[key] = value
+                    self.latest_[key] = float(value)
 
                 self.micro_batches_ += self.acc_micro_batches_
                 self.samples_ += self.acc_samples_
 
-                self.print_fn_()
+                if self.print_fn_ is not None:
+                    self.print_fn_()
 
+                for key in self.keys_:
+                    self.kv_store_[key] = 0.0
                 self.acc_elapsed_time_ = 0.0
                 self.acc_micro_batches_ = 0
                 self.acc_samples_ = 0
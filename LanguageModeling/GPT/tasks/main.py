@@ -11,7 +11,12 @@ def get_tasks_args(parser):
     """Provide extra arguments required for tasks."""
     group = parser.add_argument_group(title="tasks")
 
-    group.add_argument("--task", type=str, required=True, help="Task name.")
+    group.add_argument(
+        "--task",
+        nargs="+",
+        required=True,
+        help="Whitespace separated task names, evaluated in one process.",
+    )
     group.add_argument(
         "--epochs",
         type=int,
@@ -36,7 +41,10 @@ def get_tasks_args(parser):
         help="Whitespace separated paths or corpora names " "for training.",
     )
     group.add_argument(
-        "--valid-data", nargs="*", default=None, help="path(s) to the validation data."
+        "--valid-data",
+        nargs="*",
+        default=None,
+        help="path(s) to the validation data, one per task.",
     )
     group.add_argument(
         "--overlapping-eval",
@@ -49,6 +57,31 @@ def get_tasks_args(parser):
         action="store_true",
         help="Use more difficult formulation of lambada.",
     )
+    group.add_argument(
+        "--eval-cache-dir",
+        type=str,
+        default=None,
+        help="Directory of the tokenized evaluation data cache, defaults to "
+        "the directory of the evaluation data.",
+    )
+    group.add_argument(
+        "--num-tokenizer-workers",
+        type=int,
+        default=1,
+        help="Number of processes tokenizing the evaluation data.",
+    )
+    group.add_argument(
+        "--eval-prefetch-batches",
+        type=int,
+        default=2,
+        help="Number of evaluation batches assembled ahead on a background thread.",
+    )
+    group.add_argument(
+        "--eval-inflight-batches",
+        type=int,
+        default=2,
+        help="Max number of evaluation batches launched and not yet scored.",
+    )
     parser.add_argument(
         "--vocab-file", type=str, default=None, help="Path to the vocab file."
     )
@@ -85,9 +118,11 @@ if __name__ == "__main__":
 
     args = get_args(extra_args_provider=get_tasks_args)
 
-    if args.task in ["LAMBADA"]:
-        from zeroshot_gpt.evaluate import main
-    else:
-        raise NotImplementedError("Task {} is not implemented.".format(args.task))
+    from zeroshot_gpt.datasets import registered_tasks
+
+    for task in args.task:
+        if task not in registered_tasks():
+            raise NotImplementedError("Task {} is not implemented.".format(task))
+    from zeroshot_gpt.evaluate import main
 
     main(args)
@@ -13,79 +13,274 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import json
 import math
+import os
 import numpy as np
 from tokenizer.tokenizer import build_tokenizer
+from oneflow_gpt.third_party.data.indexed_dataset import MMapIndexedDataset
 
 
-def build_dataset(args):
+# task name -> (dataset builder, evaluation metric)
+_TASKS = {}
+
+
+def register_task(name, eval_metric):
+    """Register `build_fn(args, path)` as the dataset builder of task `name`,
+    evaluated with `eval_metric` ("accuracy" or "loss")."""
+
+    def decorator(build_fn):
+        assert name not in _TASKS, "task {} is already registered".format(name)
+        _TASKS[name] = (build_fn, eval_metric)
+        return build_fn
+
+    return decorator
+
+
+def registered_tasks():
+    return sorted(_TASKS)
+
+
+def get_eval_metric(task):
+    return _TASKS[task][1]
+
+
+def build_dataset(args, task, path):
     """Helper function to select and build dataset."""
-    if args.task == "LAMBADA":
-        return _build_lambada_dataset(args)
+    if task in _TASKS:
+        return _TASKS[task][0](args, path)
 
     raise NotImplementedError("dataset for {} task is not " "implemented.".format(task))
 
 
+def _file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _scatter_ragged(out, ids, offsets, col_starts):
+    """out[i, col_starts[i] + j] = ids[offsets[i] + j], dropping columns < 0."""
+    lengths = np.diff(offsets)
+    rows = np.repeat(np.arange(lengths.size), lengths)
+    cols = np.arange(ids.size) + np.repeat(col_starts - offsets[:-1], lengths)
+    keep = cols >= 0
+    out[rows[keep], cols[keep]] = ids[keep]
+
+
 class _LambadaDataset:
-    def __init__(self, path, pad_idx, tokenizer, seq_len, strict=False):
+    """Tokenized LAMBADA samples, padded to seq_len + 1 tokens.
+
+    The padded tokens and the label mask are cached as .npy files keyed by
+    the data file, the tokenizer and seq_len, and are memory mapped. Indexing
+    with an int or a slice returns rows of those arrays.
+    """
+
+    def __init__(
+        self,
+        path,
+        pad_idx,
+        tokenizer,
+        seq_len,
+        strict=False,
+        cache_dir=None,
+        tokenizer_key="",
+        num_workers=1,
+    ):
         print("> building lambada dataset from {} ...".format(path))
         self.seq_len = seq_len
         self.pad_idx = pad_idx
         self.tokenizer = tokenizer
         self.strict = strict
 
-        self.tokens = []
-        self.labels = []
+        if cache_dir is None:
+            cache_dir = os.path.dirname(os.path.abspath(path))
+        key = hashlib.md5(
+            "{}_{}_{}_{}_{}_{}_{}".format(
+                _file_md5(path),
+                tokenizer.name,
+                tokenizer.vocab_size,
+                tokenizer_key,
+                seq_len,
+                pad_idx,
+                strict,
+            ).encode("utf-8")
+        ).hexdigest()
+        prefix = os.path.join(
+            cache_dir, "{}_{}".format(os.path.splitext(os.path.basename(path))[0], key)
+        )
+        text_filename = prefix + "_text.npy"
+        pad_mask_filename = prefix + "_pad_mask.npy"
+
+        if not (os.path.isfile(text_filename) and os.path.isfile(pad_mask_filename)):
+            text, pad_mask = self.build_arrays(path, num_workers)
+            for filename, array in ((text_filename, text), (pad_mask_filename, pad_mask)):
+                tmp_filename = "{}.tmp{}.npy".format(filename[: -len(".npy")], os.getpid())
+                np.save(tmp_filename, array, allow_pickle=False)
+                os.replace(tmp_filename, filename)
+            print(" > saved tokenized lambada to {}".format(prefix))
+
+        print(" > loading tokenized lambada from {}".format(prefix))
+        self.text = np.load(text_filename, allow_pickle=False, mmap_mode="r")
+        self.pad_mask = np.load(pad_mask_filename, allow_pickle=False, mmap_mode="r")
+
+    def build_arrays(self, path, num_workers):
         with open(path, "r") as f:
-            for line in f.readlines():
-                text = json.loads(line)["text"]
-                tokens, labels = self.get_tokens(text)
-                self.tokens.append(tokens)
-                self.labels.append(labels)
+            texts = [json.loads(line)["text"] for line in f]
+
+        if not self.strict:
+            ids, offsets = self.tokenizer.tokenize_batch(texts, num_workers)
+            lengths = np.diff(offsets)
+            context_lengths = lengths - 1
+            label_lengths = np.ones_like(lengths)
+        else:
+            contexts = []
+            last_tokens = []
+            for text in texts:
+                last_token = text.split()[-1]
+                start_idx = text.rfind(last_token)
+                contexts.append(text[:start_idx].strip())
+                last_tokens.append(" " + last_token)
+            context_ids, context_offsets = self.tokenizer.tokenize_batch(
+                contexts, num_workers
+            )
+            label_ids, label_offsets = self.tokenizer.tokenize_batch(
+                last_tokens, num_workers
+            )
+            context_lengths = np.diff(context_offsets)
+            label_lengths = np.diff(label_offsets)
 
-    def get_tokens(self, text):
+        # Samples longer than seq_len + 1 keep their last tokens.
+        width = self.seq_len + 1
+        starts = np.minimum(width - context_lengths - label_lengths, 0)
+        text = np.full((len(texts), width), self.pad_idx, dtype=np.int32)
         if not self.strict:
-            tokens = self.tokenizer.tokenize(text)
-            return tokens[:-1], [tokens[-1]]
-        last_token = text.split()[-1]
-        start_idx = text.rfind(last_token)
-        beginning_tokens = self.tokenizer.tokenize(text[:start_idx].strip())
-        last_token = self.tokenizer.tokenize(" " + last_token)
-        return beginning_tokens, last_token
+            _scatter_ragged(text, ids, offsets, starts)
+        else:
+            _scatter_ragged(text, context_ids, context_offsets, starts)
+            _scatter_ragged(text, label_ids, label_offsets, starts + context_lengths)
+
+        # Labels are the tokens in [label_start, label_end) of every row.
+        cols = np.arange(width)
+        label_start = (starts + context_lengths)[:, None]
+        label_end = label_start + label_lengths[:, None]
+        pad_mask = ((cols >= label_start) & (cols < label_end)).astype(np.int8)
+        return text, pad_mask[:, 1:]
 
     def __len__(self):
-        return len(self.tokens)
+        return self.text.shape[0]
 
     def __getitem__(self, idx):
-        tokens = self.tokens[idx]
-        num_tokens = len(tokens)
-        pad_mask = [0] * num_tokens
-        labels = self.labels[idx]
-        pad_mask += [1] * len(labels)
-        tokens = tokens + labels
-        num_tokens = len(tokens)
-        if num_tokens < self.seq_len + 1:
-            num_pad = self.seq_len + 1 - num_tokens
-            pad_mask += [0] * (num_pad)
-            tokens += [self.pad_idx] * num_pad
-        pad_mask = np.array(pad_mask[1:])
-
-        return {"text": np.array(tokens), "pad_mask": pad_mask}
-
-
-def _build_lambada_dataset(args):
+        return {"text": self.text[idx], "pad_mask": self.pad_mask[idx]}
+
+
+@register_task("LAMBADA", "accuracy")
+def _build_lambada_dataset(args, path):
     """Build lambada dataset."""
     tokenizer = build_tokenizer(args)
 
-    assert len(args.valid_data) == 1
     val_dataset = _LambadaDataset(
-        args.valid_data[0],
+        path,
         tokenizer.eod,
         tokenizer,
         args.seq_length,
         args.strict_lambada,
+        cache_dir=args.eval_cache_dir,
+        tokenizer_key="{}_{}".format(
+            _file_md5(args.vocab_file), _file_md5(args.merge_file)
+        ),
+        num_workers=args.num_tokenizer_workers,
     )
     print(" > found {} samples.".format(len(val_dataset)))
 
     return val_dataset
+
+
+class _LMDataset:
+    """Sliding windows over the token stream of an MMapIndexedDataset.
+
+    Window i covers tokens [i * overlapping_eval, i * overlapping_eval +
+    seq_len + 1), padded with pad_idx. Every window but the first only
+    scores its last overlapping_eval targets, so each target is scored once
+    with as much context as possible. Indexing with an int or a slice
+    gathers the windows directly from the memory mapped tokens.
+    """
+
+    def __init__(self, path, pad_idx, seq_len, overlapping_eval=None):
+        print("> building lm dataset from {} ...".format(path))
+        self.seq_len = seq_len
+        self.pad_idx = pad_idx
+        self.overlapping_eval = overlapping_eval or seq_len
+        assert 0 < self.overlapping_eval <= seq_len
+
+        self.indexed_dataset = MMapIndexedDataset(path, skip_warmup=True)
+        # concatenate the items into one token stream
+        sizes = self.indexed_dataset.sizes
+        num_tokens = int(np.sum(sizes, dtype=np.int64))
+        self.tokens = np.empty(num_tokens, dtype=np.int32)
+        if num_tokens > 0:
+            self.indexed_dataset.get_ranges(
+                np.arange(len(sizes)),
+                np.zeros(len(sizes), dtype=np.int64),
+                sizes,
+                self.tokens,
+            )
+        num_targets = max(num_tokens - 1, 0)
+        self.num_samples = (
+            max(
+                math.ceil((num_targets - seq_len) / self.overlapping_eval),
+                0,
+            )
+            + 1
+        )
+        self.num_targets = num_targets
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        single = np.ndim(idx) == 0 and not isinstance(idx, slice)
+        if isinstance(idx, slice):
+            idx = np.arange(*idx.indices(self.num_samples))
+        idx = np.atleast_1d(np.asarray(idx, dtype=np.int64))
+
+        starts = idx * self.overlapping_eval
+        positions = starts[:, None] + np.arange(self.seq_len + 1)
+        valid = positions < self.tokens.size
+        text = np.where(
+            valid,
+            self.tokens[np.minimum(positions, max(self.tokens.size - 1, 0))],
+            self.pad_idx,
+        ).astype(np.int32)
+
+        pad_mask = valid[:, 1:]
+        if self.overlapping_eval != self.seq_len:
+            # targets already scored by the previous window
+            scored = np.arange(self.seq_len) >= self.seq_len - self.overlapping_eval
+            pad_mask = pad_mask & (scored | (idx == 0)[:, None])
+        pad_mask = pad_mask.astype(np.int8)
+
+        if single:
+            return {"text": text[0], "pad_mask": pad_mask[0]}
+        return {"text": text, "pad_mask": pad_mask}
+
+
+@register_task("WIKITEXT103", "loss")
+def _build_wikitext103_dataset(args, path):
+    """Build the sliding window perplexity dataset of a tokenized corpus,
+    `path` is the prefix of its MMapIndexedDataset .bin/.idx files."""
+    tokenizer = build_tokenizer(args)
+
+    val_dataset = _LMDataset(
+        path, tokenizer.eod, args.seq_length, args.overlapping_eval
+    )
+    print(
+        " > found {} samples, {} target tokens.".format(
+            len(val_dataset), val_dataset.num_targets
+        )
+    )
+
+    return val_dataset
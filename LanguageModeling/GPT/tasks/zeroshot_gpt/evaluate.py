@@ -1,6 +1,9 @@
 import math
 import os
 import sys
+import time
+import queue
+import threading
 
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
@@ -8,7 +11,7 @@ sys.path.append(
 
 from oneflow_gpt.model import GPTModel, ParallelSparseSoftmaxCrossEntropyLoss
 from oneflow_gpt import util
-from .datasets import build_dataset
+from .datasets import build_dataset, get_eval_metric
 import numpy as np
 import oneflow as flow
 
@@ -89,88 +92,225 @@ def process_batch(args, batch):
     """Process batch and produce inputs for the model."""
 
     loss_mask = batch["pad_mask"]
-    tokens_ = batch["text"]
+    tokens_ = batch["text"].astype(np.int64)
     labels = tokens_[:, 1:]
     tokens = tokens_[:, :-1]
 
     return tokens, labels, None, None, loss_mask
 
 
-def forward_step(args, batch, model, eval_metric):
-    """Forward step."""
+def score_label_positions(logits, labels, loss_mask):
+    """Score the label tokens of a batch.
 
-    # Get the batch.
-    tokens, labels, attention_mask, position_ids, loss_mask = process_batch(args, batch)
-    # Tell the model what our actual batch size will be
-    # args.micro_batch_size = len(labels)
+    Only the rows of `logits` at the `loss_mask` positions are gathered, so
+    argmax and log-softmax run over num_labels rather than batch * seq_len
+    rows.
 
-    # Forward model.
+    Args:
+        logits: `np.ndarray` of shape [batch * seq_len, vocab]
+        labels: `np.ndarray` of shape [batch, seq_len]
+        loss_mask: `np.ndarray` of shape [batch, seq_len], 1 at label tokens
 
-    # Forward pass through the model.
-    logits = model(tokens).get()
+    Returns:
+        number of samples with label tokens which are all predicted, sum of the
+        negative log-likelihood of the label tokens, number of label tokens
+    """
+    batch_size, seq_len = labels.shape
+    positions = np.flatnonzero(loss_mask.reshape(-1))
+    label_logits = logits.reshape(batch_size * seq_len, -1)[positions].astype(
+        np.float32
+    )
+    label_ids = labels.reshape(-1)[positions]
 
-    if eval_metric == "accuracy":
-        bs, e = logits.numpy().shape
-        outputs = np.argmax(
-            logits.numpy().reshape(
-                (args.micro_batch_size, int(bs / args.micro_batch_size), e)
-            ),
-            -1,
-        )
-        correct = (outputs == labels).astype(np.float32)
-        correct[(1 - loss_mask).astype(np.bool_)] = 1
-        correct = np.prod(correct, -1)
-        return np.sum(correct)
+    correct = label_logits.argmax(axis=-1) == label_ids
+    row_max = label_logits.max(axis=-1)
+    label_logit = label_logits[np.arange(positions.size), label_ids]
+    log_sum_exp = row_max + np.log(
+        np.exp(label_logits - row_max[:, None]).sum(axis=-1)
+    )
+    nll = float(np.sum(log_sum_exp - label_logit))
+
+    # a sample is correct when all of its label tokens are, samples without
+    # labels pad the last batch
+    sample_ids = positions // seq_len
+    num_labels = np.bincount(sample_ids, minlength=batch_size)
+    num_correct_labels = np.bincount(
+        sample_ids, weights=correct, minlength=batch_size
+    )
+    num_correct = int(np.sum((num_correct_labels == num_labels) & (num_labels > 0)))
+    return num_correct, nll, positions.size
+
+
+def forward_step(args, batch, model, eval_metric, callback):
+    """Launch the forward pass of a batch, `callback` is called with its
+    scores, or with the exception raised while scoring it."""
+
+    tokens, labels, attention_mask, position_ids, loss_mask = batch
+
+    if eval_metric in ("accuracy", "loss"):
+
+        def score(logits):
+            try:
+                result = score_label_positions(logits.numpy(), labels, loss_mask)
+            except Exception as e:
+                result = e
+            callback(result)
+
+        # Forward pass through the model.
+        model(tokens).async_get(score)
+        return
 
     raise NotImplementedError(
         "forward method for evaluation metric {} "
         "is not implemented.".format(eval_metric)
     )
 
-    return None
+
+class _BatchPrefetcher(object):
+    r"""Slice and process evaluation batches on a background thread
+
+    Args:
+        args: task arguments
+        data_sets: dataset whose slices are dicts of `text` and `pad_mask` arrays
+        num_batches: `Int` number of batches of `args.micro_batch_size` samples,
+            the last one is padded
+        prefetch: `Int` max number of batches assembled ahead
+    """
+
+    def __init__(self, args, data_sets, num_batches, prefetch):
+        assert prefetch > 0
+        self.args_ = args
+        self.data_sets_ = data_sets
+        self.num_batches_ = num_batches
+        self.ready_ = queue.Queue(maxsize=prefetch)
+        self.stop_ = threading.Event()
+        self.thread_ = threading.Thread(target=self._worker, daemon=True)
+        self.thread_.start()
+
+    def _worker(self):
+        batch_size = self.args_.micro_batch_size
+        try:
+            for iteration in range(self.num_batches_):
+                if self.stop_.is_set():
+                    break
+                start = iteration * batch_size
+                batch = self.data_sets_[start : start + batch_size]
+                num_pad = batch_size - len(batch["text"])
+                if num_pad > 0:
+                    # pad the last batch with samples without labels
+                    batch = {
+                        key: np.pad(value, ((0, num_pad), (0, 0)))
+                        for key, value in batch.items()
+                    }
+                self.ready_.put(process_batch(self.args_, batch))
+        except Exception as e:
+            self.ready_.put(e)
+
+    def next(self):
+        """Return the next processed batch, blocking until it is assembled."""
+        batch = self.ready_.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def close(self):
+        self.stop_.set()
+        while self.thread_.is_alive():
+            try:
+                self.ready_.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.thread_.join()
 
 
 def evaluate(args, data_sets, model, eval_metric):
     """Evaluation."""
-    total_output = 0.0
-
-    # For all the batches in the dataset.
-    for iteration in range(int(len(data_sets) / args.micro_batch_size)):
-        text = [
-            data_sets[iteration * args.micro_batch_size + i]["text"]
-            for i in range(args.micro_batch_size)
-        ]
-        text = np.stack(text)
-        pad_mask = [
-            data_sets[iteration * args.micro_batch_size + i]["pad_mask"]
-            for i in range(args.micro_batch_size)
-        ]
-        pad_mask = np.stack(pad_mask)
-        if iteration % args.log_interval == 0:
-            print("> working on iteration: {}".format(iteration))
-        # Forward evaluation.
-        output = forward_step(
-            args, {"text": text, "pad_mask": pad_mask}, model, eval_metric
-        )
-        total_output += output
+    num_batches = math.ceil(len(data_sets) / args.micro_batch_size)
+    num_inflight = args.eval_inflight_batches
+    assert num_inflight > 0
+    prefetcher = _BatchPrefetcher(
+        args, data_sets, num_batches, args.eval_prefetch_batches
+    )
 
-    return total_output
+    # batches launched and not yet scored, released by the callbacks
+    inflight = threading.Semaphore(num_inflight)
+    lock = threading.Lock()
+    totals = [0, 0.0, 0]
+    errors = []
+
+    def callback(result):
+        with lock:
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                for i, value in enumerate(result):
+                    totals[i] += value
+        inflight.release()
+
+    start_time = time.perf_counter()
+    try:
+        # For all the batches in the dataset.
+        for iteration in range(num_batches):
+            batch = prefetcher.next()
+            if iteration % args.log_interval == 0:
+                elapsed = time.perf_counter() - start_time
+                print(
+                    "> working on iteration: {} ({:.2f} samples/sec)".format(
+                        iteration,
+                        iteration * args.micro_batch_size / max(elapsed, 1e-6),
+                    )
+                )
+            inflight.acquire()
+            if errors:
+                inflight.release()
+                break
+            # Forward evaluation.
+            try:
+                forward_step(args, batch, model, eval_metric, callback)
+            except BaseException:
+                # not launched, its callback will never release the permit
+                inflight.release()
+                raise
+    finally:
+        prefetcher.close()
+        # wait for the batches still running
+        for _ in range(num_inflight):
+            inflight.acquire()
+
+    if errors:
+        raise errors[0]
+
+    elapsed = time.perf_counter() - start_time
+    num_samples = len(data_sets)
+    print(
+        " > evaluated {} samples in {:.2f} seconds ({:.2f} samples/sec)".format(
+            num_samples, elapsed, num_samples / max(elapsed, 1e-6)
+        )
+    )
+    return tuple(totals)
 
 
-def evaluate_and_print_results(args, data_sets, model, eval_metric):
+def evaluate_and_print_results(args, task, data_sets, model, eval_metric):
     """Evaluate and print results on screen."""
     # Evaluate and get results.
-    output = evaluate(args, data_sets, model, eval_metric)
-
-    string = " validation results on {} | ".format(args.task)
-    if eval_metric == "accuracy":
-        num_examples = (
-            int(len(data_sets) / args.micro_batch_size) * args.micro_batch_size
-        )
-        acc = output / num_examples
-        string += "number correct: {:.4E} | ".format(output)
+    num_correct, nll, num_tokens = evaluate(args, data_sets, model, eval_metric)
+
+    string = " validation results on {} | ".format(task)
+    if eval_metric == "loss":
+        avg_loss = nll / max(num_tokens, 1)
+        ppl = math.exp(min(20, avg_loss))
+        string += "avg loss: {:.4E} | ".format(avg_loss)
+        string += "ppl: {:.4E} | ".format(ppl)
+        string += "target tokens: {}".format(num_tokens)
+        print(string)
+    elif eval_metric == "accuracy":
+        num_examples = len(data_sets)
+        acc = num_correct / num_examples
+        ppl = math.exp(min(20, nll / max(num_tokens, 1)))
+        string += "number correct: {:.4E} | ".format(num_correct)
         string += "total examples: {:.4E} | ".format(num_examples)
-        string += "avg accuracy: {:.4E}".format(acc)
+        string += "avg accuracy: {:.4E} | ".format(acc)
+        string += "label perplexity: {:.4E}".format(ppl)
         print(string)
     else:
         raise NotImplementedError(
@@ -182,12 +322,11 @@ def evaluate_and_print_results(args, data_sets, model, eval_metric):
 def main(args):
     """Main program."""
 
-    if args.task == "LAMBADA":
-        eval_metric = "accuracy"
-    else:
-        raise NotImplementedError("{} task is not implemented.".format(args.task))
+    assert args.valid_data is not None and len(args.valid_data) == len(
+        args.task
+    ), "--valid-data needs one path per task of --task"
 
-    # Set up model and load checkpoint.
+    # Set up model and load checkpoint, once for all the tasks.
     _init_env(args)
     _init_config(args)
     gpt_eval = make_gpt_eval_func(args)
@@ -196,8 +335,11 @@ def main(args):
     assert args.load is not None
     check_point.load(args.load)
 
-    dataset = build_dataset(args)
-    # Run evaluation.
-    evaluate_and_print_results(args, dataset, gpt_eval, eval_metric)
+    for task, path in zip(args.task, args.valid_data):
+        dataset = build_dataset(args, task, path)
+        # Run evaluation.
+        evaluate_and_print_results(
+            args, task, dataset, gpt_eval, get_eval_metric(task)
+        )
 
     print("done :-)")
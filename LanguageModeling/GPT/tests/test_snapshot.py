@@ -0,0 +1,54 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+
+import numpy as np
+
+try:
+    import oneflow as flow
+    from oneflow_gpt import snapshot
+except ImportError:
+    flow = None
+
+
+@unittest.skipIf(
+    flow is None or not hasattr(flow, "checkpoint"), "oneflow is not available"
+)
+class TestWriteVariables(unittest.TestCase):
+    def setUp(self):
+        self.path_ = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path_)
+
+    def test_round_trip(self):
+        rng = np.random.RandomState(0)
+        variables = {
+            "model-wte": rng.randn(16, 8).astype(np.float32),
+            "model-h0-attn-c_attn-bias": rng.randn(24).astype(np.float16),
+            "System-Train-TrainStep": np.array([7], dtype=np.int64),
+        }
+        snapshot._write_variables(self.path_, variables)
+
+        loaded = flow.checkpoint.get(self.path_)
+        self.assertEqual(set(loaded.keys()), set(variables.keys()))
+        for name, value in variables.items():
+            blob = loaded[name].numpy()
+            self.assertEqual(blob.dtype, value.dtype)
+            np.testing.assert_array_equal(blob, value)
+
+    def test_unsupported_data_type(self):
+        variables = {"mask": np.zeros((2, 2), dtype=np.bool_)}
+        with self.assertRaises(ValueError):
+            snapshot._write_variables(self.path_, variables)
+        self.assertEqual(os.listdir(self.path_), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
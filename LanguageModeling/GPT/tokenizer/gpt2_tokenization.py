@@ -15,9 +15,13 @@
 
 import sys
 import json
+import heapq
 import logging
+import multiprocessing
 import os
+import numpy as np
 import regex as re
+from collections import OrderedDict, namedtuple
 from io import open
 
 try:
@@ -44,6 +48,9 @@ PRETRAINED_VOCAB_POSITIONAL_EMBEDDINGS_SIZE_MAP = {
 VOCAB_NAME = "vocab.json"
 MERGES_NAME = "merges.txt"
 SPECIAL_TOKENS_NAME = "special_tokens.txt"
+DEFAULT_CACHE_SIZE = 2 ** 18
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
 
 
 @lru_cache()
@@ -74,6 +81,31 @@ def bytes_to_unicode():
     return dict(zip(bs, cs))
 
 
+_ENCODE_WORKER_TOKENIZER = None
+
+
+def _init_encode_worker(tokenizer_cls, args, kwargs):
+    """Build the tokenizer of a pool worker from its files, so that the
+    parent's tokenizer and its bpe cache are not pickled to every worker."""
+    global _ENCODE_WORKER_TOKENIZER
+    _ENCODE_WORKER_TOKENIZER = tokenizer_cls(*args, **kwargs)
+
+
+def _encode_texts(tokenizer, texts):
+    """Return the flat ids of texts and the number of ids of every text."""
+    ids = []
+    lengths = np.empty(len(texts), dtype=np.int64)
+    for i, text in enumerate(texts):
+        text_ids = tokenizer.encode(text)
+        ids.extend(text_ids)
+        lengths[i] = len(text_ids)
+    return np.array(ids, dtype=np.int64), lengths
+
+
+def _encode_worker(texts):
+    return _encode_texts(_ENCODE_WORKER_TOKENIZER, texts)
+
+
 def get_pairs(word):
     """Return set of symbol pairs in a word.
 
@@ -87,6 +119,47 @@ def get_pairs(word):
     return pairs
 
 
+class LRUCache(object):
+    """Least recently used cache of at most `maxsize` entries, `None` for
+    unbounded, counting hits, misses and evictions."""
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.maxsize == 0:
+            return
+        self.data[key] = value
+        if self.maxsize is not None and len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.data.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        return CacheInfo(
+            self.hits, self.misses, self.evictions, self.maxsize, len(self.data)
+        )
+
+    def __len__(self):
+        return len(self.data)
+
+
 class GPT2Tokenizer(object):
     """
     GPT-2 BPE tokenizer. Peculiarities:
@@ -183,7 +256,11 @@ class GPT2Tokenizer(object):
         errors="replace",
         special_tokens=None,
         max_len=None,
+        cache_size=DEFAULT_CACHE_SIZE,
     ):
+        # to build the same tokenizer in encode_batch workers
+        self.init_args = (vocab_file, merges_file)
+        self.init_kwargs = dict(errors=errors, max_len=max_len, cache_size=cache_size)
         self.max_len = max_len if max_len is not None else int(1e12)
         self.encoder = json.load(open(vocab_file))
         self.decoder = {v: k for k, v in self.encoder.items()}
@@ -193,7 +270,7 @@ class GPT2Tokenizer(object):
         bpe_data = open(merges_file, encoding="utf-8").read().split("\n")[1:-1]
         bpe_merges = [tuple(merge.split()) for merge in bpe_data]
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        self.cache = LRUCache(cache_size)
 
         # Should haved added re.IGNORECASE so BPE merges can happen for
         # capitalized versions of contractions
@@ -208,6 +285,10 @@ class GPT2Tokenizer(object):
     def __len__(self):
         return len(self.encoder) + len(self.special_tokens)
 
+    def cache_info(self):
+        """Hit, miss and eviction counts and size of the bpe cache."""
+        return self.cache.info()
+
     def set_special_tokens(self, special_tokens):
         """ Add a list of additional tokens to the encoder.
             The additional tokens are indexed starting from the last index of the
@@ -224,44 +305,54 @@ class GPT2Tokenizer(object):
         logger.info("Special tokens {}".format(self.special_tokens))
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
-
-        if not pairs:
+        # single characters have nothing to merge, keep them out of the cache
+        if len(token) < 2:
             return token
-
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float("inf")))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except BaseException:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = " ".join(word)
-        self.cache[token] = word
+        word = self.cache.get(token)
+        if word is not None:
+            return word
+        word = list(token)
+
+        # Symbols form a doubly linked list over `word`, merged symbols are
+        # set to None. Candidate merges are kept in a heap ordered by
+        # (rank, position): a merge only creates pairs of higher rank, so
+        # this applies the same merges in the same order as repeatedly
+        # merging every occurrence of the lowest ranked pair.
+        bpe_ranks = self.bpe_ranks
+        prev_idx = list(range(-1, len(word) - 1))
+        next_idx = list(range(1, len(word) + 1))
+        next_idx[-1] = -1
+        heap = []
+        for i in range(len(word) - 1):
+            rank = bpe_ranks.get((word[i], word[i + 1]))
+            if rank is not None:
+                heap.append((rank, i))
+        heapq.heapify(heap)
+
+        while heap:
+            rank, i = heapq.heappop(heap)
+            j = next_idx[i]
+            # skip pairs changed by an earlier merge
+            if word[i] is None or j == -1 or bpe_ranks.get((word[i], word[j])) != rank:
+                continue
+
+            word[i] += word[j]
+            word[j] = None
+            next_idx[i] = next_idx[j]
+            if next_idx[j] != -1:
+                prev_idx[next_idx[j]] = i
+
+            if prev_idx[i] != -1:
+                rank = bpe_ranks.get((word[prev_idx[i]], word[i]))
+                if rank is not None:
+                    heapq.heappush(heap, (rank, prev_idx[i]))
+            if next_idx[i] != -1:
+                rank = bpe_ranks.get((word[i], word[next_idx[i]]))
+                if rank is not None:
+                    heapq.heappush(heap, (rank, i))
+
+        word = " ".join(symbol for symbol in word if symbol is not None)
+        self.cache.put(token, word)
         return word
 
     def tokenize(self, text):
@@ -314,6 +405,32 @@ class GPT2Tokenizer(object):
     def encode(self, text):
         return self.convert_tokens_to_ids(self.tokenize(text))
 
+    def encode_batch(self, texts, num_workers=1, chunk_size=64):
+        """Encode texts in a pool of num_workers processes, dispatching chunks
+        of chunk_size texts and keeping the input order.
+
+        Returns (ids, offsets), int64 arrays where the ids of texts[i] are
+        ids[offsets[i]:offsets[i + 1]].
+        """
+        chunks = [texts[i : i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        if num_workers > 1 and len(chunks) > 1:
+            kwargs = dict(self.init_kwargs, special_tokens=list(self.special_tokens))
+            with multiprocessing.Pool(
+                num_workers,
+                initializer=_init_encode_worker,
+                initargs=(type(self), self.init_args, kwargs),
+            ) as pool:
+                results = list(pool.imap(_encode_worker, chunks))
+        else:
+            results = [_encode_texts(self, chunk) for chunk in chunks]
+
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        if not results:
+            return np.zeros(0, dtype=np.int64), offsets
+        ids, lengths = zip(*results)
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+        return np.concatenate(ids), offsets
+
     def decode(self, tokens):
         text = "".join([self.decoder[token] for token in tokens])
         text = bytearray([self.byte_decoder[c] for c in text]).decode(
@@ -16,7 +16,7 @@
 from abc import ABC
 from abc import abstractmethod
 import math
-from .gpt2_tokenization import GPT2Tokenizer
+from .gpt2_tokenization import GPT2Tokenizer, DEFAULT_CACHE_SIZE
 
 
 def build_tokenizer(args):
@@ -27,7 +27,11 @@ def build_tokenizer(args):
     assert args.merge_file is not None
     if args.tokenizer_type == "GPT2BPETokenizer":
 
-        tokenizer = _GPT2BPETokenizer(args.vocab_file, args.merge_file)
+        tokenizer = _GPT2BPETokenizer(
+            args.vocab_file,
+            args.merge_file,
+            cache_size=getattr(args, "tokenizer_cache_size", DEFAULT_CACHE_SIZE),
+        )
     else:
         raise NotImplementedError(
             "{} tokenizer is not " "implemented.".format(args.tokenizer_type)
@@ -138,12 +142,17 @@ class AbstractTokenizer(ABC):
 class _GPT2BPETokenizer(AbstractTokenizer):
     """Original GPT2 BPE tokenizer."""
 
-    def __init__(self, vocab_file, merge_file):
+    def __init__(self, vocab_file, merge_file, cache_size=DEFAULT_CACHE_SIZE):
         name = "GPT2 BPE"
         super().__init__(name)
 
         self.tokenizer = GPT2Tokenizer(
-            vocab_file, merge_file, errors="replace", special_tokens=[], max_len=None
+            vocab_file,
+            merge_file,
+            errors="replace",
+            special_tokens=[],
+            max_len=None,
+            cache_size=cache_size,
         )
         self.eod_id = self.tokenizer.encoder["<|endoftext|>"]
 
@@ -162,9 +171,16 @@ class _GPT2BPETokenizer(AbstractTokenizer):
     def tokenize(self, text):
         return self.tokenizer.encode(text)
 
+    def tokenize_batch(self, texts, num_workers=1):
+        """Returns (ids, offsets), see GPT2Tokenizer.encode_batch."""
+        return self.tokenizer.encode_batch(texts, num_workers=num_workers)
+
     def detokenize(self, token_ids):
         return self.tokenizer.decode(token_ids)
 
+    def cache_info(self):
+        return self.tokenizer.cache_info()
+
     @property
     def eod(self):
         return self.eod_id
@@ -0,0 +1,190 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+
+from oneflow_gpt.third_party.data.gpt_dataset import GPTDataset, _build_sample_idx
+from oneflow_gpt.third_party.data.indexed_dataset import (
+    MMapIndexedDataset,
+    data_file_path,
+    index_file_path,
+    make_dataset,
+)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="OneFlow GPT dataset benchmark")
+    parser.add_argument(
+        "--bench",
+        type=str,
+        default="sample_idx",
+        choices=["sample_idx", "get_batch"],
+        help="which benchmark to run",
+    )
+    parser.add_argument("--seq-length", type=int, default=1024)
+    parser.add_argument("--num-epochs", type=int, default=1)
+    parser.add_argument(
+        "--num-docs",
+        type=str,
+        default="10000,100000,1000000,10000000",
+        help="comma separated corpus sizes in number of documents",
+    )
+    parser.add_argument(
+        "--mean-doc-length", type=int, default=512, help="mean tokens per document"
+    )
+    parser.add_argument(
+        "--verify-max-docs",
+        type=int,
+        default=100000,
+        help="check against the reference loop for corpora up to this size",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=32, help="batch size of get_batch bench"
+    )
+    parser.add_argument(
+        "--num-batches", type=int, default=200, help="number of get_batch batches"
+    )
+    parser.add_argument("--seed", type=int, default=1234)
+    return parser.parse_args()
+
+
+def _reference_build_sample_idx(sizes, doc_idx, seq_length, num_epochs, tokens_per_epoch):
+    """The original pure python implementation, used to verify the output."""
+    num_samples = (num_epochs * tokens_per_epoch - 1) // seq_length
+    sample_idx = np.zeros([num_samples + 1, 2], dtype=np.int32)
+
+    sample_index = 0
+    doc_idx_index = 0
+    doc_offset = 0
+    sample_idx[sample_index][0] = doc_idx_index
+    sample_idx[sample_index][1] = doc_offset
+    sample_index += 1
+    while sample_index <= num_samples:
+        remaining_seq_length = seq_length + 1
+        while remaining_seq_length != 0:
+            doc_id = doc_idx[doc_idx_index]
+            doc_length = sizes[doc_id] - doc_offset
+            remaining_seq_length -= doc_length
+            if remaining_seq_length <= 0:
+                doc_offset += remaining_seq_length + doc_length - 1
+                remaining_seq_length = 0
+            else:
+                doc_idx_index += 1
+                doc_offset = 0
+        sample_idx[sample_index][0] = doc_idx_index
+        sample_idx[sample_index][1] = doc_offset
+        sample_index += 1
+
+    return sample_idx
+
+
+def _make_corpus(num_docs, num_epochs, mean_doc_length, rng):
+    sizes = rng.geometric(1.0 / mean_doc_length, size=num_docs).astype(np.int32)
+    # some empty documents to cover the corner case
+    sizes[rng.randint(0, num_docs, size=max(num_docs // 100, 1))] = 0
+    doc_idx = np.tile(np.arange(num_docs, dtype=np.int32), num_epochs)
+    rng.shuffle(doc_idx)
+    tokens_per_epoch = int(np.sum(sizes))
+    return sizes, doc_idx, tokens_per_epoch
+
+
+def bench_sample_idx(args):
+    rng = np.random.RandomState(args.seed)
+    print(
+        f"| {'docs'.ljust(10)} | {'tokens'.ljust(14)} | {'samples'.ljust(12)} "
+        f"| {'build(s)'.ljust(10)} | {'reference(s)'.ljust(12)} | {'verified'.ljust(8)} |"
+    )
+    print(f"| {'-' * 10} | {'-' * 14} | {'-' * 12} | {'-' * 10} | {'-' * 12} | {'-' * 8} |")
+    for num_docs in map(int, args.num_docs.split(",")):
+        sizes, doc_idx, tokens_per_epoch = _make_corpus(
+            num_docs, args.num_epochs, args.mean_doc_length, rng
+        )
+
+        start = time.perf_counter()
+        sample_idx = _build_sample_idx(
+            sizes, doc_idx, args.seq_length, args.num_epochs, tokens_per_epoch
+        )
+        elapsed = time.perf_counter() - start
+
+        ref_elapsed = "-"
+        verified = "-"
+        if num_docs <= args.verify_max_docs:
+            start = time.perf_counter()
+            ref = _reference_build_sample_idx(
+                sizes, doc_idx, args.seq_length, args.num_epochs, tokens_per_epoch
+            )
+            ref_elapsed = f"{time.perf_counter() - start:.4f}"
+            verified = str(np.array_equal(ref, sample_idx))
+
+        print(
+            f"| {num_docs:<10d} | {tokens_per_epoch * args.num_epochs:<14d} "
+            f"| {sample_idx.shape[0] - 1:<12d} | {elapsed:<10.4f} "
+            f"| {ref_elapsed:<12} | {verified:<8} |"
+        )
+
+
+def _make_mmap_dataset(prefix, sizes, rng):
+    tokens = rng.randint(0, 50257, size=int(np.sum(sizes))).astype(np.uint16)
+    with open(data_file_path(prefix), "wb") as f:
+        f.write(tokens.tobytes(order="C"))
+    with MMapIndexedDataset.Index.writer(index_file_path(prefix), np.uint16) as index:
+        index.write(sizes, list(range(len(sizes) + 1)))
+    return make_dataset(prefix, "mmap", skip_warmup=True)
+
+
+def bench_get_batch(args):
+    rng = np.random.RandomState(args.seed)
+    num_docs = int(args.num_docs.split(",")[0])
+    sizes = rng.geometric(1.0 / args.mean_doc_length, size=num_docs).astype(np.int32)
+    num_samples = args.batch_size * args.num_batches
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prefix = os.path.join(tmp_dir, "bench")
+        indexed_dataset = _make_mmap_dataset(prefix, sizes, rng)
+        documents = np.arange(num_docs, dtype=np.int32)
+        dataset = GPTDataset(
+            "bench",
+            prefix,
+            documents,
+            indexed_dataset,
+            num_samples,
+            args.seq_length,
+            args.seed,
+        )
+
+        start = time.perf_counter()
+        for i in range(args.num_batches):
+            batch = [dataset[i * args.batch_size + j] for j in range(args.batch_size)]
+            ref = np.stack(batch)
+        per_item_elapsed = time.perf_counter() - start
+
+        out = np.empty((args.batch_size, args.seq_length + 1), dtype=np.int64)
+        start = time.perf_counter()
+        for i in range(args.num_batches):
+            indices = np.arange(i * args.batch_size, (i + 1) * args.batch_size)
+            dataset.get_batch(indices, out=out)
+        get_batch_elapsed = time.perf_counter() - start
+
+        verified = np.array_equal(ref, out)
+        del dataset, indexed_dataset
+
+    print(f"| {'path'.ljust(10)} | {'samples/sec'.ljust(12)} |")
+    print(f"| {'-' * 10} | {'-' * 12} |")
+    print(f"| {'per-item'.ljust(10)} | {num_samples / per_item_elapsed:<12.1f} |")
+    print(f"| {'get_batch'.ljust(10)} | {num_samples / get_batch_elapsed:<12.1f} |")
+    print(f"verified: {verified}")
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.bench == "sample_idx":
+        bench_sample_idx(args)
+    elif args.bench == "get_batch":
+        bench_get_batch(args)
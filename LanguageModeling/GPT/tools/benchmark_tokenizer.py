@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+
+import regex as re
+
+from tokenizer.gpt2_tokenization import DEFAULT_CACHE_SIZE, GPT2Tokenizer, get_pairs
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="OneFlow GPT tokenizer benchmark")
+    parser.add_argument(
+        "--input",
+        type=str,
+        required=True,
+        help="sample corpus, loose json with one document per line or plain text",
+    )
+    parser.add_argument(
+        "--json-key", type=str, default="text", help="key of the text in json lines"
+    )
+    parser.add_argument("--vocab-file", type=str, required=True)
+    parser.add_argument("--merge-file", type=str, required=True)
+    parser.add_argument(
+        "--max-docs", type=int, default=10000, help="number of documents to tokenize"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help="max entries of the bpe cache",
+    )
+    parser.add_argument(
+        "--no-verify",
+        action="store_true",
+        help="skip the reference tokenizer and the output comparison",
+    )
+    return parser.parse_args()
+
+
+def _reference_bpe(tokenizer, token):
+    """The original implementation of GPT2Tokenizer.bpe, without cache."""
+    word = tuple(token)
+    pairs = get_pairs(word)
+
+    if not pairs:
+        return token
+
+    while True:
+        bigram = min(pairs, key=lambda pair: tokenizer.bpe_ranks.get(pair, float("inf")))
+        if bigram not in tokenizer.bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except BaseException:
+                new_word.extend(word[i:])
+                break
+
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        new_word = tuple(new_word)
+        word = new_word
+        if len(word) == 1:
+            break
+        else:
+            pairs = get_pairs(word)
+    return " ".join(word)
+
+
+def _load_docs(path, json_key, max_docs):
+    docs = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if len(docs) == max_docs:
+                break
+            try:
+                docs.append(json.loads(line)[json_key])
+            except (ValueError, TypeError, KeyError):
+                docs.append(line)
+    return docs
+
+
+def _pretokenize(tokenizer, docs):
+    """Split docs into the byte encoded words bpe is called on."""
+    words = []
+    for doc in docs:
+        for token in re.findall(tokenizer.pat, doc):
+            words.append(
+                "".join(tokenizer.byte_encoder[b] for b in token.encode("utf-8"))
+            )
+    return words
+
+
+def _bench(bpe, words):
+    start = time.perf_counter()
+    outputs = [bpe(word) for word in words]
+    return outputs, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    args = get_args()
+    tokenizer = GPT2Tokenizer(
+        args.vocab_file,
+        args.merge_file,
+        errors="replace",
+        special_tokens=[],
+        cache_size=args.cache_size,
+    )
+    docs = _load_docs(args.input, args.json_key, args.max_docs)
+    words = _pretokenize(tokenizer, docs)
+    unique_words = list(set(words))
+    num_bytes = sum(len(doc.encode("utf-8")) for doc in docs)
+    print(
+        f"{len(docs)} documents, {num_bytes / 1e6:.2f} MB, {len(words)} words,"
+        f" {len(unique_words)} unique, max word length"
+        f" {max(map(len, unique_words), default=0)}"
+    )
+
+    # bpe without the cache, every unique word once
+    print(f"| {'bpe'.ljust(10)} | {'words/sec'.ljust(12)} | {'seconds'.ljust(10)} |")
+    print(f"| {'-' * 10} | {'-' * 12} | {'-' * 10} |")
+    tokenizer.cache.clear()
+    outputs, elapsed = _bench(tokenizer.bpe, unique_words)
+    print(f"| {'heap'.ljust(10)} | {len(unique_words) / elapsed:<12.1f} | {elapsed:<10.4f} |")
+    if not args.no_verify:
+        ref_outputs, ref_elapsed = _bench(
+            lambda word: _reference_bpe(tokenizer, word), unique_words
+        )
+        print(
+            f"| {'reference'.ljust(10)} | {len(unique_words) / ref_elapsed:<12.1f}"
+            f" | {ref_elapsed:<10.4f} |"
+        )
+        print(f"verified: {outputs == ref_outputs}")
+
+    # end to end encode, with the cache
+    tokenizer.cache.clear()
+    start = time.perf_counter()
+    num_tokens = sum(len(tokenizer.encode(doc)) for doc in docs)
+    elapsed = time.perf_counter() - start
+    print(
+        f"encode: {len(docs) / elapsed:.1f} docs/s, {num_tokens / elapsed:.1f} tokens/s,"
+        f" {num_bytes / 1e6 / elapsed:.2f} MB/s"
+    )
+    print(f"cache: {tokenizer.cache_info()}")
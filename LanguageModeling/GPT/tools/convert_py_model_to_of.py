@@ -1,10 +1,18 @@
 import argparse
+import glob
 import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import torch
 import meta_pb2 as meta_pb
 
 
+# bytes of a constant buffer written repeatedly for constant blobs
+_WRITE_CHUNK_SIZE = 1 << 22
+
+
 def get_args():
 
     parser = argparse.ArgumentParser()
@@ -14,7 +22,8 @@ def get_args():
         "--py_model_dir",
         type=str,
         default="/path/to/iter_0500000/mp_rank_00/model_optim_rng.pt",
-        help="Path the PyTorch checkpoint file path.",
+        help="Path the PyTorch checkpoint file path, or the directory of its"
+        " mp_rank_XX tensor parallel shards.",
     )
     parser.add_argument(
         "--of_dump_path",
@@ -22,88 +31,215 @@ def get_args():
         default="./convert_pt_to_of_gpt_release",
         help="Path to the output OneFlow model.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of threads converting tensors in parallel.",
+    )
+    parser.add_argument(
+        "--vocab_size",
+        type=int,
+        default=None,
+        help="Vocab size of the tokenizer, word embeddings are re-padded for"
+        " the target model when set, otherwise kept as in the checkpoint.",
+    )
+    parser.add_argument(
+        "--make_vocab_size_divisible_by",
+        type=int,
+        default=128,
+        help="Same as --make-vocab-size-divisible-by of the target model.",
+    )
+    parser.add_argument(
+        "--target_tensor_model_parallel_size",
+        type=int,
+        default=1,
+        help="Tensor model parallel size of the target model.",
+    )
 
     return parser.parse_args()
 
 
-def _SaveWeightBlob2File(blob, op_name, save_path, var="out", meta="meta"):
-    folder = os.path.join(save_path, op_name)
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-    filename = os.path.join(folder, var)
-    f = open(filename, "wb")
-    f.write(blob.tobytes())
+def _load_state_dict(path):
+    try:
+        # tensors are read from the file as they are accessed
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.1 or legacy (non zip) checkpoint format
+        return torch.load(path, map_location="cpu")
+
+
+def _find_shards(py_model_dir):
+    if os.path.isfile(py_model_dir):
+        return [py_model_dir]
+
+    shards = sorted(
+        glob.glob(os.path.join(py_model_dir, "mp_rank_*", "model_optim_rng.pt"))
+    )
+    assert len(shards) > 0, f"no mp_rank_XX/model_optim_rng.pt in {py_model_dir}"
+    return shards
+
+
+def _op_name(model_key):
+    op_name_list = model_key.split(".")
+    if "layers." in model_key:
+        op_name = model_key.replace("layers.", "model-")
+        op_name = op_name.replace(
+            "-%s." % (op_name_list[1]), "-h%s-" % (op_name_list[1])
+        )
+    else:
+        op_name = model_key.replace("final_layernorm.", "model-layernorm_f-")
+    op_name = op_name.replace("input_layernorm.", "layernorm_1-")
+    op_name = op_name.replace("post_attention_layernorm.", "layernorm_2-")
+    # self_attention. of the encoder format, attention. of the transformer one
+    op_name = op_name.replace("self_attention.", "attn-")
+    op_name = op_name.replace("attention.", "attn-")
+    op_name = op_name.replace("query_key_value.", "c_attn-")
+    op_name = op_name.replace("dense.", "c_proj-")
+    op_name = op_name.replace("mlp.dense_h_to_4h.", "mlp-c_fc-")
+    op_name = op_name.replace("mlp.dense_4h_to_h.", "mlp-c_proj-")
+
+    if "layernorm_1" in op_name or "layernorm_2" in op_name or "layernorm_f" in op_name:
+        op_name = op_name.replace("-weight", "-gamma")
+        op_name = op_name.replace("-bias", "-beta")
+
+    if "." in op_name:
+        raise ValueError(f"unknown checkpoint key {model_key}")
+    return op_name
+
+
+def _tensor_parallel_axis(model_key):
+    """Axis Megatron splits a tensor along across tensor parallel ranks,
+    None if the tensor is replicated."""
+    if model_key == "word_embeddings":
+        # VocabParallelEmbedding
+        return 0
+    if "query_key_value." in model_key or "dense_h_to_4h." in model_key:
+        # ColumnParallelLinear weight and bias
+        return 0
+    if model_key.endswith("attention.dense.weight") or model_key.endswith(
+        "dense_4h_to_h.weight"
+    ):
+        # RowParallelLinear weight
+        return 1
+    return None
+
+
+def _write_meta(folder, shape, meta="meta"):
     meta_info = meta_pb.Meta()
-    meta_info.shape.dim[:] = blob.shape
+    meta_info.shape.dim[:] = shape
     meta_info.data_type = meta_pb.kFloat
-    filename = os.path.join(folder, meta)
-    f = open(filename, "w")
-    f.write(str(meta_info))
-    f.close()
-    np.save(filename, blob)
+    with open(os.path.join(folder, meta), "w") as f:
+        f.write(str(meta_info))
 
 
-def _SaveWeightBlob2FileExtend(blob, op_name, save_path, var="out", meta="meta"):
-    _SaveWeightBlob2File(blob.numpy(), op_name, save_path, var=var, meta=meta)
-    _SaveWeightBlob2File(
-        np.ones_like(blob), op_name + "-v", save_path, var=var, meta=meta
-    )
-    _SaveWeightBlob2File(
-        np.zeros_like(blob), op_name + "-m", save_path, var=var, meta=meta
-    )
+def _write_blob(blob, op_name, save_path, var="out"):
+    folder = os.path.join(save_path, op_name)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, var), "wb") as f:
+        f.write(memoryview(np.ascontiguousarray(blob, dtype=np.float32)).cast("B"))
+    _write_meta(folder, blob.shape)
 
 
-def convert(args):
-    path = args.py_model_dir
-    state_dict = torch.load(path, map_location="cpu")
-    for model_key, model_value in state_dict["model"]["language_model"][
-        "transformer"
-    ].items():
-        if len(model_value.shape) > 1:
-            model_value = torch.transpose(model_value, 0, 1)
-        model_value = model_value.float()
-        op_name_list = model_key.split(".")
-        if "layers." in model_key:
-            op_name = model_key.replace("layers.", "model-")
-            op_name = op_name.replace(
-                "-%s." % (op_name_list[1]), "-h%s-" % (op_name_list[1])
-            )
+def _write_constant_blob(value, shape, op_name, save_path, var="out"):
+    """Write a float32 blob filled with `value` without allocating it, zeros
+    are written as a sparse file."""
+    folder = os.path.join(save_path, op_name)
+    os.makedirs(folder, exist_ok=True)
+    num_bytes = int(np.prod(shape, dtype=np.int64)) * 4
+    with open(os.path.join(folder, var), "wb") as f:
+        if value == 0:
+            f.truncate(num_bytes)
         else:
-            op_name = model_key.replace("final_layernorm.", "model-layernorm_f-")
-        op_name = op_name.replace("input_layernorm.", "layernorm_1-")
-        op_name = op_name.replace("post_attention_layernorm.", "layernorm_2-")
-        op_name = op_name.replace("attention.", "attn-")
-        op_name = op_name.replace("query_key_value.", "c_attn-")
-        op_name = op_name.replace("dense.", "c_proj-")
-        op_name = op_name.replace("mlp.dense_h_to_4h.", "mlp-c_fc-")
-        op_name = op_name.replace("mlp.dense_4h_to_h.", "mlp-c_proj-")
-
-        if (
-            "layernorm_1" in op_name
-            or "layernorm_2" in op_name
-            or "layernorm_f" in op_name
-        ):
-            op_name = op_name.replace("-weight", "-gamma")
-            op_name = op_name.replace("-bias", "-beta")
-
-        print(model_key, "-" * 8, op_name)
-        _SaveWeightBlob2FileExtend(model_value, op_name, args.of_dump_path)
-
-    _SaveWeightBlob2FileExtend(
-        state_dict["model"]["language_model"]["embedding"]["position_embeddings"][
-            "weight"
-        ].float(),
-        "model-wpe",
-        args.of_dump_path,
+            chunk = memoryview(
+                np.full(min(num_bytes, _WRITE_CHUNK_SIZE) // 4, value, np.float32)
+            ).cast("B")
+            for start in range(0, num_bytes, len(chunk)):
+                f.write(chunk[: num_bytes - start])
+    _write_meta(folder, shape)
+
+
+def _pad_vocab_size(vocab_size, alignment, tensor_model_parallel_size):
+    if alignment == 0:
+        return vocab_size
+    alignment *= tensor_model_parallel_size
+    return int(math.ceil(vocab_size / alignment)) * alignment
+
+
+def _convert_tensor(args, model_key, op_name, shard_tensors, padded_vocab_size=None):
+    """Merge the tensor parallel shards of one tensor and write it with its
+    optimizer moments, only this tensor is materialized."""
+    blobs = [t.float().numpy() for t in shard_tensors]
+    axis = _tensor_parallel_axis(model_key)
+    if len(blobs) == 1 or axis is None:
+        blob = blobs[0]
+    else:
+        blob = np.concatenate(blobs, axis=axis)
+    del blobs
+
+    if padded_vocab_size is not None and blob.shape[0] != padded_vocab_size:
+        # the padded rows are never looked up, keep them zero
+        rows = min(blob.shape[0], padded_vocab_size)
+        padded = np.zeros((padded_vocab_size, blob.shape[1]), dtype=np.float32)
+        padded[:rows] = blob[:rows]
+        blob = padded
+
+    if blob.ndim > 1 and model_key not in ("word_embeddings", "position_embeddings"):
+        blob = blob.T
+
+    _write_blob(blob, op_name, args.of_dump_path)
+    _write_constant_blob(1.0, blob.shape, op_name + "-v", args.of_dump_path)
+    _write_constant_blob(0.0, blob.shape, op_name + "-m", args.of_dump_path)
+    print(model_key, "-" * 8, op_name, blob.shape)
+
+
+def convert(args):
+    shards = _find_shards(args.py_model_dir)
+    print(f"converting {len(shards)} tensor parallel shards")
+    language_models = [
+        _load_state_dict(path)["model"]["language_model"] for path in shards
+    ]
+    transformers = [
+        lm["transformer"] if "transformer" in lm else lm["encoder"]
+        for lm in language_models
+    ]
+    embeddings = [lm["embedding"] for lm in language_models]
+
+    padded_vocab_size = None
+    if args.vocab_size is not None:
+        padded_vocab_size = _pad_vocab_size(
+            args.vocab_size,
+            args.make_vocab_size_divisible_by,
+            args.target_tensor_model_parallel_size,
+        )
+
+    jobs = [
+        (model_key, _op_name(model_key), [t[model_key] for t in transformers], None)
+        for model_key in transformers[0].keys()
+    ]
+    jobs.append(
+        (
+            "position_embeddings",
+            "model-wpe",
+            [e["position_embeddings"]["weight"] for e in embeddings],
+            None,
+        )
     )
-    _SaveWeightBlob2FileExtend(
-        state_dict["model"]["language_model"]["embedding"]["word_embeddings"][
-            "weight"
-        ].float(),
-        "model-wte",
-        args.of_dump_path,
+    jobs.append(
+        (
+            "word_embeddings",
+            "model-wte",
+            [e["word_embeddings"]["weight"] for e in embeddings],
+            padded_vocab_size,
+        )
     )
 
+    os.makedirs(args.of_dump_path, exist_ok=True)
+    with ThreadPoolExecutor(args.workers) as executor:
+        futures = [executor.submit(_convert_tensor, args, *job) for job in jobs]
+        for future in futures:
+            future.result()
+
 
 if __name__ == "__main__":
     args = get_args()
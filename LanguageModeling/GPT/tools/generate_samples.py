@@ -0,0 +1,166 @@
+"""Generate text from prompts with key/value cached incremental decoding.
+
+Every line of --prompt-file is a prompt, prompts are decoded in batches of
+--micro-batch-size and the generated texts are written as json lines.
+"""
+import os
+import sys
+import json
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+
+import numpy as np
+import oneflow as flow
+
+from oneflow_gpt.config import get_args
+
+
+def get_generation_args(parser):
+    group = parser.add_argument_group(title="text generation")
+    group.add_argument(
+        "--prompt-file", type=str, required=True, help="Text file, one prompt per line."
+    )
+    group.add_argument(
+        "--output-file",
+        type=str,
+        default=None,
+        help="Json lines file of the generated texts, defaults to stdout.",
+    )
+    group.add_argument(
+        "--max-new-tokens",
+        type=int,
+        default=64,
+        help="Max number of tokens generated per prompt.",
+    )
+    group.add_argument(
+        "--prompt-length",
+        type=int,
+        default=None,
+        help="Length prompts are left padded to, longer prompts keep their last "
+        "tokens. Defaults to seq_length - max_new_tokens.",
+    )
+    group.add_argument("--greedy", action="store_true", help="Use greedy sampling.")
+    group.add_argument(
+        "--top-k", type=int, default=0, help="Top k sampling, 0 to disable."
+    )
+    group.add_argument(
+        "--top-p", type=float, default=0.0, help="Top p sampling, 0 to disable."
+    )
+    group.add_argument(
+        "--temperature", type=float, default=1.0, help="Sampling temperature."
+    )
+    group.add_argument(
+        "--device",
+        type=str,
+        default="gpu",
+        choices=["gpu", "cpu"],
+        help="Device to generate on.",
+    )
+    parser.add_argument(
+        "--vocab-file", type=str, default=None, help="Path to the vocab file."
+    )
+    parser.add_argument(
+        "--merge-file", type=str, default=None, help="Path to the BPE merge file."
+    )
+    parser.add_argument(
+        "--tokenizer-type",
+        type=str,
+        default="GPT2BPETokenizer",
+        choices=["GPT2BPETokenizer"],
+        help="What type of tokenizer to use.",
+    )
+    return parser
+
+
+def _init_config(args):
+    if args.device == "cpu":
+        flow.config.gpu_device_num(0)
+        flow.config.cpu_device_num(1)
+    else:
+        flow.config.gpu_device_num(1)
+
+    flow.config.enable_legacy_model_io()
+    flow.config.enable_model_io_v2(True)
+
+
+def main():
+    args = get_args(extra_args_provider=get_generation_args)
+    # the model module reads the parsed args on import
+    from oneflow_gpt.generation import Generator
+    from tokenizer.tokenizer import build_tokenizer
+
+    flow.env.log_dir(args.log)
+    _init_config(args)
+    tokenizer = build_tokenizer(args)
+    prompt_length = args.prompt_length or args.seq_length - args.max_new_tokens
+    generator = Generator(
+        "model",
+        args.micro_batch_size,
+        prompt_length,
+        args.max_new_tokens,
+        device=args.device,
+    )
+
+    if args.load is not None:
+        flow.train.CheckPoint().load(args.load)
+    else:
+        print("WARNING: --load is not set, generating with random weights")
+
+    with open(args.prompt_file, "r") as f:
+        prompts = [line.rstrip("\n") for line in f if line.strip()]
+
+    rng = np.random.RandomState(args.seed)
+    out = sys.stdout if args.output_file is None else open(args.output_file, "w")
+    total_tokens = 0
+    total_elapsed = 0.0
+    total_ttft = 0.0
+    num_batches = 0
+    for start in range(0, len(prompts), args.micro_batch_size):
+        batch = prompts[start : start + args.micro_batch_size]
+        prompt_ids = [
+            tokenizer.tokenize(prompt)[-prompt_length:] or [tokenizer.eod]
+            for prompt in batch
+        ]
+        results, stats = generator.generate(
+            prompt_ids,
+            eod=tokenizer.eod,
+            vocab_size=tokenizer.vocab_size,
+            greedy=args.greedy,
+            top_k=args.top_k,
+            top_p=args.top_p,
+            temperature=args.temperature,
+            rng=rng,
+        )
+        for prompt, new_tokens in zip(batch, results):
+            out.write(
+                json.dumps({"prompt": prompt, "text": tokenizer.detokenize(new_tokens)})
+                + "\n"
+            )
+        out.flush()
+
+        print(
+            f"> batch {num_batches}: {len(batch)} prompts,"
+            f" time to first token {stats['time_to_first_token'] * 1000:.1f} ms,"
+            f" {stats['num_tokens']} tokens in {stats['elapsed']:.2f} s"
+            f" ({stats['tokens_per_sec']:.1f} tokens/s)",
+            file=sys.stderr,
+        )
+        total_tokens += stats["num_tokens"]
+        total_elapsed += stats["elapsed"]
+        total_ttft += stats["time_to_first_token"]
+        num_batches += 1
+
+    if out is not sys.stdout:
+        out.close()
+    print(
+        f"> generated {total_tokens} tokens for {len(prompts)} prompts,"
+        f" {total_tokens / max(total_elapsed, 1e-6):.1f} tokens/s,"
+        f" avg time to first token {total_ttft / max(num_batches, 1) * 1000:.1f} ms",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""Tokenize a loose json corpus into MMapIndexedDataset .bin/.idx files.
+
+Each line of the input is a json object, the text under every --json-keys
+key becomes one document. The input is split into byte ranges which are
+tokenized by a pool of workers, every worker streams its range into its
+own shard and the shards are merged in input order at the end.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+
+from tokenizer.tokenizer import build_tokenizer
+from tokenizer.gpt2_tokenization import DEFAULT_CACHE_SIZE
+from oneflow_gpt.third_party.data import indexed_dataset
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="OneFlow GPT data preprocessing")
+    group = parser.add_argument_group(title="input data")
+    group.add_argument(
+        "--input", type=str, required=True, help="Path to input JSON (one doc per line)"
+    )
+    group.add_argument(
+        "--json-keys",
+        nargs="+",
+        default=["text"],
+        help="space separate listed of keys to extract from json",
+    )
+
+    group = parser.add_argument_group(title="tokenizer")
+    group.add_argument(
+        "--tokenizer-type",
+        type=str,
+        default="GPT2BPETokenizer",
+        choices=["GPT2BPETokenizer"],
+        help="What type of tokenizer to use.",
+    )
+    group.add_argument(
+        "--vocab-file", type=str, required=True, help="Path to the vocab file"
+    )
+    group.add_argument(
+        "--merge-file", type=str, required=True, help="Path to the BPE merge file."
+    )
+    group.add_argument(
+        "--tokenizer-cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help="Max number of words kept in the bpe cache of every worker.",
+    )
+    group.add_argument(
+        "--append-eod",
+        action="store_true",
+        default=True,
+        help="Append an <eod> token to the end of a document, the default.",
+    )
+    group.add_argument(
+        "--no-append-eod",
+        action="store_false",
+        help="Concatenate the documents without an <eod> token.",
+        dest="append_eod",
+    )
+
+    group = parser.add_argument_group(title="output data")
+    group.add_argument(
+        "--output-prefix",
+        type=str,
+        required=True,
+        help="Path to binary output file without suffix",
+    )
+    group.add_argument("--dataset-impl", type=str, default="mmap", choices=["mmap"])
+
+    group = parser.add_argument_group(title="runtime")
+    group.add_argument(
+        "--workers", type=int, default=1, help="Number of worker processes to launch"
+    )
+    group.add_argument(
+        "--chunk-size",
+        type=float,
+        default=64,
+        help="Size in MiB of the input byte range tokenized by one task",
+    )
+    group.add_argument(
+        "--log-interval",
+        type=int,
+        default=1,
+        help="Interval in number of finished chunks between progress updates",
+    )
+    return parser.parse_args()
+
+
+_ADD_DOCUMENTS_BATCH = 1024
+
+
+def _output_prefix(args, key):
+    return f"{args.output_prefix}_{key}_document"
+
+
+def _shard_prefix(args, key, shard):
+    return f"{args.output_prefix}_{key}_shard{shard:05d}"
+
+
+def _split_chunks(path, chunk_size):
+    file_size = os.path.getsize(path)
+    starts = list(range(0, file_size, chunk_size)) or [0]
+    ends = starts[1:] + [file_size]
+    return list(zip(range(len(starts)), starts, ends))
+
+
+def _add_documents(builder, docs):
+    tokens = np.fromiter(itertools.chain.from_iterable(docs), dtype=np.int64)
+    builder.add_items(tokens, [len(doc) for doc in docs], end_documents=True)
+    docs.clear()
+
+
+def _iter_lines(path, start, end):
+    """Yield the lines which begin inside the byte range [start, end)."""
+    with open(path, "rb") as f:
+        if start > 0:
+            # the line crossing start belongs to the previous chunk
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+
+class Encoder(object):
+    tokenizer = None
+
+    def __init__(self, args):
+        self.args = args
+
+    def initializer(self):
+        # Use Encoder class as a container for global data
+        Encoder.tokenizer = build_tokenizer(self.args)
+
+    def encode_chunk(self, chunk):
+        shard, start, end = chunk
+        builders = {
+            key: indexed_dataset.make_builder(
+                indexed_dataset.data_file_path(_shard_prefix(self.args, key, shard)),
+                impl=self.args.dataset_impl,
+                vocab_size=Encoder.tokenizer.vocab_size,
+            )
+            for key in self.args.json_keys
+        }
+
+        cache_info = Encoder.tokenizer.cache_info()
+        pending_docs = {key: [] for key in self.args.json_keys}
+        num_docs = 0
+        num_tokens = 0
+        for line in _iter_lines(self.args.input, start, end):
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            for key in self.args.json_keys:
+                doc_ids = Encoder.tokenizer.tokenize(data[key])
+                if self.args.append_eod:
+                    doc_ids.append(Encoder.tokenizer.eod)
+                if len(doc_ids) == 0:
+                    continue
+                pending_docs[key].append(doc_ids)
+                if len(pending_docs[key]) == _ADD_DOCUMENTS_BATCH:
+                    _add_documents(builders[key], pending_docs[key])
+                num_tokens += len(doc_ids)
+            num_docs += 1
+
+        for key, builder in builders.items():
+            if len(pending_docs[key]) > 0:
+                _add_documents(builder, pending_docs[key])
+            builder.finalize(
+                indexed_dataset.index_file_path(_shard_prefix(self.args, key, shard))
+            )
+
+        new_cache_info = Encoder.tokenizer.cache_info()
+        cache_hits = new_cache_info.hits - cache_info.hits
+        cache_misses = new_cache_info.misses - cache_info.misses
+        return shard, end - start, num_docs, num_tokens, cache_hits, cache_misses
+
+
+def main():
+    args = get_args()
+    tokenizer = build_tokenizer(args)
+    chunks = _split_chunks(args.input, int(args.chunk_size * 1024 * 1024))
+    print(f"> tokenizing {args.input} in {len(chunks)} chunks with {args.workers} workers")
+
+    encoder = Encoder(args)
+    pool = multiprocessing.Pool(args.workers, initializer=encoder.initializer)
+    encoded_chunks = pool.imap(encoder.encode_chunk, chunks, 1)
+
+    builders = {
+        key: indexed_dataset.make_builder(
+            indexed_dataset.data_file_path(_output_prefix(args, key)),
+            impl=args.dataset_impl,
+            vocab_size=tokenizer.vocab_size,
+        )
+        for key in args.json_keys
+    }
+
+    start_time = time.perf_counter()
+    total_bytes = 0
+    total_docs = 0
+    total_tokens = 0
+    total_cache_hits = 0
+    total_cache_lookups = 0
+    # imap keeps the input order, so shards are merged as soon as they finish
+    for i, encoded_chunk in enumerate(encoded_chunks, 1):
+        shard, num_bytes, num_docs, num_tokens, cache_hits, cache_misses = encoded_chunk
+        for key, builder in builders.items():
+            shard_prefix = _shard_prefix(args, key, shard)
+            builder.merge_file_(shard_prefix)
+            os.remove(indexed_dataset.data_file_path(shard_prefix))
+            os.remove(indexed_dataset.index_file_path(shard_prefix))
+
+        total_bytes += num_bytes
+        total_docs += num_docs
+        total_tokens += num_tokens
+        total_cache_hits += cache_hits
+        total_cache_lookups += cache_hits + cache_misses
+        if i % args.log_interval == 0 or i == len(chunks):
+            elapsed = time.perf_counter() - start_time
+            print(
+                f"Processed {total_docs} documents in {i}/{len(chunks)} chunks"
+                f" ({total_docs / elapsed:.2f} docs/s,"
+                f" {total_tokens / elapsed:.2f} tokens/s,"
+                f" {total_bytes / elapsed / 1024 / 1024:.2f} MB/s,"
+                f" bpe cache hit rate"
+                f" {total_cache_hits / max(total_cache_lookups, 1):.2%})."
+            )
+
+    pool.close()
+    pool.join()
+
+    for key, builder in builders.items():
+        builder.finalize(indexed_dataset.index_file_path(_output_prefix(args, key)))
+
+    num_written_tokens = 0
+    for key in args.json_keys:
+        dataset = indexed_dataset.MMapIndexedDataset(
+            _output_prefix(args, key), skip_warmup=True
+        )
+        num_written_tokens += int(dataset.sizes.sum())
+        print(
+            f"> {_output_prefix(args, key)}: {len(dataset.doc_idx) - 1} documents,"
+            f" {int(dataset.sizes.sum())} tokens"
+        )
+        del dataset
+    assert num_written_tokens == total_tokens
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""Reshard a snapshot for a different tensor/pipeline model parallel layout.
+
+Snapshot variables hold the global (logical) tensors and are sliced by the
+parallel distributions of oneflow_gpt.distribute at load time, so only the
+vocab split `wte` and its optimizer states depend on the layout: the padded
+vocab size is a multiple of the tensor model parallel size. This tool re-pads
+them for the target layout, checks every split axis of the column/row
+parallel linears against it and copies all other variables unchanged, one
+variable at a time.
+
+Pass the arguments of the target training job along with the snapshots:
+
+    python3 tools/reshard_snapshot.py <training args of the target layout> \
+        --input-snapshot old/iter100000_snapshot \
+        --output-snapshot new/iter100000_snapshot
+"""
+import os
+import re
+import sys
+import shutil
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+)
+
+import numpy as np
+
+from oneflow_gpt.config import get_args
+
+
+_VARIABLE_DATA_FILENAME = "out"
+_VARIABLE_META_FILENAME = "meta"
+_SNAPSHOT_DONE_FILENAME = "snapshot_done"
+_MANIFEST_FILENAME = "manifest.json"
+_NUMPY_DATA_TYPES = {
+    "kFloat": np.float32,
+    "kDouble": np.float64,
+    "kInt8": np.int8,
+    "kInt32": np.int32,
+    "kInt64": np.int64,
+    "kUInt8": np.uint8,
+    "kFloat16": np.float16,
+}
+# rows of wte copied at once
+_COPY_ROWS = 4096
+
+# name pattern of a variable or of its optimizer states -> tensor model
+# parallel split axis, as given by the second sbp of distribute.get_*_dist
+_SPLIT_AXES = [
+    # get_wte_parallel_dist, [B, S(0)]
+    (re.compile(r"^model-wte(-m|-v|-momentum)?$"), 0),
+    # get_col_linear_weight_parallel_dist, [B, S(1)]
+    (
+        re.compile(r"^model-h\d+-(attn-c_attn|mlp-c_fc)-weight(-m|-v|-momentum)?$"),
+        1,
+    ),
+    # get_col_linear_bias_parallel_dist, [B, S(0)]
+    (re.compile(r"^model-h\d+-(attn-c_attn|mlp-c_fc)-bias(-m|-v|-momentum)?$"), 0),
+    # get_row_linear_weight_parallel_dist, [B, S(0)]
+    (re.compile(r"^model-h\d+-(attn|mlp)-c_proj-weight(-m|-v|-momentum)?$"), 0),
+]
+
+
+def get_reshard_args(parser):
+    group = parser.add_argument_group(title="reshard")
+    group.add_argument(
+        "--input-snapshot",
+        type=str,
+        required=True,
+        help="Snapshot directory saved under the source layout.",
+    )
+    group.add_argument(
+        "--output-snapshot",
+        type=str,
+        required=True,
+        help="Snapshot directory to write for the layout of the given arguments.",
+    )
+    return parser
+
+
+def _split_axis(var_name):
+    for pattern, axis in _SPLIT_AXES:
+        if pattern.match(var_name):
+            return axis
+    return None
+
+
+def _read_meta(var_dir):
+    with open(os.path.join(var_dir, _VARIABLE_META_FILENAME), "r") as f:
+        meta = f.read()
+    shape = tuple(int(d) for d in re.findall(r"dim:\s*(\d+)", meta))
+    data_type = re.search(r"data_type:\s*(\w+)", meta).group(1)
+    return shape, data_type
+
+
+def _write_meta(var_dir, shape, data_type):
+    dims = "".join(f"  dim: {d}\n" for d in shape)
+    with open(os.path.join(var_dir, _VARIABLE_META_FILENAME), "w") as f:
+        f.write(f"shape {{\n{dims}}}\ndata_type: {data_type}\n")
+
+
+def _repad_rows(src_dir, dst_dir, shape, data_type, num_rows):
+    """Copy the first rows of a 2d variable and zero fill the padded rows,
+    `_COPY_ROWS` rows at a time."""
+    src = np.memmap(
+        os.path.join(src_dir, _VARIABLE_DATA_FILENAME),
+        dtype=_NUMPY_DATA_TYPES[data_type],
+        mode="r",
+        shape=shape,
+    )
+    copy_rows = min(shape[0], num_rows)
+    with open(os.path.join(dst_dir, _VARIABLE_DATA_FILENAME), "wb") as f:
+        for start in range(0, copy_rows, _COPY_ROWS):
+            rows = np.ascontiguousarray(src[start : min(start + _COPY_ROWS, copy_rows)])
+            f.write(memoryview(rows).cast("B"))
+        f.truncate(num_rows * shape[1] * src.dtype.itemsize)
+    del src
+    _write_meta(dst_dir, (num_rows,) + shape[1:], data_type)
+
+
+def _check_layers(var_names, num_layers, pipeline_model_parallel_size):
+    layer_pattern = re.compile(r"^model-h(\d+)-")
+    layers = set(
+        int(m.group(1)) for m in map(layer_pattern.match, var_names) if m is not None
+    )
+    if layers != set(range(num_layers)):
+        raise ValueError(
+            f"snapshot has {len(layers)} layers, expected num_layers {num_layers}"
+        )
+
+    num_layers_per_stage = num_layers // pipeline_model_parallel_size
+    for stage in range(pipeline_model_parallel_size):
+        print(
+            f" > pipeline stage {stage}: layers {stage * num_layers_per_stage}"
+            f" to {(stage + 1) * num_layers_per_stage - 1}"
+        )
+
+
+def reshard(args):
+    src = args.input_snapshot
+    dst = args.output_snapshot
+    if not os.path.isfile(os.path.join(src, _SNAPSHOT_DONE_FILENAME)):
+        raise ValueError(f"{src} is not a complete snapshot")
+    if os.path.exists(dst):
+        raise ValueError(f"{dst} already exist")
+
+    tp_size = args.tensor_model_parallel_size
+    var_names = sorted(
+        name for name in os.listdir(src) if os.path.isdir(os.path.join(src, name))
+    )
+    _check_layers(var_names, args.num_layers, args.pipeline_model_parallel_size)
+
+    tmp_dst = os.path.join(
+        os.path.dirname(os.path.abspath(dst)), f".{os.path.basename(dst)}.tmp"
+    )
+    if os.path.exists(tmp_dst):
+        shutil.rmtree(tmp_dst)
+    os.makedirs(tmp_dst)
+
+    for var_name in var_names:
+        src_dir = os.path.join(src, var_name)
+        dst_dir = os.path.join(tmp_dst, var_name)
+        os.makedirs(dst_dir)
+        shape, data_type = _read_meta(src_dir)
+        axis = _split_axis(var_name)
+
+        if var_name.startswith("model-wte"):
+            if shape[1] != args.hidden_size:
+                raise ValueError(
+                    f"{var_name} shape {shape} does not match"
+                    f" hidden size {args.hidden_size}"
+                )
+            _repad_rows(src_dir, dst_dir, shape, data_type, args.padded_vocab_size)
+            print(f"{var_name}: {shape} -> {(args.padded_vocab_size,) + shape[1:]}")
+            shape = (args.padded_vocab_size,) + shape[1:]
+        else:
+            for filename in (_VARIABLE_DATA_FILENAME, _VARIABLE_META_FILENAME):
+                shutil.copyfile(
+                    os.path.join(src_dir, filename), os.path.join(dst_dir, filename)
+                )
+
+        if axis is not None:
+            if shape[axis] % tp_size != 0:
+                raise ValueError(
+                    f"{var_name} axis {axis} of shape {shape} is not divisible by"
+                    f" tensor model parallel size {tp_size}"
+                )
+            local_shape = list(shape)
+            local_shape[axis] //= tp_size
+            print(f"{var_name}: S({axis}), {tuple(local_shape)} per rank")
+
+    # data state and other snapshot files, the manifest is of the source
+    for filename in os.listdir(src):
+        if filename in (_SNAPSHOT_DONE_FILENAME, _MANIFEST_FILENAME):
+            continue
+        if os.path.isfile(os.path.join(src, filename)):
+            shutil.copyfile(
+                os.path.join(src, filename), os.path.join(tmp_dst, filename)
+            )
+
+    with open(os.path.join(tmp_dst, _SNAPSHOT_DONE_FILENAME), "w"):
+        pass
+    os.rename(tmp_dst, dst)
+    print(
+        f"Resharded {len(var_names)} variables to {dst} for tensor model parallel"
+        f" size {tp_size}, pipeline model parallel size"
+        f" {args.pipeline_model_parallel_size}"
+    )
+
+
+if __name__ == "__main__":
+    reshard(get_args(extra_args_provider=get_reshard_args))
@@ -0,0 +1,98 @@
+"""
+Copyright 2020 The OneFlow Authors. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import csv
+import json
+import threading
+import collections
+import numpy as np
+
+
+# used by the Metric of the GPT, BERT and CNN benchmarks, which append the
+# repository root to sys.path to import it
+class MetricSink(object):
+    def __init__(self, path, file_format=None, capacity=65536, flush_interval=1.0):
+        r"""write metric records to a jsonl or csv file from a background thread
+
+        Args:
+            path: `str` output file
+            file_format: `str` jsonl or csv, inferred from the suffix of path if None
+            capacity: `Int` max number of buffered records, the oldest ones are
+                dropped when the writer falls behind
+            flush_interval: `float` seconds between writes
+        """
+        if file_format is None:
+            file_format = "csv" if path.endswith(".csv") else "jsonl"
+        if file_format not in ("jsonl", "csv"):
+            raise ValueError("file_format must be <jsonl|csv>")
+
+        self.file_format_ = file_format
+        self.flush_interval_ = flush_interval
+        # deque append and popleft are atomic, so the producer never blocks on
+        # the writer and the ring buffer needs no lock
+        self.buffer_ = collections.deque(maxlen=capacity)
+        self.num_pushed_ = 0
+        self.num_written_ = 0
+
+        self.file_ = open(path, "w", newline="")
+        self.csv_writer_ = csv.writer(self.file_)
+        self.csv_fields_ = None
+
+        self.stop_ = threading.Event()
+        self.thread_ = threading.Thread(target=self._writer, daemon=True)
+        self.thread_.start()
+
+    def push(self, fields, values):
+        """Buffer a record of `values` named by `fields`, from a single
+        producer thread. Values are formatted by the writer."""
+        self.buffer_.append((fields, values))
+        self.num_pushed_ += 1
+
+    def _write(self):
+        while True:
+            try:
+                fields, values = self.buffer_.popleft()
+            except IndexError:
+                break
+
+            values = [v.item() if isinstance(v, np.generic) else v for v in values]
+            if self.file_format_ == "csv":
+                if fields != self.csv_fields_:
+                    self.csv_writer_.writerow(fields)
+                    self.csv_fields_ = fields
+                self.csv_writer_.writerow(values)
+            else:
+                self.file_.write(json.dumps(dict(zip(fields, values))) + "\n")
+            self.num_written_ += 1
+
+        self.file_.flush()
+
+    def _writer(self):
+        while not self.stop_.wait(self.flush_interval_):
+            self._write()
+
+    @property
+    def num_dropped(self):
+        """Number of records overwritten before they were written."""
+        return self.num_pushed_ - self.num_written_ - len(self.buffer_)
+
+    def close(self):
+        self.stop_.set()
+        self.thread_.join()
+        self._write()
+        self.file_.close()
+        if self.num_dropped > 0:
+            print(f"WARNING: metric sink dropped {self.num_dropped} records")